@@ -29,20 +29,36 @@ Compared with Counter
 
 """
 
-from sortedcontainers import SortedListWithKey
+from sortedcontainers import SortedList, SortedListWithKey
+
+import bz2, csv, gc, gzip, heapq, io, marshal, mmap, os, shutil, socket
+import struct, tempfile, threading, types
 
 from collections import Counter, MutableMapping, Mapping
+from collections import KeysView, ItemsView, ValuesView, namedtuple
+from array import array
 
 from functools import wraps
 from operator import itemgetter
-from itertools import chain, repeat
-from sys import hexversion
+from itertools import chain, compress, count, groupby, islice, repeat
+from sys import getsizeof, hexversion
+from time import time
+from timeit import default_timer as timer
+from bisect import bisect_left, bisect_right, insort
+from math import ceil, floor, log
+from numbers import Integral
+from random import Random
+
+_random = Random()
 
 if hexversion < 0x03000000:
+    import cPickle as pickle
+    import Queue as queue
     from itertools import imap as map
     def iteritems(_dict):
         return _dict.iteritems()
 else:
+    import pickle, queue
     def iteritems(_dict):
         return _dict.items()
 
@@ -94,580 +110,4367 @@ class _IlocWrapper:
             del _list[index]
             del _dict[key]
 
-class PriorityDict(MutableMapping):
+class _Smallest(object):
+    """Sentinel that compares less than every other object."""
+    def __eq__(self, that):
+        return self is that
+    def __ne__(self, that):
+        return self is not that
+    def __lt__(self, that):
+        return self is not that
+    def __le__(self, that):
+        return True
+    def __gt__(self, that):
+        return False
+    def __ge__(self, that):
+        return self is that
+    __hash__ = object.__hash__
+    def __repr__(self):
+        return '_Smallest'
+
+class _Biggest(object):
+    """Sentinel that compares greater than every other object."""
+    def __eq__(self, that):
+        return self is that
+    def __ne__(self, that):
+        return self is not that
+    def __lt__(self, that):
+        return False
+    def __le__(self, that):
+        return self is that
+    def __gt__(self, that):
+        return self is not that
+    def __ge__(self, that):
+        return True
+    __hash__ = object.__hash__
+    def __repr__(self):
+        return '_Biggest'
+
+_Smallest, _Biggest = _Smallest(), _Biggest()
+
+class _Stats:
     """
-    A PriorityDict provides the same methods as a dict. Additionally, a
-    PriorityDict efficiently maintains its keys in value sorted order.
-    Consequently, the keys method will return the keys in value sorted order,
-    the popitem method will remove the item with the highest value, etc.
+    Record operation counts and latency histograms for a PriorityDict.
+
+    Histograms are keyed by power-of-two upper bounds: latencies are bucketed
+    in microseconds and tie-run lengths in entries. A bucket keyed by *b*
+    counts samples below *b* but not below ``b // 2``.
     """
-    def __init__(self, *args, **kwargs):
-        """
-        A PriorityDict provides the same methods as a dict. Additionally, a
-        PriorityDict efficiently maintains its keys in value sorted order.
-        Consequently, the keys method will return the keys in value sorted
-        order, the popitem method will remove the item with the highest value,
-        etc.
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.reset()
 
-        If the first argument is the boolean value False, then it indicates
-        that keys are not comparable. By default this setting is True and
-        duplicate values are tie-breaked on the key. Using comparable keys
-        improves the performance of the PriorityDict.
+    def reset(self):
+        """Forget all recorded counts and histograms."""
+        self.counts = Counter()
+        self.totals = Counter()
+        self.latency = {}
+        self.ties = Counter()
+        self.strategies = Counter()
+        self.rebuilt = 0
 
-        An optional *iterable* argument provides an initial series of items to
-        populate the PriorityDict.  Each item in the sequence must itself
-        contain two items. The first is used as a key in the new dictionary,
-        and the second as the key's value. If a given key is seen more than
-        once, the last value associated with it is retained in the new
-        dictionary.
+    def record(self, name, elapsed, size=1):
+        """Record operation *name* which took *elapsed* seconds."""
+        self.counts[name] += 1
+        self.totals[name] += elapsed
+        bucket = 1 << int(elapsed * 1e6).bit_length()
+        try:
+            self.latency[name][bucket] += 1
+        except KeyError:
+            self.latency[name] = Counter({bucket: 1})
+        if self.callback is not None:
+            self.callback(name, elapsed, size)
 
-        If keyword arguments are given, the keywords themselves with their
-        associated values are added as items to the dictionary. If a key is
-        specified both in the positional argument and as a keyword argument, the
-        value associated with the keyword is retained in the dictionary. For
-        example, these all return a dictionary equal to ``{"one": 2, "two":
-        3}``:
+    def as_dict(self):
+        """Return the recorded statistics as a dict of plain values."""
+        return {
+            'counts': dict(self.counts),
+            'seconds': dict(self.totals),
+            'latency': dict((name, dict(hist))
+                            for name, hist in iteritems(self.latency)),
+            'ties': dict(self.ties),
+            'strategies': dict(self.strategies),
+            'rebuilt': self.rebuilt,
+        }
 
-        * ``SortedDict(one=2, two=3)``
-        * ``SortedDict({'one': 2, 'two': 3})``
-        * ``SortedDict(zip(('one', 'two'), (2, 3)))``
-        * ``SortedDict([['two', 3], ['one', 2]])``
+class _ListProxy(object):
+    """
+    Base for proxies installed in front of the sorted list of a PriorityDict
+    to observe its mutations. Proxies may be stacked and are only installed
+    while the feature they support is enabled, so PriorityDicts without them
+    pay nothing. Everything not overridden is delegated to the wrapped list.
+    """
+    def __init__(self, _list):
+        self._list = _list
 
-        The first example only works for keys that are valid Python
-        identifiers; the others work with any valid keys.
+    def __getattr__(self, name):
+        return getattr(self._list, name)
 
-        Note that this constructor mimics the Python dict constructor. If
-        you're looking for a constructor like collections.Counter(...), see
-        PriorityDict.count(...).
-        """
-        self._dict = dict()
-        self._list = SortedListWithKey(key=itemgetter(1))
-        self.iloc = _IlocWrapper(self)
-        self.update(*args, **kwargs)
+    def __len__(self):
+        return len(self._list)
+
+    def __iter__(self):
+        return iter(self._list)
+
+    def __reversed__(self):
+        return reversed(self._list)
+
+    def __contains__(self, value):
+        return value in self._list
+
+    def __getitem__(self, index):
+        return self._list[index]
+
+    def __delitem__(self, index):
+        del self._list[index]
+
+class _StatsList(_ListProxy):
+    """Proxy which records every mutation in a `_Stats` object."""
+    def __init__(self, _list, stats):
+        self._list = _list
+        self._stats = stats
+
+    def add(self, value):
+        start = timer()
+        self._list.add(value)
+        self._stats.record('add', timer() - start)
+
+    def remove(self, value):
+        _list = self._list
+        tie = value[1]
+        run = (_list.bisect_right((_Biggest, tie))
+               - _list.bisect_left((_Smallest, tie)))
+        self._stats.ties[1 << run.bit_length()] += 1
+        start = timer()
+        _list.remove(value)
+        self._stats.record('remove', timer() - start)
+
+    def pop(self, index=-1):
+        start = timer()
+        value = self._list.pop(index)
+        self._stats.record('pop', timer() - start)
+        return value
+
+    def __delitem__(self, index):
+        size = len(self._list)
+        start = timer()
+        del self._list[index]
+        self._stats.record('delete', timer() - start,
+                           size - len(self._list))
 
     def clear(self):
-        """Remove all elements from the dictionary."""
-        self._dict.clear()
+        start = timer()
         self._list.clear()
+        self._stats.record('clear', timer() - start)
 
-    def clean(self, value=0):
-        """
-        Remove all items with value less than or equal to `value`.
-        Default `value` is 0.
-        """
-        _list, _dict = self._list, self._dict
-        pos = self.bisect_right(value)
-        for tup in _list[:pos]:
-            del _dict[tup[0]]
-        del _list[:pos]
+    def update(self, iterable):
+        values = list(iterable)
+        start = timer()
+        self._list.update(values)
+        self._stats.rebuilt += len(values)
+        self._stats.record('rebuild', timer() - start, len(values))
 
-    def __contains__(self, key):
-        """Return True if and only if *key* is in the dictionary."""
-        return key in self._dict
+class _ValueIndexList(_ListProxy):
+    """
+    Proxy which maintains `_groups`, a dict mapping each value in the sorted
+    list to the set of keys with that value.
+    """
+    def __init__(self, _list):
+        self._list = _list
+        self._groups = {}
+        self._index(_list)
 
-    def __delitem__(self, key):
-        """
-        Remove ``d[key]`` from *d*.  Raises a KeyError if *key* is not in the
-        dictionary.
-        """
-        value = self._dict[key]
-        self._list.remove((key, value))
-        del self._dict[key]
+    def _index(self, items):
+        _groups = self._groups
+        for key, value in items:
+            try:
+                _groups[value].add(key)
+            except KeyError:
+                _groups[value] = set((key,))
 
-    def __getitem__(self, key):
-        """
-        Return the priority of *key* in *d*.  Raises a KeyError if *key* is not
-        in the dictionary.
-        """
-        return self._dict[key]
+    def _unindex(self, key, value):
+        _groups = self._groups
+        keys = _groups[value]
+        keys.discard(key)
+        if not keys:
+            del _groups[value]
 
-    def __iter__(self):
-        """
-        Create an iterator over the keys of the dictionary ordered by the value
-        sort order.
-        """
-        return map(itemgetter(0), self._list)
+    def add(self, value):
+        self._list.add(value)
+        self._index((value,))
 
-    def __reversed__(self):
-        """
-        Create an iterator over the keys of the dictionary ordered by the
-        reversed value sort order.
-        """
-        return map(itemgetter(0), reversed(self._list))
+    def remove(self, value):
+        self._list.remove(value)
+        self._unindex(*value)
 
-    def __len__(self):
-        """Return the number of (key, value) pairs in the dictionary."""
-        return len(self._dict)
+    def pop(self, index=-1):
+        value = self._list.pop(index)
+        self._unindex(*value)
+        return value
 
-    def __setitem__(self, key, value):
-        """Set `d[key]` to *value*."""
-        if key in self._dict:
-            old_value = self._dict[key]
-            self._list.remove((key, old_value))
-        self._list.add((key, value))
-        self._dict[key] = value
+    def __delitem__(self, index):
+        _list = self._list
+        values = _list[index]
+        del _list[index]
+        if isinstance(index, slice):
+            for value in values:
+                self._unindex(*value)
+        else:
+            self._unindex(*values)
 
-    def copy(self):
-        """Create a shallow copy of the dictionary."""
-        return PriorityDict(self.iteritems())
+    def clear(self):
+        self._list.clear()
+        self._groups.clear()
 
-    def __copy__(self):
-        """Create a shallow copy of the dictionary."""
-        return self.copy()
+    def update(self, iterable):
+        values = list(iterable)
+        self._list.update(values)
+        self._index(values)
 
-    @classmethod
-    def fromkeys(cls, iterable, value=0):
-        """
-        Create a new dictionary with keys from `iterable` and values set to
-        `value`. The default *value* is 0.
-        """
-        return PriorityDict((key, value) for key in iterable)
+class _KeyIndexList(_ListProxy):
+    """
+    Proxy which maintains `_keys`, a SortedListWithKey of the same items as
+    the sorted list but ordered by key. Both lists hold the same item tuples.
+    """
+    def __init__(self, _list):
+        self._list = _list
+        self._keys = SortedListWithKey(_list, key=itemgetter(0))
 
-    def get(self, key, default=None):
-        """
-        Return the value for *key* if *key* is in the dictionary, else
-        *default*.  If *default* is not given, it defaults to ``None``,
-        so that this method never raises a KeyError.
-        """
-        return self._dict.get(key, default)
+    def add(self, value):
+        self._list.add(value)
+        self._keys.add(value)
 
-    def has_key(self, key):
-        """Return True if and only in *key* is in the dictionary."""
-        return key in self._dict
+    def remove(self, value):
+        self._list.remove(value)
+        self._keys.remove(value)
 
-    def pop(self, key, default=_NotGiven):
-        """
-        If *key* is in the dictionary, remove it and return its value,
-        else return *default*. If *default* is not given and *key* is not in
-        the dictionary, a KeyError is raised.
-        """
-        if key in self._dict:
-            value = self._dict[key]
-            self._list.remove((key, value))
-            return self._dict.pop(key)
+    def pop(self, index=-1):
+        value = self._list.pop(index)
+        self._keys.remove(value)
+        return value
+
+    def __delitem__(self, index):
+        _list, _keys = self._list, self._keys
+        values = _list[index]
+        del _list[index]
+        if not isinstance(index, slice):
+            _keys.remove(values)
+        elif len(values) * 8 < len(_keys):
+            for value in values:
+                _keys.remove(value)
         else:
-            if default == _NotGiven:
-                raise KeyError
-            else:
-                return default
+            _keys.clear()
+            _keys.update(_list)
 
-    def popitem(self, index=-1):
-        """
-        Remove and return item at *index* (default: -1). Raises IndexError if
-        dict is empty or index is out of range. Negative indices are supported
-        as for slice indices.
-        """
-        key, value = self._list.pop(index)
-        del self._dict[key]
-        return key, value
+    def clear(self):
+        self._list.clear()
+        self._keys.clear()
 
-    def setdefault(self, key, default=0):
-        """
-        If *key* is in the dictionary, return its value.  If not, insert *key*
-        with a value of *default* and return *default*.  *default* defaults to
-        ``0``.
-        """
-        if key in self._dict:
-            return self._dict[key]
-        else:
-            self._dict[key] = default
-            self._list.add((key, default))
-            return default
+    def update(self, iterable):
+        values = list(iterable)
+        self._list.update(values)
+        self._keys.update(values)
 
-    def elements(self):
-        """
-        Return an iterator over elements repeating each as many times as its
-        count. Elements are returned in value sort-order. If an element’s count
-        is less than one, elements() will ignore it.
-        """
-        values = (repeat(key, value) for key, value in self._list)
-        return chain.from_iterable(values)
+class _WeightsList(_ListProxy):
+    """
+    Proxy which keeps the weight ``max(value, 0)`` of every key in a slot
+    and a Fenwick tree of the prefix sums of the slot weights, so that keys
+    can be drawn in proportion to their values in logarithmic time. Slots
+    of removed keys are reused. The tree is rebuilt from the weights after
+    every `len(_weights)` changes so float rounding does not accumulate.
+    """
+    def __init__(self, _list):
+        self._list = _list
+        self._build(_list)
 
-    def most_common(self, count=None):
-        """
-        Return a list of the `count` highest priority elements with their
-        priority. If `count` is not specified, `most_common` returns *all*
-        elements in the dict. Elements with equal counts are ordered by key.
-        """
-        _list, _dict = self._list, self._dict
+    def _build(self, items):
+        self._slots = {}
+        self._keys, self._weights, self._free = [], [], []
+        for key, value in items:
+            self._slots[key] = len(self._keys)
+            self._keys.append(key)
+            self._weights.append(max(value, 0))
+        self._rebuild()
 
-        if count is None:
-            return list(reversed(_list))
+    def _rebuild(self):
+        _weights = self._weights
+        size = len(_weights)
+        _tree = self._tree = [0] + _weights
+        for pos in range(1, size + 1):
+            parent = pos + (pos & -pos)
+            if parent <= size:
+                _tree[parent] += _tree[pos]
+        self._changes = 0
 
-        end = len(_dict)
-        start = end - count
+    def _prefix(self, pos):
+        """Return the total weight of the first *pos* slots."""
+        _tree, total = self._tree, 0
+        while pos > 0:
+            total += _tree[pos]
+            pos -= pos & -pos
+        return total
 
-        return list(reversed(_list[start:end]))
+    def _set(self, slot, weight):
+        _tree, _weights = self._tree, self._weights
+        delta = weight - _weights[slot]
+        _weights[slot] = weight
+        pos, size = slot + 1, len(_weights)
+        while pos <= size:
+            _tree[pos] += delta
+            pos += pos & -pos
+        self._changes += 1
+        if self._changes > size:
+            self._rebuild()
 
-    def subtract(self, elements):
-        """
-        Elements are subtracted from an iterable or from another mapping (or
-        counter). Like dict.update() but subtracts counts instead of replacing
-        them. Both inputs and outputs may be zero or negative.
-        """
-        self -= Counter(elements)
+    def _insert(self, key, value):
+        if self._free:
+            slot = self._free.pop()
+            self._keys[slot] = key
+        else:
+            slot = len(self._keys)
+            self._keys.append(key)
+            self._weights.append(0)
+            pos = slot + 1
+            self._tree.append(self._prefix(slot) - self._prefix(pos - (pos & -pos)))
+        self._slots[key] = slot
+        self._set(slot, max(value, 0))
 
-    def tally(self, *args, **kwargs):
-        """
-        Elements are counted from an iterable or added-in from another mapping
-        (or counter). Like dict.update() but adds counts instead of replacing
-        them. Also, the iterable is expected to be a sequence of elements, not a
-        sequence of (key, value) pairs.
-        """
-        self += Counter(*args, **kwargs)
+    def _delete(self, key):
+        slot = self._slots.pop(key)
+        self._set(slot, 0)
+        self._keys[slot] = None
+        self._free.append(slot)
 
-    @classmethod
-    def count(self, *args, **kwargs):
+    def total(self):
+        """Return the total weight."""
+        return self._prefix(len(self._weights))
+
+    def find(self, target):
         """
-        Consume `args` and `kwargs` with a Counter and use that mapping to
-        initialize a PriorityDict.
+        Return the slot whose prefix sums bracket *target*, or None if
+        rounding puts *target* past the last positive weight.
         """
-        return PriorityDict(Counter(*args, **kwargs))
+        _tree, size = self._tree, len(self._weights)
+        pos, mask = 0, 1 << size.bit_length()
+        while mask:
+            step = pos + mask
+            if step <= size and _tree[step] <= target:
+                pos = step
+                target -= _tree[step]
+            mask >>= 1
+        if pos < size and self._weights[pos] > 0:
+            return pos
+        return None
 
-    def update(self, *args, **kwargs):
-        """
-        Update the dictionary with the key/value pairs from *other*, overwriting
-        existing keys.
+    def add(self, value):
+        self._list.add(value)
+        self._insert(*value)
 
-        *update* accepts either another dictionary object or an iterable of
-        key/value pairs (as a tuple or other iterable of length two).  If
-        keyword arguments are specified, the dictionary is then updated with
-        those key/value pairs: ``d.update(red=1, blue=2)``.
-        """
-        _list, _dict = self._list, self._dict
+    def remove(self, value):
+        self._list.remove(value)
+        self._delete(value[0])
 
-        if len(args) == 1 and len(kwargs) == 0 and isinstance(args[0], Mapping):
-            items = args[0]
-        else:
-            items = dict(*args, **kwargs)
+    def pop(self, index=-1):
+        value = self._list.pop(index)
+        self._delete(value[0])
+        return value
 
-        if (10 * len(items)) > len(_dict):
-            _dict.update(items)
-            _list.clear()
-            _list.update(iteritems(_dict))
-        else:
-            for key, value in iteritems(items):
-                old_value = _dict[key]
-                _list.remove((key, old_value))
-                _dict[key] = value
-                _list.add((key, value))
+    def __delitem__(self, index):
+        values = self._list[index]
+        del self._list[index]
+        if not isinstance(index, slice):
+            values = [values]
+        for key, value in values:
+            self._delete(key)
+
+    def clear(self):
+        self._list.clear()
+        self._build(())
+
+    def update(self, iterable):
+        values = list(iterable)
+        self._list.update(values)
+        if len(values) > len(self._slots):
+            self._build(self._list)
+        else:
+            for key, value in values:
+                self._insert(key, value)
+
+_MASK64 = (1 << 64) - 1
+
+class _AggregatesList(_ListProxy):
+    """
+    Proxy which maintains the running `_total` and `_squares` of the values
+    in the sorted list and `_fingerprint`, the sum of the hashes of its items
+    modulo ``2 ** 64``, which depends only on the items and not the order
+    they were written. Float sums are recomputed after every `len(_list)`
+    removals so rounding does not accumulate.
+    """
+    def __init__(self, _list):
+        self._list = _list
+        self._build()
+
+    def _build(self):
+        total = squares = fingerprint = 0
+        for item in self._list:
+            value = item[1]
+            total += value
+            squares += value * value
+            fingerprint += hash(item)
+        self._total, self._squares = total, squares
+        self._fingerprint = fingerprint & _MASK64
+        self._changes = 0
+
+    def _insert(self, item):
+        value = item[1]
+        self._total += value
+        self._squares += value * value
+        self._fingerprint = (self._fingerprint + hash(item)) & _MASK64
+
+    def _delete(self, item):
+        value = item[1]
+        self._total -= value
+        self._squares -= value * value
+        self._fingerprint = (self._fingerprint - hash(item)) & _MASK64
+
+    def _removed(self, count=1):
+        """Count *count* float removals and rebuild once rounding may show."""
+        if not isinstance(self._total, Integral):
+            self._changes += count
+            if self._changes > len(self._list):
+                self._build()
+
+    def exact(self):
+        """Return True if the sums hold no rounding error."""
+        return isinstance(self._total, Integral)
+
+    def add(self, value):
+        self._list.add(value)
+        self._insert(value)
+
+    def remove(self, value):
+        self._list.remove(value)
+        self._delete(value)
+        self._removed()
+
+    def pop(self, index=-1):
+        value = self._list.pop(index)
+        self._delete(value)
+        self._removed()
+        return value
+
+    def __delitem__(self, index):
+        values = self._list[index]
+        del self._list[index]
+        if not isinstance(index, slice):
+            values = [values]
+        if len(values) > len(self._list):
+            self._build()
+            return
+        for value in values:
+            self._delete(value)
+        self._removed(len(values))
+
+    def clear(self):
+        self._list.clear()
+        self._build()
+
+    def update(self, iterable):
+        values = list(iterable)
+        self._list.update(values)
+        for value in values:
+            self._insert(value)
+
+class _KeyIlocWrapper(_IlocWrapper):
+    def _keys(self):
+        proxy = _find(self._dict._list, _KeyIndexList)
+        if proxy is None:
+            return [(key,) for key in sorted(self._dict._dict)]
+        return proxy._keys
+
+    def __getitem__(self, index):
+        """
+        Return the key at index *index* in key order. Supports negative
+        indices and slice notation. Raises IndexError on invalid *index*.
+        """
+        _keys = self._keys()
+        if isinstance(index, slice):
+            return [tup[0] for tup in _keys[index]]
+        else:
+            return _keys[index][0]
+
+    def __delitem__(self, index):
+        """
+        Remove the key at index *index* in key order from the dictionary.
+        Supports negative indices and slice notation. Raises IndexError on
+        invalid *index*.
+        """
+        _dict = self._dict
+        if isinstance(index, slice):
+            for key in self[index]:
+                del _dict[key]
+        else:
+            del _dict[self[index]]
+
+INCREMENTAL, MERGE, REBUILD = 'incremental', 'merge', 'rebuild'
+
+class CostModel(object):
+    """
+    Choose how a bulk change is applied to the sorted list of a PriorityDict.
+
+    Changing *count* keys of a dict left with *size* keys can be done:
+
+    * incrementally, removing and adding each entry: ``count * log(size)``,
+    * by merge, filtering the list and merging in the sorted changed
+      entries: ``size + count``,
+    * by rebuild, re-sorting every entry: ``size * log(size)``.
+
+    *size* is the number of keys after the change, so changing keys that are
+    already present costs the same as for a dict of that size. Each
+    strategy's estimate is scaled by a per-unit cost in seconds. The defaults
+    are fitted to ``tests/benchmark_strategy.py`` on CPython 3.9: changing up
+    to about a tenth of the keys is fastest incrementally, and re-sorting is
+    fastest beyond that, except that merging wins for dicts of around a
+    million keys when a tenth to a third of them change. If *adaptive* is
+    True (the default), the per-unit costs are refined from the observed
+    duration of every bulk change. If *strategy* is given, it is always
+    chosen.
+
+    A model is shared by every PriorityDict through the class attribute
+    `PriorityDict.cost_model`; assign a different model to an instance to
+    tune it separately. See `CostModel.calibrate` to measure per-unit costs
+    on the running machine.
+    """
+    def __init__(self, incremental=7e-7, merge=1.4e-6, rebuild=1e-7,
+                 adaptive=True, strategy=None):
+        self.rates = {
+            INCREMENTAL: incremental,
+            MERGE: merge,
+            REBUILD: rebuild,
+        }
+        self.adaptive = adaptive
+        self.strategy = strategy
+
+    @staticmethod
+    def units(strategy, size, count):
+        """Return the estimated work of applying *strategy*."""
+        if strategy == INCREMENTAL:
+            return count * log(size + 2, 2)
+        elif strategy == MERGE:
+            return size + count
+        else:
+            return size * log(size + 2, 2)
+
+    def costs(self, size, count):
+        """
+        Return a dict mapping each strategy to its estimated cost in seconds
+        when changing *count* keys of a dict left with *size* keys.
+        """
+        units = self.units
+        return dict((strategy, rate * units(strategy, size, count))
+                    for strategy, rate in iteritems(self.rates))
+
+    def choose(self, size, count):
+        """
+        Return the cheapest strategy for changing *count* keys of a dict left
+        with *size* keys.
+        """
+        if self.strategy is not None:
+            return self.strategy
+        costs = self.costs(size, count)
+        return min(costs, key=costs.__getitem__)
+
+    def observe(self, strategy, size, count, elapsed):
+        """
+        Refine the per-unit cost of *strategy* given that changing *count*
+        keys of a dict left with *size* keys took *elapsed* seconds. Small changes are too noisy to
+        learn from and single observations move the estimate at most by a
+        factor of two.
+        """
+        if not self.adaptive or count < 64:
+            return
+        rates = self.rates
+        rate = rates[strategy]
+        observed = elapsed / self.units(strategy, size, count)
+        observed = min(max(observed, rate / 2), rate * 2)
+        rates[strategy] = rate + 0.1 * (observed - rate)
+
+    @classmethod
+    def calibrate(cls, size=100000, repeat=3):
+        """
+        Return a model with per-unit costs measured by applying each strategy
+        to a PriorityDict with *size* keys, at least 1, held in the full
+        sorted list even when small. The fastest of *repeat* runs of each
+        measurement is used.
+
+        Calibrating does not change `PriorityDict.cost_model`. Assigning the
+        result to it changes the model of every PriorityDict without one of
+        its own, and with *adaptive* set they all refine that one model.
+        """
+        if size < 1 or repeat < 1:
+            raise ValueError('size and repeat must be at least 1')
+        rates, random = {}, Random(size)
+        values = [random.random() for key in range(size)]
+        counts = {
+            INCREMENTAL: max(size // 100, 1),
+            MERGE: max(size // 10, 1),
+            REBUILD: size,
+        }
+        for strategy, count in iteritems(counts):
+            elapsed = []
+            model = cls(adaptive=False, strategy=strategy)
+            model.observe = lambda *args: elapsed.append(args[-1])
+            that = dict((key, 1) for key in range(0, size, size // count))
+            for run in range(repeat):
+                temp = PriorityDict(zip(range(size), values))
+                temp._promote()
+                temp.cost_model = model
+                temp += that
+            units = cls.units(strategy, size, len(that))
+            rates[strategy] = min(elapsed) / units
+        return cls(**rates)
+
+def _unwrap(_list):
+    """Return the SortedListWithKey behind any proxies of *_list*."""
+    while isinstance(_list, _ListProxy):
+        _list = _list._list
+    return _list
+
+def _find(_list, cls):
+    """Return the proxy of type *cls* in front of *_list*, or None."""
+    while isinstance(_list, _ListProxy):
+        if isinstance(_list, cls):
+            return _list
+        _list = _list._list
+    return None
+
+def _empty_like(_list):
+    """Return an empty sorted list of the same kind and load as *_list*."""
+    if isinstance(_list, _SmallList):
+        return _SmallList()
+    elif isinstance(_list, _PackedList):
+        return _PackedList(load=_list._list._load)
+    return SortedListWithKey(key=_list._key, value_orderable=_list._ordered,
+                             load=_list._list._load)
+
+def _clone(_list):
+    """
+    Return a copy of the sorted list *_list* made by copying its blocks
+    rather than re-sorting its values.
+    """
+    if isinstance(_list, _SmallList):
+        return _SmallList(_list._items)
+    inner = _list._list
+    result = _empty_like(_list)
+    other = result._list
+    other._lists = [list(block) for block in inner._lists]
+    other._maxes = list(inner._maxes)
+    other._index = list(inner._index)
+    other._len = inner._len
+    return result
+
+def _share(_list):
+    """
+    Return a copy of the sorted list *_list* whose blocks are shared with
+    *_list* until either modifies them. Small lists are copied.
+    """
+    if isinstance(_list, _SmallList):
+        return _SmallList(_list._items)
+    inner = _list._list
+    if not isinstance(inner, _CowList):
+        # Lists start out as plain SortedLists so that those never
+        # snapshotted do not pay for tracking shared blocks.
+        inner.__class__ = _CowList
+        inner._shared = set()
+    inner._shared.update(map(id, inner._lists))
+    result = _empty_like(_list)
+    other = result._list
+    other.__class__ = _CowList
+    other._shared = set(inner._shared)
+    other._lists = list(inner._lists)
+    other._maxes = list(inner._maxes)
+    other._len = inner._len
+    return result
+
+class _CowList(SortedList):
+    """
+    SortedList whose blocks may be shared with another list. A shared block,
+    one whose id is in `_shared`, is copied before it is first modified.
+    """
+    def _own(self, pos):
+        _lists, _shared = self._lists, self._shared
+        if 0 <= pos < len(_lists) and id(_lists[pos]) in _shared:
+            _shared.discard(id(_lists[pos]))
+            _lists[pos] = list(_lists[pos])
+
+    def _own_all(self):
+        for pos in range(len(self._lists)):
+            self._own(pos)
+
+    def add(self, val):
+        _maxes = self._maxes
+        if _maxes:
+            self._own(min(bisect_right(_maxes, val), len(_maxes) - 1))
+        SortedList.add(self, val)
+
+    def _delete(self, pos, idx):
+        # Deleting may merge the block with either neighbor.
+        for near in (pos - 1, pos, pos + 1):
+            self._own(near)
+        SortedList._delete(self, pos, idx)
+
+    def __setitem__(self, index, value):
+        self._own_all()
+        SortedList.__setitem__(self, index, value)
+
+    def append(self, val):
+        self._own_all()
+        SortedList.append(self, val)
+
+    def extend(self, values):
+        self._own_all()
+        SortedList.extend(self, values)
+
+    def insert(self, idx, val):
+        self._own_all()
+        SortedList.insert(self, idx, val)
+
+class _SmallList(object):
+    """
+    Flat sorted list of ``(value, key)`` pairs for dictionaries with few
+    items, which orders like a SortedListWithKey keyed on value but takes a
+    fraction of its memory. Provides the subset of the SortedListWithKey
+    interface used by PriorityDict.
+    """
+    __slots__ = ('_items',)
+
+    def __init__(self, elements=()):
+        self._items = list(elements)
+
+    def _find(self, value):
+        _items, elem = self._items, (value[1], value[0])
+        pos = bisect_left(_items, elem)
+        if pos == len(_items) or _items[pos] != elem:
+            raise ValueError('{0!r} not in list'.format(value))
+        return pos
+
+    def add(self, value):
+        insort(self._items, (value[1], value[0]))
+
+    def remove(self, value):
+        del self._items[self._find(value)]
+
+    def pop(self, index=-1):
+        value, key = self._items.pop(index)
+        return key, value
+
+    def update(self, iterable):
+        _items = self._items
+        _items.extend((value, key) for key, value in iterable)
+        _items.sort()
+
+    def clear(self):
+        del self._items[:]
+
+    def index(self, value):
+        return self._find(value)
+
+    def bisect_left(self, value):
+        return bisect_left(self._items, (value[1], value[0]))
+
+    def bisect_right(self, value):
+        return bisect_right(self._items, (value[1], value[0]))
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return ((key, value) for value, key in self._items)
+
+    def __reversed__(self):
+        return ((key, value) for value, key in reversed(self._items))
+
+    def __contains__(self, value):
+        try:
+            self._find(value)
+        except ValueError:
+            return False
+        return True
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [(key, value) for value, key in self._items[index]]
+        value, key = self._items[index]
+        return key, value
+
+    def __delitem__(self, index):
+        del self._items[index]
+
+    def _check(self):
+        _items = self._items
+        assert all(_items[pos] < _items[pos + 1]
+                   for pos in range(len(_items) - 1))
+
+def _chunks(iterable, size):
+    """Yield lists of up to *size* consecutive items of *iterable*."""
+    iterator = iter(iterable)
+    return iter(lambda: list(islice(iterator, size)), [])
+
+def _drain(values):
+    """Yield and release the items of list *values* in order."""
+    values.reverse()
+    while values:
+        yield values.pop()
+
+def _codec(_list):
+    """
+    Return a pair of functions converting items to and from the elements
+    stored in the blocks of the empty sorted list *_list*.
+    """
+    if isinstance(_list, _SmallList):
+        swap = itemgetter(1, 0)
+        return swap, swap
+    elif isinstance(_list, _PackedList):
+        return _pack, _unpack
+    _key, _pair = _list._key, _list._pair
+    return (lambda item: _pair(_key(item), item)), itemgetter(1)
+
+def _fill(_list, elements):
+    """
+    Fill the empty sorted list *_list* a block at a time with *elements*,
+    already converted by `_codec` and in sorted order.
+    """
+    if isinstance(_list, _SmallList):
+        _list._items.extend(elements)
+        return
+    inner = _list._list
+    for block in _chunks(elements, inner._load):
+        inner._lists.append(block)
+        inner._maxes.append(block[-1])
+        inner._len += len(block)
+    del inner._index[:]
+
+def _bound(_list, item):
+    """
+    Return the element stored in the blocks of the unwrapped sorted list
+    *_list* for *item*, whose key may be a sentinel. Bisecting left of the
+    element for a sentinel item finds the same position as bisecting the
+    item on either side.
+    """
+    if isinstance(_list, _SmallList):
+        return item[1], item[0]
+    elif isinstance(_list, _PackedList):
+        return _list._bound(item)
+    return _list._pair(_list._key(item), item)
+
+def _sweep(_list, elements):
+    """
+    Return the left bisect positions of *elements* in the sorted list
+    *_list*, in the order given. The elements are visited in sorted order
+    so that the blocks are walked once and each is searched from where the
+    previous element was found.
+    """
+    base = _unwrap(_list)
+    if isinstance(base, _SmallList):
+        _lists, _maxes = [base._items], base._items[-1:]
+    else:
+        _lists, _maxes = base._list._lists, base._list._maxes
+    blocks = len(_maxes)
+    result = [0] * len(elements)
+    pos = idx = offset = 0
+    for num in sorted(range(len(elements)), key=elements.__getitem__):
+        element = elements[num]
+        while pos < blocks and _maxes[pos] < element:
+            offset += len(_lists[pos])
+            pos += 1
+            idx = 0
+        if pos < blocks:
+            idx = bisect_left(_lists[pos], element, idx)
+        result[num] = offset + idx
+    return result
+
+def _as_list(values):
+    """Return *values*, a sequence or NumPy array, as a list."""
+    return values.tolist() if hasattr(values, 'tolist') else list(values)
+
+def _like(result, values):
+    """Return the list *result* as a NumPy array if *values* is one."""
+    if type(values).__module__ == 'numpy':
+        import numpy
+        return numpy.array(result)
+    return result
+
+_GC_HEADER = getsizeof([]) - [].__sizeof__()
+
+_UNCOUNTED = tuple(getattr(types, name) for name in (
+    'ModuleType', 'FunctionType', 'BuiltinFunctionType', 'MethodType',
+    'ClassType') if hasattr(types, name)) + (type,)
+
+_COMPONENTS = ('object', 'hash_table', 'sorted_list', 'blocks', 'index',
+               'entries', 'keys', 'values', 'proxies')
+
+def _deep_size(objects, seen):
+    """
+    Return the bytes of *objects* and every object they reference, counting
+    each once and skipping those whose ids are in *seen*, which is updated.
+    Classes, modules and functions are not counted.
+    """
+    size, stack = 0, list(objects)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _UNCOUNTED):
+            continue
+        seen.add(id(obj))
+        size += getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+def _shallow_size(objects, seen):
+    """Return the bytes of *objects* not in *seen*, adding them to it."""
+    size = 0
+    for obj in objects:
+        if id(obj) not in seen:
+            seen.add(id(obj))
+            size += getsizeof(obj)
+    return size
+
+def _estimate_entries(block, nested):
+    """
+    Return the bytes of the entries of *block*, tuples whose second element
+    is also a tuple if *nested*, or integers ordered by value. Tuples all
+    have the size of the first; integers are taken to be the size of the
+    larger of the first and last.
+    """
+    if not block:
+        return 0
+    first = block[0]
+    if nested:
+        size = getsizeof(first) + getsizeof(first[1])
+    else:
+        size = max(getsizeof(first), getsizeof(block[-1]))
+    return size * len(block)
+
+def _list_memory(_list, report, seen, exact=True):
+    """
+    Add the bytes of the unwrapped sorted list *_list* to the *report*
+    components ``sorted_list`` (list objects and their attributes),
+    ``blocks``, ``index`` (the positional index) and ``entries`` (the
+    tuples or packed integers in the blocks). If *exact* is False, entries
+    are estimated from the first of each block, in time proportional to the
+    number of blocks.
+    """
+    if isinstance(_list, _SmallList):
+        report['sorted_list'] += _shallow_size((_list,), seen)
+        report['blocks'] += _shallow_size((_list._items,), seen)
+        if exact:
+            report['entries'] += _shallow_size(_list._items, seen)
+        else:
+            report['entries'] += _estimate_entries(_list._items, False)
+        return
+    inner = _list._list
+    report['sorted_list'] += _shallow_size(
+        (_list, _list.__dict__, inner, inner.__dict__, inner._lists,
+         inner._maxes), seen)
+    report['blocks'] += _shallow_size(inner._lists, seen)
+    report['index'] += _shallow_size([inner._index] + inner._index, seen)
+    _entries, nested = report['entries'], not isinstance(_list, _PackedList)
+    for block in inner._lists:
+        if not exact:
+            _entries += _estimate_entries(block, nested)
+            continue
+        _entries += _shallow_size(block, seen)
+        if nested:
+            _entries += _shallow_size(map(itemgetter(1), block), seen)
+    report['entries'] = _entries
+
+_COMPRESSED = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+)
+
+def _open_path(path, mode):
+    """
+    Open *path* in binary *mode*, decompressing gzip, bz2 or zstd files by
+    their leading bytes when reading and compressing by extension when
+    writing. Return the file object and the compression used, if any.
+    """
+    if mode == 'rb':
+        with open(path, 'rb') as stream:
+            head = stream.read(4)
+        compression = next((name for magic, name in _COMPRESSED
+                            if head.startswith(magic)), None)
+    else:
+        extensions = {'.gz': 'gzip', '.bz2': 'bz2', '.zst': 'zstd'}
+        compression = extensions.get(os.path.splitext(path)[1])
+
+    if compression is None:
+        return open(path, mode), None
+    elif compression == 'gzip':
+        return gzip.open(path, mode), compression
+    elif compression == 'bz2':
+        return bz2.BZ2File(path, mode), compression
+
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstd files require the zstandard package')
+    if mode == 'rb':
+        stream = zstandard.ZstdDecompressor().stream_reader(open(path, mode))
+    else:
+        stream = zstandard.ZstdCompressor().stream_writer(open(path, mode))
+    return stream, compression
+
+def _text(stream, mode):
+    """Wrap binary *stream* for csv on Python 3; Python 2 csv wants bytes."""
+    if hexversion < 0x03000000:
+        return stream
+    return io.TextIOWrapper(stream, encoding='utf-8', newline='',
+                            write_through=mode == 'wb')
+
+def _text_items(reader, format, key_type, value_type):
+    """Yield ``(key, value)`` items from a TSV or CSV text file object."""
+    if format == 'csv':
+        for row in csv.reader(reader):
+            if row:
+                yield key_type(row[0]), value_type(row[1])
+    else:
+        for line in reader:
+            line = line.rstrip('\r\n')
+            if line:
+                key, value = line.rsplit('\t', 1)
+                yield key_type(key), value_type(value)
+
+def _format_value(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+_FORMATS = ('tsv', 'csv', 'binary')
+
+def _check_format(format):
+    if format not in _FORMATS:
+        raise ValueError('unknown format: {0!r}'.format(format))
+
+_BINARY_MAGIC = b'PDCT'
+_BINARY_HEADER = struct.Struct('<4sBBxxQ')
+_INT_KEY, _TEXT_KEY, _BYTES_KEY = 0, 1, 2
+_INT_VALUE, _FLOAT_VALUE = 0, 1
+
+def _binary_items(buffer):
+    """
+    Yield the ``(key, value)`` items of the binary count file in *buffer*,
+    any object supporting the buffer protocol, such as an mmap.
+
+    The file is a header of the magic bytes ``PDCT``, a key code, a value
+    code and the item count, followed by the items in value order. Integer
+    keys are stored with their value in fixed-size records; text and bytes
+    keys are prefixed by their length.
+    """
+    magic, key_code, value_code, size = _BINARY_HEADER.unpack_from(buffer, 0)
+    if magic != _BINARY_MAGIC:
+        raise ValueError('not a PriorityDict binary count file')
+    value = struct.Struct('<q' if value_code == _INT_VALUE else '<d')
+    pos = _BINARY_HEADER.size
+    if key_code == _INT_KEY:
+        record = struct.Struct('<q' + value.format[-1:])
+        for num in repeat(None, size):
+            yield record.unpack_from(buffer, pos)
+            pos += record.size
+    else:
+        length = struct.Struct('<I')
+        for num in repeat(None, size):
+            stop = pos + length.size + length.unpack_from(buffer, pos)[0]
+            key = bytes(buffer[pos + length.size:stop])
+            if key_code == _TEXT_KEY:
+                key = key.decode('utf-8')
+            yield key, value.unpack_from(buffer, stop)[0]
+            pos = stop + value.size
+
+def _write_binary(writer, items, size, key_code, value_code):
+    """Write *size* *items* to *writer* in the format of `_binary_items`."""
+    writer.write(_BINARY_HEADER.pack(_BINARY_MAGIC, key_code, value_code, size))
+    value = struct.Struct('<q' if value_code == _INT_VALUE else '<d')
+    if key_code == _INT_KEY:
+        record = struct.Struct('<q' + value.format[-1:])
+        for chunk in _chunks(items, 4096):
+            writer.write(b''.join(record.pack(*item) for item in chunk))
+    else:
+        length = struct.Struct('<I')
+        for chunk in _chunks(items, 4096):
+            parts = []
+            for key, val in chunk:
+                if key_code == _TEXT_KEY:
+                    key = key.encode('utf-8')
+                parts.extend((length.pack(len(key)), key, value.pack(val)))
+            writer.write(b''.join(parts))
+
+def _key_code(key):
+    if isinstance(key, Integral):
+        return _INT_KEY
+    elif isinstance(key, bytes):
+        return _BYTES_KEY
+    elif isinstance(key, type(u'')):
+        return _TEXT_KEY
+    raise TypeError('binary files hold int, text or bytes keys')
+
+def _check_int64(low, high, name):
+    """Raise OverflowError unless *low* and *high* fit in 64 bits."""
+    if low < -(1 << 63) or high >= 1 << 63:
+        raise OverflowError(
+            'binary files hold {0} in [-2 ** 63, 2 ** 63)'.format(name))
+
+class PriorityDict(MutableMapping):
+    """
+    A PriorityDict provides the same methods as a dict. Additionally, a
+    PriorityDict efficiently maintains its keys in value sorted order.
+    Consequently, the keys method will return the keys in value sorted order,
+    the popitem method will remove the item with the highest value, etc.
+
+    Dictionaries of up to `small_size` items keep their sorted order in a
+    flat list, and switch to a SortedListWithKey once they grow past it or
+    an index, sampling or stats is enabled. Set `small_size` to 0 to always
+    use the SortedListWithKey.
+    """
+    cost_model = CostModel()
+    small_size = 256
+
+    # Slots keep the instance dict, needed only for other attributes, from
+    # being allocated. On Python 2 the ABC base classes already provide it.
+    __slots__ = ('_dict', '_list', '_iloc') + (
+        ('__dict__', '__weakref__') if hexversion >= 0x03000000 else ())
+
+    def __init__(self, *args, **kwargs):
+        """
+        A PriorityDict provides the same methods as a dict. Additionally, a
+        PriorityDict efficiently maintains its keys in value sorted order.
+        Consequently, the keys method will return the keys in value sorted
+        order, the popitem method will remove the item with the highest value,
+        etc.
+
+        If the first argument is the boolean value False, then it indicates
+        that keys are not comparable. By default this setting is True and
+        duplicate values are tie-breaked on the key. Using comparable keys
+        improves the performance of the PriorityDict.
+
+        An optional *iterable* argument provides an initial series of items to
+        populate the PriorityDict.  Each item in the sequence must itself
+        contain two items. The first is used as a key in the new dictionary,
+        and the second as the key's value. If a given key is seen more than
+        once, the last value associated with it is retained in the new
+        dictionary.
+
+        If keyword arguments are given, the keywords themselves with their
+        associated values are added as items to the dictionary. If a key is
+        specified both in the positional argument and as a keyword argument, the
+        value associated with the keyword is retained in the dictionary. For
+        example, these all return a dictionary equal to ``{"one": 2, "two":
+        3}``:
+
+        * ``SortedDict(one=2, two=3)``
+        * ``SortedDict({'one': 2, 'two': 3})``
+        * ``SortedDict(zip(('one', 'two'), (2, 3)))``
+        * ``SortedDict([['two', 3], ['one', 2]])``
+
+        The first example only works for keys that are valid Python
+        identifiers; the others work with any valid keys.
+
+        Note that this constructor mimics the Python dict constructor. If
+        you're looking for a constructor like collections.Counter(...), see
+        PriorityDict.count(...).
+        """
+        self._dict = dict()
+        if self.small_size:
+            self._list = _SmallList()
+        else:
+            self._list = SortedListWithKey(key=itemgetter(1))
+        self.update(*args, **kwargs)
+
+    @property
+    def iloc(self):
+        """
+        Indexable view of the keys in value sorted order, created on first
+        use. See `_IlocWrapper`.
+        """
+        try:
+            return self._iloc
+        except AttributeError:
+            self._iloc = _IlocWrapper(self)
+            return self._iloc
+
+    def _promote(self):
+        """Replace a flat small list with a SortedListWithKey."""
+        _list = self._list
+        if isinstance(_list, _SmallList):
+            result = SortedListWithKey(key=itemgetter(1))
+            encode = _codec(result)[0]
+            _fill(result, [encode(item) for item in _list])
+            self._list = result
+
+    def _fit(self):
+        """Promote a small list once the dictionary grows past small_size."""
+        if type(self._list) is _SmallList and len(self._dict) > self.small_size:
+            self._promote()
+
+    def clear(self):
+        """Remove all elements from the dictionary."""
+        self._dict.clear()
+        self._list.clear()
+
+    def clean(self, value=0):
+        """
+        Remove all items with value less than or equal to `value`.
+        Default `value` is 0.
+        """
+        _list, _dict = self._list, self._dict
+        pos = self.bisect_right(value)
+        for key, value in islice(_list, pos):
+            del _dict[key]
+        del _list[:pos]
+
+    def __contains__(self, key):
+        """Return True if and only if *key* is in the dictionary."""
+        return key in self._dict
+
+    def __delitem__(self, key):
+        """
+        Remove ``d[key]`` from *d*.  Raises a KeyError if *key* is not in the
+        dictionary.
+        """
+        value = self._dict[key]
+        self._list.remove((key, value))
+        del self._dict[key]
+
+    def __getitem__(self, key):
+        """
+        Return the priority of *key* in *d*.  Raises a KeyError if *key* is not
+        in the dictionary.
+        """
+        return self._dict[key]
+
+    def __iter__(self):
+        """
+        Create an iterator over the keys of the dictionary ordered by the value
+        sort order.
+        """
+        return map(itemgetter(0), self._list)
+
+    def __reversed__(self):
+        """
+        Create an iterator over the keys of the dictionary ordered by the
+        reversed value sort order.
+        """
+        return map(itemgetter(0), reversed(self._list))
+
+    def __len__(self):
+        """Return the number of (key, value) pairs in the dictionary."""
+        return len(self._dict)
+
+    def __setitem__(self, key, value):
+        """Set `d[key]` to *value*."""
+        if key in self._dict:
+            old_value = self._dict[key]
+            self._list.remove((key, old_value))
+            try:
+                self._list.add((key, value))
+            except BaseException:
+                self._list.add((key, old_value))
+                raise
+            self._dict[key] = value
+        else:
+            self._list.add((key, value))
+            self._dict[key] = value
+            self._fit()
+
+    def copy(self):
+        """
+        Create a shallow copy of the dictionary. The sorted order is cloned
+        rather than re-sorted so copying takes linear time.
+        """
+        result = self._new()
+        result._dict = self._dict.copy()
+        result._list = _clone(_unwrap(self._list))
+        return result
+
+    def snapshot(self):
+        """
+        Return a read-only `PriorityDictSnapshot` of the dictionary. The
+        snapshot shares the blocks of the sorted list with the dictionary, so
+        taking it costs time proportional to the number of blocks, and the
+        dictionary copies a block only when it first modifies it afterwards.
+        """
+        return PriorityDictSnapshot(self)
+
+    def __copy__(self):
+        """Create a shallow copy of the dictionary."""
+        return self.copy()
+
+    @classmethod
+    def fromkeys(cls, iterable, value=0):
+        """
+        Create a new dictionary with keys from `iterable` and values set to
+        `value`. The default *value* is 0.
+        """
+        result = cls._new()
+        result.update(dict.fromkeys(iterable, value))
+        return result
+
+    @classmethod
+    def load(cls, source, format='tsv', key_type=str, value_type=int,
+             chunk_size=100000):
+        """
+        Create a new dictionary from the count file *source*, a path or a file
+        object. *format* is ``'tsv'`` for lines of key, tab and value,
+        ``'csv'``, or ``'binary'`` for files written by `dump`. Paths of
+        gzip, bz2 or zstd (with the zstandard package) compressed files are
+        decompressed; pass other compressed input as a decompressing file
+        object. File objects are read as given: text for TSV and CSV on
+        Python 3, else binary.
+
+        Text fields are converted with *key_type* and *value_type*. The file
+        is read *chunk_size* items at a time, each chunk is sorted into a run
+        and the runs are merged straight into the blocks of the sorted list,
+        so no second copy of the items is built. If a key repeats, its last
+        value is kept. Binary files are already in value order and are read
+        through mmap when *source* is an uncompressed path. Raises ValueError
+        for an unknown *format*.
+        """
+        _check_format(format)
+        result = cls._new()
+        result._promote()
+        _dict, _list = result._dict, result._list
+        encode, decode = _codec(_list)
+
+        if isinstance(source, (str, type(u''))):
+            stream, compression = _open_path(source, 'rb')
+        else:
+            stream, compression = source, None
+
+        try:
+            if format == 'binary':
+                buffer = None
+                if compression is None:
+                    try:
+                        buffer = mmap.mmap(stream.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+                    except (AttributeError, io.UnsupportedOperation):
+                        pass
+                if buffer is None:
+                    buffer = stream.read()
+                _fill(_list, result._ordered(
+                    _dict, map(encode, _binary_items(buffer)), decode))
+                if isinstance(buffer, mmap.mmap):
+                    buffer.close()
+                return result
+
+            if stream is not source:
+                stream = _text(stream, 'rb')
+            items = _text_items(stream, format, key_type, value_type)
+            runs, repeated = [], set()
+            for chunk in _chunks(items, chunk_size):
+                for key, value in chunk:
+                    if key in _dict:
+                        repeated.add(key)
+                    _dict[key] = value
+                runs.append(sorted(map(encode, chunk)))
+        finally:
+            if stream is not source:
+                stream.close()
+
+        elements = heapq.merge(*[_drain(run) for run in runs])
+        if repeated:
+            # Earlier values of repeated keys are dropped and the last
+            # values merged in.
+            elements = heapq.merge(
+                (elem for elem in elements if decode(elem)[0] not in repeated),
+                sorted(encode((key, _dict[key])) for key in repeated))
+        _fill(_list, elements)
+        return result
+
+    @staticmethod
+    def _ordered(_dict, elements, decode):
+        """
+        Yield *elements* after adding their items to *_dict*. Raise
+        ValueError if they are out of order or repeat a key.
+        """
+        last = _NotGiven
+        for elem in elements:
+            if last is not _NotGiven and not last < elem:
+                raise ValueError('binary count file is not in value order')
+            key, value = decode(elem)
+            if key in _dict:
+                raise ValueError('repeated key: {0!r}'.format(key))
+            _dict[key] = value
+            last = elem
+            yield elem
+
+    def dump(self, target, format='tsv'):
+        """
+        Write the items of the dictionary to *target*, a path or a file
+        object, in value order straight from the sorted list. *format* is as
+        for `load`. Paths ending in ``.gz``, ``.bz2`` or ``.zst`` are
+        compressed. The binary format takes int, text or bytes keys of one
+        kind and int or float values; ints must fit in 64 bits or
+        OverflowError is raised. TSV keys may hold tabs, as the value is split
+        at the last tab, but not line breaks, which raise ValueError. Raises
+        ValueError for an unknown *format*. Nothing is written if the items
+        are rejected.
+        """
+        _check_format(format)
+        if format == 'tsv':
+            for key in self._dict:
+                text = '{0}'.format(key)
+                if '\n' in text or '\r' in text:
+                    raise ValueError(
+                        'TSV keys cannot hold line breaks: {0!r}'.format(key))
+        elif format == 'binary':
+            key_code = _key_code(next(iter(self._list))[0]) if self else 0
+            if not all(_key_code(key) == key_code for key in self._dict):
+                raise TypeError('binary files hold keys of one kind')
+            integral = all(isinstance(value, Integral)
+                           for value in self.itervalues())
+            if self and key_code == _INT_KEY:
+                _check_int64(min(self._dict), max(self._dict), 'int keys')
+            if self and integral:
+                _check_int64(self._list[0][1], self._list[-1][1], 'int values')
+
+        if isinstance(target, (str, type(u''))):
+            stream = _open_path(target, 'wb')[0]
+        else:
+            stream = target
+
+        try:
+            if format == 'binary':
+                value_code = _INT_VALUE if integral else _FLOAT_VALUE
+                _write_binary(stream, iter(self._list), len(self),
+                              key_code, value_code)
+                return
+
+            writer = _text(stream, 'wb') if stream is not target else stream
+            if format == 'csv':
+                rows = csv.writer(writer)
+                for key, value in self._list:
+                    rows.writerow((key, _format_value(value)))
+            else:
+                for key, value in self._list:
+                    writer.write('{0}\t{1}\n'.format(key, _format_value(value)))
+        finally:
+            if stream is not target:
+                stream.close()
+
+    def get(self, key, default=None):
+        """
+        Return the value for *key* if *key* is in the dictionary, else
+        *default*.  If *default* is not given, it defaults to ``None``,
+        so that this method never raises a KeyError.
+        """
+        return self._dict.get(key, default)
+
+    def has_key(self, key):
+        """Return True if and only in *key* is in the dictionary."""
+        return key in self._dict
+
+    def pop(self, key, default=_NotGiven):
+        """
+        If *key* is in the dictionary, remove it and return its value,
+        else return *default*. If *default* is not given and *key* is not in
+        the dictionary, a KeyError is raised.
+        """
+        if key in self._dict:
+            value = self._dict[key]
+            self._list.remove((key, value))
+            return self._dict.pop(key)
+        else:
+            if default == _NotGiven:
+                raise KeyError
+            else:
+                return default
+
+    def popitem(self, index=-1):
+        """
+        Remove and return item at *index* (default: -1). Raises IndexError if
+        dict is empty or index is out of range. Negative indices are supported
+        as for slice indices.
+        """
+        key, value = self._list.pop(index)
+        del self._dict[key]
+        return key, value
+
+    def setdefault(self, key, default=0):
+        """
+        If *key* is in the dictionary, return its value.  If not, insert *key*
+        with a value of *default* and return *default*.  *default* defaults to
+        ``0``.
+        """
+        if key in self._dict:
+            return self._dict[key]
+        else:
+            self._dict[key] = default
+            self._list.add((key, default))
+            self._fit()
+            return default
+
+    def elements(self):
+        """
+        Return an iterator over elements repeating each as many times as its
+        count. Elements are returned in value sort-order. If an element’s count
+        is less than one, elements() will ignore it.
+        """
+        values = (repeat(key, value) for key, value in self._list)
+        return chain.from_iterable(values)
+
+    def most_common(self, count=None):
+        """
+        Return a list of the `count` highest priority elements with their
+        priority. If `count` is not specified, `most_common` returns *all*
+        elements in the dict. Elements with equal counts are ordered by key.
+        Only the `count` returned items are allocated.
+        """
+        if count is None:
+            return list(reversed(self._list))
+
+        return list(islice(reversed(self._list), max(count, 0)))
+
+    def iter_most_common(self):
+        """
+        Return an iterator over the items (``(key, value)`` pairs) of the
+        dictionary from the highest priority to the lowest. Items are produced
+        lazily so consuming a prefix costs only the items consumed.
+        """
+        return reversed(self._list)
+
+    def iter_least_common(self):
+        """
+        Return an iterator over the items (``(key, value)`` pairs) of the
+        dictionary from the lowest priority to the highest. Items are produced
+        lazily so consuming a prefix costs only the items consumed.
+        """
+        return iter(self._list)
+
+    def subtract(self, elements):
+        """
+        Elements are subtracted from an iterable or from another mapping (or
+        counter). Like dict.update() but subtracts counts instead of replacing
+        them. Both inputs and outputs may be zero or negative.
+        """
+        self -= Counter(elements)
+
+    def tally(self, *args, **kwargs):
+        """
+        Elements are counted from an iterable or added-in from another mapping
+        (or counter). Like dict.update() but adds counts instead of replacing
+        them. Also, the iterable is expected to be a sequence of elements, not a
+        sequence of (key, value) pairs.
+        """
+        self += Counter(*args, **kwargs)
+
+    @classmethod
+    def count(cls, *args, **kwargs):
+        """
+        Consume `args` and `kwargs` with a Counter and use that mapping to
+        initialize a PriorityDict.
+        """
+        result = cls._new()
+        result.update(Counter(*args, **kwargs))
+        return result
+
+    def update(self, *args, **kwargs):
+        """
+        Update the dictionary with the key/value pairs from *other*, overwriting
+        existing keys.
+
+        *update* accepts either another dictionary object or an iterable of
+        key/value pairs (as a tuple or other iterable of length two).  If
+        keyword arguments are specified, the dictionary is then updated with
+        those key/value pairs: ``d.update(red=1, blue=2)``.
+        """
+        _dict = self._dict
+
+        if len(args) == 1 and len(kwargs) == 0 and isinstance(args[0], Mapping):
+            items = args[0]
+        else:
+            items = dict(*args, **kwargs)
+            if not _dict:
+                self._dict = items
+                try:
+                    self._fit()
+                    self._list.update(iteritems(items))
+                except BaseException:
+                    self._dict = _dict
+                    self._list.clear()
+                    raise
+                return
+
+        if not _dict:
+            try:
+                _dict.update(items)
+                self._fit()
+                self._list.update(iteritems(_dict))
+            except BaseException:
+                _dict.clear()
+                self._list.clear()
+                raise
+            return
+
+        # Restore the dict if a key or value is rejected part way through so
+        # the dict and the sorted list never disagree.
+        size, changed = len(_dict), {}
+        try:
+            for key, value in iteritems(items):
+                changed[key] = _dict.get(key, _NotGiven)
+                _dict[key] = value
+        except BaseException:
+            self._restore(changed)
+            raise
+        self._apply(changed, size)
 
     def index(self, key):
         """
-        Return the smallest *i* such that `d.iloc[i] == key`.  Raises KeyError
-        if *key* is not present.
+        Return the smallest *i* such that `d.iloc[i] == key`.  Raises KeyError
+        if *key* is not present.
+        """
+        value = self._dict[key]
+        return self._list.index((key, value))
+
+    def bisect_left(self, value):
+        """
+        Similar to the ``bisect`` module in the standard library, this returns
+        an appropriate index to insert *value* in PriorityDict. If *value* is
+        already present in PriorityDict, the insertion point will be before (to
+        the left of) any existing entries.
+        """
+        return self._list.bisect_left((_Smallest, value))
+
+    bisect = bisect_left
+
+    def bisect_right(self, value):
+        """
+        Same as `bisect_left`, but if *value* is already present in
+        PriorityDict, the insertion point will be after (to the right
+        of) any existing entries.
+        """
+        return self._list.bisect_right((_Biggest, value))
+
+    def get_many(self, keys, default=None):
+        """
+        Return the values for *keys*, a sequence or NumPy array, with
+        *default* for keys not in the dictionary. The result is a NumPy array
+        if *keys* is one, else a list.
+        """
+        _get = self._dict.get
+        return _like([_get(key, default) for key in _as_list(keys)], keys)
+
+    def index_many(self, keys):
+        """
+        Return `d.index(key)` for each of *keys*, a sequence or NumPy array.
+        The positions are found in one sorted sweep over the list rather than
+        a search per key. Raises KeyError if any key is not present. The
+        result is a NumPy array if *keys* is one, else a list.
+        """
+        _dict, _list = self._dict, self._list
+        items = [(key, _dict[key]) for key in _as_list(keys)]
+        base = _unwrap(_list)
+        encode = _codec(base)[0]
+        return _like(_sweep(_list, [encode(item) for item in items]), keys)
+
+    def bisect_many(self, values, side='left'):
+        """
+        Return `d.bisect_left(value)`, or `d.bisect_right(value)` if *side* is
+        ``'right'``, for each of *values*, a sequence or NumPy array. The
+        positions are found in one sorted sweep over the list. The result is a
+        NumPy array if *values* is one, else a list.
+        """
+        if side == 'left':
+            sentinel = _Smallest
+        elif side == 'right':
+            sentinel = _Biggest
+        else:
+            raise ValueError('side must be left or right')
+        base = _unwrap(self._list)
+        elements = [_bound(base, (sentinel, value))
+                    for value in _as_list(values)]
+        return _like(_sweep(self._list, elements), values)
+
+    def set_many(self, keys, values):
+        """
+        Set `d[key] = value` for each pair of *keys* and *values*, sequences
+        or NumPy arrays of equal length. The writes are applied to the sorted
+        list as one batch, like `update`.
+        """
+        keys, values = _as_list(keys), _as_list(values)
+        if len(keys) != len(values):
+            raise ValueError('keys and values differ in length')
+        self.update(zip(keys, values))
+
+    def enable_key_index(self):
+        """
+        Start maintaining a second sorted list of the items ordered by key.
+        It holds the same item tuples as the value-ordered list and both are
+        updated together by every write. The index makes *irange_keys*,
+        *key_iloc* and *bisect_key_left* logarithmic. Building it takes
+        ``O(n log n)`` time; it has no cost until enabled. Keys must be
+        orderable.
+        """
+        if _find(self._list, _KeyIndexList) is None:
+            self._promote()
+            self._list = _KeyIndexList(self._list)
+
+    def disable_key_index(self):
+        """Stop maintaining the key index and discard it."""
+        self._remove_proxy(_KeyIndexList)
+
+    @property
+    def key_iloc(self):
+        """
+        Positional access to the keys in key order, like *iloc* in value
+        order. Without the key index the keys are sorted on every access.
+        """
+        return _KeyIlocWrapper(self)
+
+    def bisect_key_left(self, key):
+        """
+        Return the index of *key* in key order, or the index at which it
+        would be inserted if absent.
+        """
+        proxy = _find(self._list, _KeyIndexList)
+        if proxy is None:
+            return sum(1 for val in self._dict if val < key)
+        return proxy._keys.bisect_left((key, _Smallest))
+
+    bisect_key = bisect_key_left
+
+    def bisect_key_right(self, key):
+        """
+        Same as `bisect_key_left`, but if *key* is present the index returned
+        is after (to the right of) it.
+        """
+        proxy = _find(self._list, _KeyIndexList)
+        if proxy is None:
+            return sum(1 for val in self._dict if val <= key)
+        return proxy._keys.bisect_right((key, _Biggest))
+
+    def irange_keys(self, minimum=None, maximum=None, inclusive=(True, True),
+                    reverse=False):
+        """
+        Return an iterator over the keys between *minimum* and *maximum* in
+        key order, or reversed key order if *reverse* is True. A bound of
+        None is unbounded. The boolean pair *inclusive* sets whether each
+        bound is included in the range.
+        """
+        if minimum is None:
+            start = 0
+        elif inclusive[0]:
+            start = self.bisect_key_left(minimum)
+        else:
+            start = self.bisect_key_right(minimum)
+
+        if maximum is None:
+            stop = len(self)
+        elif inclusive[1]:
+            stop = self.bisect_key_right(maximum)
+        else:
+            stop = self.bisect_key_left(maximum)
+
+        keys = self.key_iloc[start:stop]
+        return reversed(keys) if reverse else iter(keys)
+
+    def _sampler(self):
+        proxy = _find(self._list, _WeightsList)
+        if proxy is None:
+            self._promote()
+            proxy = self._list = _WeightsList(self._list)
+        return proxy
+
+    def disable_sampling(self):
+        """Discard the prefix sums kept for sampling since it was first used."""
+        self._remove_proxy(_WeightsList)
+
+    def enable_aggregates(self):
+        """
+        Start maintaining the total and sum of squares of the values and a
+        fingerprint of the items, updated in constant time by every write.
+        They make *total*, *mean* and *variance* constant time and let
+        comparisons between two PriorityDicts that both maintain them return
+        early. Enabling takes linear time and happens on the first call to
+        *total*, *mean* or *variance*. Values must be numbers.
+        """
+        self._aggregates()
+
+    def disable_aggregates(self):
+        """Stop maintaining the total, sum of squares and fingerprint."""
+        self._remove_proxy(_AggregatesList)
+
+    def _aggregates(self):
+        proxy = _find(self._list, _AggregatesList)
+        if proxy is None:
+            self._promote()
+            proxy = self._list = _AggregatesList(self._list)
+        return proxy
+
+    def total(self):
+        """Return the sum of the values."""
+        return self._aggregates()._total
+
+    def mean(self):
+        """
+        Return the mean of the values. Raises ValueError if the dictionary is
+        empty.
+        """
+        if not self._dict:
+            raise ValueError('mean of an empty PriorityDict')
+        return self._aggregates()._total / float(len(self._dict))
+
+    def variance(self):
+        """
+        Return the population variance of the values. Raises ValueError if
+        the dictionary is empty.
+        """
+        size = len(self._dict)
+        if not size:
+            raise ValueError('variance of an empty PriorityDict')
+        proxy = self._aggregates()
+        total, squares = proxy._total, proxy._squares
+        if proxy.exact():
+            return (size * squares - total * total) / float(size * size)
+        return max(squares / size - (total / size) ** 2, 0.0)
+
+    def sample(self, k=1, replace=True, random=None):
+        """
+        Return a list of *k* keys drawn at random with probability
+        proportional to their values. Negative values count as zero. With
+        *replace* False, the keys are distinct; see
+        `sample_without_replacement`. *random* is the `random.Random`
+        instance to draw with, by default the module's.
+
+        The first call builds a Fenwick tree of prefix sums over the keys in
+        linear time, which every later write updates in logarithmic time.
+        Each draw then takes logarithmic time; batches of more than about
+        ``len(d) / log2(len(d))`` draws are instead sorted and resolved in one
+        pass over the weights. Raises ValueError if no value is positive.
+        """
+        if not replace:
+            return self.sample_without_replacement(k, random)
+        proxy, rand = self._sampler(), (random or _random).random
+        total = proxy.total()
+        if total <= 0:
+            raise ValueError('no positive values to sample')
+        _keys, find = proxy._keys, proxy.find
+        size = len(proxy._weights)
+
+        if k * size.bit_length() <= size:
+            result = []
+            while len(result) < k:
+                slot = find(rand() * total)
+                if slot is not None:
+                    result.append(_keys[slot])
+            return result
+
+        targets = [rand() * total for num in range(k)]
+        order = sorted(range(k), key=targets.__getitem__)
+        result = [None] * k
+        slots = ((slot, weight) for slot, weight in enumerate(proxy._weights)
+                 if weight > 0)
+        slot, cumulative = None, 0
+        for pos in order:
+            while slot is None or cumulative <= targets[pos]:
+                try:
+                    slot, weight = next(slots)
+                except StopIteration:
+                    break
+                cumulative += weight
+            result[pos] = _keys[slot]
+        return result
+
+    def sample_without_replacement(self, k, random=None):
+        """
+        Return a list of *k* distinct keys drawn one after another with
+        probability proportional to their values among the keys not yet
+        drawn. Negative values count as zero. Takes ``O(k log n)`` time.
+        Raises ValueError if fewer than *k* values are positive.
+        """
+        proxy, rand = self._sampler(), (random or _random).random
+        _keys, _weights, find = proxy._keys, proxy._weights, proxy.find
+        drawn = []
+        try:
+            while len(drawn) < k:
+                total = proxy.total()
+                if total <= 0:
+                    raise ValueError('fewer than k positive values')
+                slot = find(rand() * total)
+                if slot is not None:
+                    drawn.append((slot, _weights[slot]))
+                    proxy._set(slot, 0)
+        finally:
+            for slot, weight in drawn:
+                proxy._set(slot, weight)
+        return [_keys[slot] for slot, weight in drawn]
+
+    def enable_value_index(self):
+        """
+        Start maintaining an index from each value to the keys with that
+        value. The index is updated by every write and makes
+        *count_with_value* and *distinct_values* constant time. Building it
+        takes linear time; it has no cost until enabled.
+        """
+        if _find(self._list, _ValueIndexList) is None:
+            self._promote()
+            self._list = _ValueIndexList(self._list)
+
+    def disable_value_index(self):
+        """Stop maintaining the value index and discard it."""
+        self._remove_proxy(_ValueIndexList)
+
+    def count_with_value(self, value):
+        """Return the number of keys whose value is equal to *value*."""
+        proxy = _find(self._list, _ValueIndexList)
+        if proxy is None:
+            return self.bisect_right(value) - self.bisect_left(value)
+        keys = proxy._groups.get(value)
+        return 0 if keys is None else len(keys)
+
+    def distinct_values(self):
+        """Return the number of distinct values in the dictionary."""
+        proxy = _find(self._list, _ValueIndexList)
+        if proxy is None:
+            return sum(1 for group in groupby(self._list, itemgetter(1)))
+        return len(proxy._groups)
+
+    def iter_value_groups(self, reverse=False):
+        """
+        Return an iterator over ``(value, keys)`` pairs for each distinct
+        value, ordered by value from least to greatest or, if *reverse* is
+        True, from greatest to least. Each *keys* is a list ordered as in
+        iteration. With the value index enabled, each group is located by its
+        size rather than by scanning its entries.
+        """
+        _list = self._list
+        proxy = _find(_list, _ValueIndexList)
+
+        if proxy is None:
+            items = reversed(_list) if reverse else iter(_list)
+            return ((value, [key for key, value in group])
+                    for value, group in groupby(items, itemgetter(1)))
+
+        return self._iter_value_groups(proxy._groups, reverse)
+
+    def _iter_value_groups(self, _groups, reverse):
+        _list = self._list
+        pos, end = 0, len(_list)
+        while pos < end:
+            if reverse:
+                value = _list[end - pos - 1][1]
+                count = len(_groups[value])
+                start = end - pos - count
+                keys = [key for key, val in reversed(_list[start:end - pos])]
+            else:
+                value = _list[pos][1]
+                count = len(_groups[value])
+                keys = [key for key, val in _list[pos:pos + count]]
+            yield value, keys
+            pos += count
+
+    def __iadd__(self, that):
+        """Add values from `that` mapping."""
+        _dict = self._dict
+        size, changed = len(_dict), {}
+        try:
+            for key, value in iteritems(that):
+                if key in _dict:
+                    old_value = changed[key] = _dict[key]
+                    _dict[key] = old_value + value
+                else:
+                    changed[key] = _NotGiven
+                    _dict[key] = value
+        except BaseException:
+            self._restore(changed)
+            raise
+        self._apply(changed, size)
+        return self
+
+    def __isub__(self, that):
+        """Subtract values from `that` mapping."""
+        _dict = self._dict
+        size, changed = len(_dict), {}
+        try:
+            for key, value in iteritems(that):
+                if key in _dict:
+                    old_value = changed[key] = _dict[key]
+                    _dict[key] = old_value - value
+        except BaseException:
+            self._restore(changed)
+            raise
+        self._apply(changed, size)
+        return self
+
+    def __ior__(self, that):
+        """Or values from `that` mapping (max(v1, v2))."""
+        _dict = self._dict
+        size, changed = len(_dict), {}
+        try:
+            for key, value in iteritems(that):
+                if key in _dict:
+                    old_value = _dict[key]
+                    if value > old_value:
+                        changed[key] = old_value
+                        _dict[key] = value
+                else:
+                    changed[key] = _NotGiven
+                    _dict[key] = value
+        except BaseException:
+            self._restore(changed)
+            raise
+        self._apply(changed, size)
+        return self
+
+    def __iand__(self, that):
+        """And values from `that` mapping (min(v1, v2))."""
+        _dict = self._dict
+        size, changed = len(_dict), {}
+        try:
+            for key, value in iteritems(that):
+                if key in _dict:
+                    old_value = _dict[key]
+                    if value < old_value:
+                        changed[key] = old_value
+                        _dict[key] = value
+        except BaseException:
+            self._restore(changed)
+            raise
+        self._apply(changed, size)
+        return self
+
+    def _restore(self, changed):
+        """
+        Put back the values in *changed*, as passed to `_apply`, removing the
+        keys that were added, after a change was rejected part way through.
+        """
+        _dict = self._dict
+        for key, old_value in iteritems(changed):
+            if old_value is _NotGiven:
+                _dict.pop(key, None)
+            else:
+                _dict[key] = old_value
+
+    def _apply(self, changed, size):
+        """
+        Bring the sorted list up to date after the keys in *changed* were set
+        in the dict. *changed* maps each key to its value before the change,
+        or `_NotGiven` if it was added, and *size* is the length of the dict
+        before the change. The list is updated incrementally, merged or
+        rebuilt, whichever `cost_model` expects to be cheapest. If the list
+        rejects a value, for example one not comparable with the others, the
+        dict is restored, the list rebuilt from it and the error re-raised.
+        """
+        count = len(changed)
+
+        if count == 0:
+            return
+
+        self._fit()
+        _list, _dict, model = self._list, self._dict, self.cost_model
+        # Costs depend on the size after the change: updating keys already
+        # present does not grow the list.
+        total = len(_dict)
+        strategy = model.choose(total, count) if size else REBUILD
+        start = timer()
+
+        try:
+            if strategy == INCREMENTAL:
+                _add, _remove = _list.add, _list.remove
+                for key, old_value in iteritems(changed):
+                    if old_value is not _NotGiven:
+                        _remove((key, old_value))
+                    _add((key, _dict[key]))
+            elif strategy == MERGE:
+                kept = [tup for tup in _list if tup[0] not in changed]
+                added = sorted(((key, _dict[key]) for key in changed),
+                               key=itemgetter(1, 0))
+                _list.clear()
+                _list.update(chain(kept, added))
+            else:
+                _list.clear()
+                _list.update(iteritems(_dict))
+        except BaseException:
+            self._restore(changed)
+            _list.clear()
+            _list.update(iteritems(_dict))
+            raise
+
+        if type(_list) is not _SmallList:
+            # Timings of small lists would skew the model for large ones.
+            model.observe(strategy, total, count, timer() - start)
+
+        proxy = _find(_list, _StatsList)
+        if proxy is not None:
+            proxy._stats.strategies[strategy] += 1
+
+    @classmethod
+    def _new(cls):
+        """
+        Return a new empty dictionary for copies, operator results and the
+        alternate constructors.
+        """
+        return cls()
+
+    def __add__(self, that):
+        """Add values from this and `that` mapping."""
+        result = self._new()
+        _dict = result._dict
+        _dict.update(self._dict)
+        for key, value in iteritems(that):
+            if key in _dict:
+                _dict[key] += value
+            else:
+                _dict[key] = value
+        result._fit()
+        result._list.update(iteritems(_dict))
+        return result
+
+    def __sub__(self, that):
+        """Subtract values in `that` mapping from this."""
+        result = self._new()
+        _dict = result._dict
+        _dict.update(self._dict)
+        for key, value in iteritems(that):
+            if key in _dict:
+                _dict[key] -= value
+        result._fit()
+        result._list.update(iteritems(_dict))
+        return result
+
+    def __or__(self, that):
+        """Or values from this and `that` mapping."""
+        result = self._new()
+        _dict = result._dict
+        _dict.update(self._dict)
+        for key, value in iteritems(that):
+            if key in _dict:
+                old_value = _dict[key]
+                _dict[key] = old_value if old_value > value else value
+            else:
+                _dict[key] = value
+        result._fit()
+        result._list.update(iteritems(_dict))
+        return result
+
+    def __and__(self, that):
+        """And values from this and `that` mapping."""
+        result = self._new()
+        _dict = result._dict
+        _dict.update(self._dict)
+        for key, value in iteritems(that):
+            if key in _dict:
+                old_value = _dict[key]
+                _dict[key] = old_value if old_value < value else value
+        result._fit()
+        result._list.update(iteritems(_dict))
+        return result
+
+    def _differs(self, that):
+        """
+        Return True if the fingerprints maintained by this and PriorityDict
+        *that* show they differ. False means they may be equal.
+        """
+        this = _find(self._list, _AggregatesList)
+        other = _find(that._list, _AggregatesList)
+        return (this is not None and other is not None
+                and this._fingerprint != other._fingerprint)
+
+    def _exceeds(self, that):
+        """
+        Return True if the maintained totals show some value of this
+        dictionary must exceed that of the same key in PriorityDict *that*,
+        so this is not less than or equal to *that*. False means it may be.
+        The totals bound the values only if they are exact and *that* has
+        no negative values.
+        """
+        this = _find(self._list, _AggregatesList)
+        other = _find(that._list, _AggregatesList)
+        return (this is not None and other is not None
+                and this.exact() and other.exact()
+                and (not that._dict or that._list[0][1] >= 0)
+                and this._total > other._total)
+
+    def __eq__(self, that):
+        """Compare two mappings for equality."""
+        if isinstance(that, PriorityDict):
+            if self._differs(that):
+                return False
+            that = that._dict
+        return self._dict == that
+
+    def __ne__(self, that):
+        """Compare two mappings for inequality."""
+        if isinstance(that, PriorityDict):
+            if self._differs(that):
+                return True
+            that = that._dict
+        return self._dict != that
+
+    def __lt__(self, that):
+        """Compare two mappings for less than."""
+        if isinstance(that, PriorityDict):
+            that = that._dict
+        _dict = self._dict
+        return (_dict != that and self <= that)
+
+    def __le__(self, that):
+        """Compare two mappings for less than equal."""
+        if isinstance(that, PriorityDict):
+            if self._exceeds(that):
+                return False
+            that = that._dict
+        _dict = self._dict
+        return (len(_dict) <= len(that) and
+                all(_dict[key] <= that[key] if key in that else False
+                    for key in _dict))
+
+    def __gt__(self, that):
+        """Compare two mappings for greater than."""
+        if isinstance(that, PriorityDict):
+            that = that._dict
+        _dict = self._dict
+        return (_dict != that and self >= that)
+
+    def __ge__(self, that):
+        """Compare two mappings for greater than equal."""
+        if isinstance(that, PriorityDict):
+            if that._exceeds(self):
+                return False
+            that = that._dict
+        _dict = self._dict
+        return (len(_dict) >= len(that) and
+                all(_dict[key] >= that[key] if key in _dict else False
+                    for key in that))
+
+    def isdisjoint(self, that):
+        """
+        Return True if no key in `self` is also in `that`.
+        This doesn't check that the value is greater than zero.
+        To remove keys with value less than or equal to zero see *clean*.
+        """
+        return not any(key in self for key in that)
+
+    def items(self):
+        """
+        Return a list of the dictionary's items (``(key, value)``
+        pairs). Items are ordered by their value from least to greatest.
+        """
+        return list(self._list)
+
+    def iteritems(self):
+        """
+        Return an iterable over the items (``(key, value)`` pairs) of the
+        dictionary. Items are ordered by their value from least to greatest.
+        """
+        return iter(self._list)
+
+    @not26
+    def viewitems(self):
+        """
+        In Python 2.7 and later, return a new `ItemsView` of the dictionary's
+        items. Beware iterating the `ItemsView` as items are unordered.
+
+        In Python 2.6, raise a NotImplementedError.
+        """
+        if hexversion < 0x03000000:
+            return self._dict.viewitems()
+        else:
+            return self._dict.items()
+
+    def keys(self):
+        """
+        Return a list of the dictionary's keys. Keys are ordered
+        by their corresponding value from least to greatest.
+        """
+        return list(tup[0] for tup in self._list)
+
+    def iterkeys(self):
+        """
+        Return an iterable over the keys of the dictionary. Keys are ordered
+        by their corresponding value from least to greatest.
+        """
+        return iter(tup[0] for tup in self._list)
+
+    @not26
+    def viewkeys(self):
+        """
+        In Python 2.7 and later, return a new `KeysView` of the dictionary's
+        keys. Beware iterating the `KeysView` as keys are unordered.
+
+        In Python 2.6, raise a NotImplementedError.
+        """
+        if hexversion < 0x03000000:
+            return self._dict.viewkeys()
+        else:
+            return self._dict.keys()
+
+    def values(self):
+        """
+        Return a list of the dictionary's values. Values are
+        ordered from least to greatest.
+        """
+        return list(tup[1] for tup in self._list)
+
+    def itervalues(self):
+        """
+        Return an iterable over the values of the dictionary. Values are
+        iterated from least to greatest.
+        """
+        return iter(tup[1] for tup in self._list)
+
+    @not26
+    def viewvalues(self):
+        """
+        In Python 2.7 and later, return a `ValuesView` of the dictionary's
+        values. Beware iterating the `ValuesView` as values are unordered.
+
+        In Python 2.6, raise a NotImplementedError.
+        """
+        if hexversion < 0x03000000:
+            return self._dict.viewvalues()
+        else:
+            return self._dict.values()
+
+    def enable_stats(self, callback=None):
+        """
+        Start recording operation counts, latency histograms and rebuild
+        statistics for the dictionary. If *callback* is given, it is called
+        as ``callback(name, elapsed, size)`` after every recorded operation.
+        Recording has no cost until enabled. Returns the stats recorder; see
+        *stats* for the recorded values.
+        """
+        proxy = _find(self._list, _StatsList)
+        if proxy is None:
+            self._promote()
+            proxy = self._list = _StatsList(self._list, _Stats(callback))
+        else:
+            proxy._stats.callback = callback
+        return proxy._stats
+
+    def disable_stats(self):
+        """Stop recording statistics and discard those already recorded."""
+        self._remove_proxy(_StatsList)
+
+    def _remove_proxy(self, cls):
+        """Remove the proxy of type *cls* in front of the sorted list."""
+        holder, _list = self, self._list
+        while isinstance(_list, _ListProxy):
+            if isinstance(_list, cls):
+                holder._list = _list._list
+                return
+            holder, _list = _list, _list._list
+
+    def stats(self, reset=False):
+        """
+        Return a dict of the statistics recorded since *enable_stats* was
+        called, or None if stats are not enabled. The dict maps:
+
+        * ``counts`` to the number of each operation on the sorted list,
+        * ``seconds`` to the total time spent in each operation,
+        * ``latency`` to per-operation latency histograms in microseconds,
+        * ``ties`` to a histogram of equal-value run lengths seen by remove,
+        * ``strategies`` to the number of bulk changes applied with each
+          `CostModel` strategy,
+        * ``rebuilt`` to the number of entries loaded by rebuilds.
+
+        Operations are ``add``, ``remove``, ``pop``, ``delete``, ``clear``
+        and ``rebuild``. If *reset* is True, the recorder is cleared after
+        reading.
+        """
+        proxy = _find(self._list, _StatsList)
+        if proxy is None:
+            return None
+        stats = proxy._stats
+        result = stats.as_dict()
+        if reset:
+            stats.reset()
+        return result
+
+    def _table(self):
+        """Return the key lookup table, or None if it is not built."""
+        return self._dict
+
+    def _memory(self, contents=True):
+        """
+        Return a dict of the bytes used by each component. If *contents* is
+        False, only the containers are measured: keys, values and proxies are
+        skipped and entries are estimated, in time proportional to the number
+        of blocks.
+        """
+        report = dict.fromkeys(_COMPONENTS, 0)
+        seen = set((id(self),))
+        report['object'] = object.__sizeof__(self) + _GC_HEADER
+        base = _unwrap(self._list)
+        table = self._table()
+        if isinstance(base, _PackedList):
+            # Keys and values are packed into integers, not held as objects.
+            if table is not None:
+                report['hash_table'] = _deep_size((table,), seen)
+            _list_memory(base, report, seen, contents)
+        else:
+            if table is not None:
+                report['hash_table'] = _shallow_size((table,), seen)
+            _list_memory(base, report, seen, contents)
+            if contents:
+                items = list(base)
+                report['keys'] = _deep_size(map(itemgetter(0), items), seen)
+                report['values'] = _deep_size(map(itemgetter(1), items),
+                                              seen)
+        if not contents:
+            return report
+        proxies, _list = [], self._list
+        while _list is not base:
+            proxies.append(_list)
+            _list = _list._list
+        report['proxies'] = _deep_size(proxies, seen)
+        return report
+
+    def memory_report(self):
+        """
+        Return a dict of the bytes used by the dictionary, broken down by
+        component:
+
+        * ``object``, the dictionary object itself,
+        * ``hash_table``, the dict from keys to values, or the slot table of
+          an IntPriorityDict,
+        * ``sorted_list``, the sorted list objects, their attributes and
+          their lists of blocks and block maximums,
+        * ``blocks``, the block lists,
+        * ``index``, the positional index of the sorted list,
+        * ``entries``, the item tuples in the blocks, or packed integers,
+        * ``keys`` and ``values``, each distinct key and value object with
+          the objects it references,
+        * ``proxies``, the structures of enabled indexes, sampling,
+          aggregates and stats.
+
+        Objects are counted once, in the first component above that holds
+        them. Keys and values may also be referenced elsewhere, such as
+        small integers and interned strings, and are counted anyway. Blocks
+        shared with snapshots are counted by each. ``total`` is the sum of
+        the components, ``count`` the number of items and ``per_entry`` the
+        bytes per item above those of an empty dictionary, an estimate of
+        the cost of adding one.
+        """
+        report = self._memory()
+        report['total'] = sum(report[name] for name in _COMPONENTS)
+        report['count'] = size = len(self._list)
+        empty = self._empty()._memory()
+        fixed = sum(empty[name] for name in _COMPONENTS)
+        report['per_entry'] = (report['total'] - fixed) / float(size or 1)
+        return report
+
+    def _empty(self):
+        """Return an empty dictionary of this kind for memory baselines."""
+        return self.__class__()
+
+    def __sizeof__(self):
+        """
+        Return the bytes used by the dictionary, its hash table, sorted list
+        and entry tuples, but not its keys and values, as for a dict, nor its
+        indexes. Entries are estimated from the first of each block so this
+        takes time proportional to the number of blocks. See *memory_report*
+        for an exact breakdown.
+        """
+        report = self._memory(contents=False)
+        return sum(report[name] for name in _COMPONENTS) - _GC_HEADER
+
+    def __repr__(self):
+        """Return a string representation of PriorityDict."""
+        template = '{0}({{{1}}})'
+        items = ', '.join('{0}: {1}'.format(repr(key), repr(value))
+                          for key, value in self._list)
+        return template.format(
+            self.__class__.__name__,
+            items
+        )
+
+    def _check(self):
+        self._list._check()
+        assert len(self._dict) == len(self._list)
+        assert all(key in self._dict and self._dict[key] == value
+                   for key, value in self._list)
+        proxy = _find(self._list, _ValueIndexList)
+        if proxy is not None:
+            groups = {}
+            for key, value in self._list:
+                groups.setdefault(value, set()).add(key)
+            assert proxy._groups == groups
+        proxy = _find(self._list, _KeyIndexList)
+        if proxy is not None:
+            proxy._keys._check()
+            assert list(proxy._keys) == sorted(self._list)
+        proxy = _find(self._list, _WeightsList)
+        if proxy is not None:
+            assert len(proxy._slots) == len(self._dict)
+            for key, value in iteritems(self._dict):
+                slot = proxy._slots[key]
+                assert proxy._keys[slot] == key
+                assert proxy._weights[slot] == max(value, 0)
+            assert all(proxy._weights[slot] == 0 for slot in proxy._free)
+            total = 0
+            for pos, weight in enumerate(proxy._weights):
+                total += weight
+                assert abs(proxy._prefix(pos + 1) - total) <= 1e-9 * total
+        proxy = _find(self._list, _AggregatesList)
+        if proxy is not None:
+            values = list(self.itervalues())
+            total, squares = sum(values), sum(val * val for val in values)
+            scale = max(sum(abs(val) for val in values), 1)
+            assert abs(proxy._total - total) <= 1e-9 * scale
+            assert abs(proxy._squares - squares) <= 1e-9 * max(squares, 1)
+            assert proxy._fingerprint == sum(map(hash, self._list)) & _MASK64
+
+class _SnapshotIloc(_IlocWrapper):
+    def __delitem__(self, index):
+        raise TypeError('PriorityDictSnapshot is read-only')
+
+class PriorityDictSnapshot(PriorityDict):
+    """
+    A read-only view of a PriorityDict as it was when the snapshot was taken.
+    Snapshots share the blocks of their sorted list with the PriorityDict
+    until it modifies them. The key lookup table is built on first use so
+    snapshots only read in value order never pay for it. Use
+    `PriorityDict.snapshot` to create one and `copy` to get a writable
+    PriorityDict. Operators and the *fromkeys*, *count* and *load*
+    constructors return a PriorityDict.
+    """
+    def __init__(self, source):
+        self._list = _share(_unwrap(source._list))
+        self._lookup = None
+        self._iloc = _SnapshotIloc(self)
+
+    @property
+    def _dict(self):
+        if self._lookup is None:
+            self._lookup = dict(self._list)
+        return self._lookup
+
+    def _table(self):
+        return self._lookup
+
+    def __len__(self):
+        """Return the number of (key, value) pairs in the snapshot."""
+        return len(self._list)
+
+    @classmethod
+    def _new(cls):
+        return PriorityDict()
+
+    def _empty(self):
+        return PriorityDict().snapshot()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('PriorityDictSnapshot is read-only')
+
+    __setitem__ = __delitem__ = clear = clean = pop = popitem = _readonly
+    setdefault = update = tally = subtract = enable_stats = _readonly
+    __iadd__ = __isub__ = __ior__ = __iand__ = _readonly
+
+class WindowedPriorityDict(PriorityDict):
+    """
+    A PriorityDict of the counts tallied in the last *window* seconds. Counts
+    are kept per time bucket of ``window / buckets`` seconds and the
+    dictionary itself holds their running total. When a bucket leaves the
+    window, its counts are subtracted from the total in one batch and keys
+    whose count reaches zero or below are removed, so expiry costs time in
+    the size of the bucket rather than the window.
+
+    Writing counts directly, for example with *update* or `+=`, changes the
+    total without recording them in a bucket, so they never expire.
+    Operators and the *fromkeys*, *count* and *load* constructors return a
+    PriorityDict.
+    """
+    def __init__(self, window, buckets=60):
+        PriorityDict.__init__(self)
+        self.window = window
+        self.buckets = buckets
+        self._width = float(window) / buckets
+        self._counts = {}
+        self._latest = None
+
+    @classmethod
+    def _new(cls):
+        return PriorityDict()
+
+    def _empty(self):
+        return WindowedPriorityDict(self.window, self.buckets)
+
+    def copy(self):
+        """Create a shallow copy of the dictionary and its buckets."""
+        result = WindowedPriorityDict(self.window, self.buckets)
+        result._dict = self._dict.copy()
+        result._list = _clone(_unwrap(self._list))
+        result._counts = dict((index, counts.copy())
+                              for index, counts in iteritems(self._counts))
+        result._latest = self._latest
+        return result
+
+    def tally(self, iterable, timestamp=None):
+        """
+        Count elements from an iterable, or add counts from a mapping, at
+        *timestamp* seconds (default now) as `PriorityDict.tally` does.
+        Buckets older than the window are expired first. Counts older than
+        the window are ignored.
+        """
+        if timestamp is None:
+            timestamp = time()
+        index = self.expire(timestamp)
+        if index <= self._latest - self.buckets:
+            return
+        counts = Counter(iterable)
+        self += counts
+        if index in self._counts:
+            self._counts[index].update(counts)
+        else:
+            self._counts[index] = counts
+
+    def expire(self, timestamp=None):
+        """
+        Advance the window to *timestamp* seconds (default now) and subtract
+        the buckets which leave it. Return the index of the bucket holding
+        *timestamp*.
+        """
+        if timestamp is None:
+            timestamp = time()
+        index = int(timestamp // self._width)
+        if self._latest is None or index > self._latest:
+            self._latest = index
+        _counts, oldest = self._counts, self._latest - self.buckets
+        expired = [num for num in _counts if num <= oldest]
+        if not expired:
+            return index
+        total = _counts.pop(expired[0])
+        for num in expired[1:]:
+            total.update(_counts.pop(num))
+        self -= total
+        _dict = self._dict
+        for key in total:
+            if key in _dict and _dict[key] <= 0:
+                del self[key]
+        return index
+
+class _ByIloc(object):
+    """Keys of a MultiPriorityDict in the order of one named priority."""
+    def __init__(self, _dict, _list):
+        self._dict = _dict
+        self._list = _list
+
+    def __len__(self):
+        return len(self._list)
+
+    def __getitem__(self, index):
+        """
+        Return the key at index *index* in the order of the priority.
+        Supports negative indices and slice notation. Raises IndexError on
+        invalid *index*.
+        """
+        if isinstance(index, slice):
+            return [tup[0] for tup in self._list[index]]
+        return self._list[index][0]
+
+    def __delitem__(self, index):
+        """
+        Remove the key at index *index* in the order of the priority from
+        the dictionary. Supports negative indices and slice notation.
+        """
+        _dict = self._dict
+        if isinstance(index, slice):
+            for key in self[index]:
+                del _dict[key]
+        else:
+            del _dict[self[index]]
+
+class _MultiIloc(object):
+    def __init__(self, _dict):
+        self._dict = _dict
+
+    def __getitem__(self, by):
+        """Return the keys indexed in the order of priority *by*."""
+        _dict = self._dict
+        return _ByIloc(_dict, _dict._by(by))
+
+class MultiPriorityDict(MutableMapping):
+    """
+    A dictionary mapping each key to a record of several named priorities,
+    with the keys kept in value sorted order by each priority. *names* lists
+    the priority names, which must be valid Python identifiers, and the
+    remaining arguments populate the dictionary as for `PriorityDict`.
+
+    Records are namedtuples of type `Record` with the priorities as fields.
+    A record may be set from a Record, a mapping of every name to its value
+    or a sequence of values in name order. Each priority has its own sorted
+    list of ``(key, value)`` items over the one dict of records, and setting
+    a record only updates the lists of the priorities that changed. Use
+    *set* to change some priorities of a key and keep the rest.
+
+    Orders are as in PriorityDict: by value, then by key. Methods taking
+    *by* name the priority to use; where it is optional it defaults to the
+    first name. ``d.iloc[by]`` indexes the keys in the order of *by*.
+    """
+    def __init__(self, names, *args, **kwargs):
+        self.names = tuple(names)
+        if not self.names:
+            raise ValueError('at least one priority name is required')
+        self.Record = namedtuple('Record', self.names)
+        self._positions = dict((name, pos)
+                               for pos, name in enumerate(self.names))
+        self._dict = {}
+        self._lists = [SortedListWithKey(key=itemgetter(1))
+                       for name in self.names]
+        self.iloc = _MultiIloc(self)
+        self.update(*args, **kwargs)
+
+    def _position(self, by):
+        """
+        Return the position of priority *by* in the records, or 0 if *by*
+        is None. Raises KeyError if there is no priority named *by*.
+        """
+        if by is None:
+            return 0
+        try:
+            return self._positions[by]
+        except KeyError:
+            raise KeyError('unknown priority: {0!r}'.format(by))
+
+    def _by(self, by):
+        """Return the sorted list of priority *by*."""
+        return self._lists[self._position(by)]
+
+    def _record(self, value):
+        if isinstance(value, self.Record):
+            return value
+        elif isinstance(value, Mapping):
+            return self.Record(**value)
+        return self.Record(*value)
+
+    def __getitem__(self, key):
+        """Return the record of *key*. Raises KeyError if *key* is missing."""
+        return self._dict[key]
+
+    def __setitem__(self, key, value):
+        """
+        Set the record of *key* to *value*. Only the sorted lists of the
+        priorities whose value changed are updated.
+        """
+        record = self._record(value)
+        old = self._dict.get(key)
+        if old is None:
+            for _list, val in zip(self._lists, record):
+                _list.add((key, val))
+        else:
+            for _list, before, after in zip(self._lists, old, record):
+                if before != after:
+                    _list.remove((key, before))
+                    _list.add((key, after))
+        self._dict[key] = record
+
+    def set(self, key, **priorities):
+        """
+        Set the named *priorities* of *key* and keep its others. A key not
+        in the dictionary must be given every priority.
+        """
+        old = self._dict.get(key)
+        if old is None:
+            self[key] = self.Record(**priorities)
+        else:
+            self[key] = old._replace(**priorities)
+
+    def __delitem__(self, key):
+        """Remove *key*. Raises KeyError if *key* is missing."""
+        record = self._dict.pop(key)
+        for _list, val in zip(self._lists, record):
+            _list.remove((key, val))
+
+    def __iter__(self):
+        """Return an iterator over the keys in arbitrary order."""
+        return iter(self._dict)
+
+    def __len__(self):
+        return len(self._dict)
+
+    def __contains__(self, key):
+        return key in self._dict
+
+    def update(self, *args, **kwargs):
+        """
+        Update the dictionary with the key/record pairs from *other*, as for
+        `PriorityDict.update`. An empty dictionary sorts each priority once.
+        """
+        items = dict(*args, **kwargs)
+        if self._dict:
+            for key, value in iteritems(items):
+                self[key] = value
+            return
+        # Build every record before changing anything, so a rejected record
+        # leaves the dictionary empty.
+        _record = self._record
+        _dict = dict((key, _record(value)) for key, value in iteritems(items))
+        try:
+            for pos, _list in enumerate(self._lists):
+                _list.update((key, record[pos])
+                             for key, record in iteritems(_dict))
+        except BaseException:
+            for _list in self._lists:
+                _list.clear()
+            raise
+        self._dict = _dict
+
+    def clear(self):
+        """Remove all keys."""
+        self._dict.clear()
+        for _list in self._lists:
+            _list.clear()
+
+    def copy(self):
+        """Create a shallow copy of the dictionary."""
+        result = self.__class__(self.names)
+        result._dict = self._dict.copy()
+        result._lists = [_clone(_list) for _list in self._lists]
+        return result
+
+    __copy__ = copy
+
+    def most_common(self, count=None, by=None):
+        """
+        Return a list of the `count` keys with the highest priority *by*,
+        as ``(key, value)`` pairs, or all of them if `count` is not given.
+        """
+        _list = self._by(by)
+        if count is None:
+            return list(reversed(_list))
+        return list(islice(reversed(_list), max(count, 0)))
+
+    def index(self, key, by=None):
+        """
+        Return the position of *key* in the order of priority *by*. Raises
+        KeyError if *key* is not present.
+        """
+        pos = self._position(by)
+        return self._lists[pos].index((key, self._dict[key][pos]))
+
+    def bisect_left(self, by, value):
+        """
+        Return the number of keys whose priority *by* is less than *value*,
+        the index at which a key with that value would be inserted.
+        """
+        return self._by(by).bisect_left((_Smallest, value))
+
+    bisect = bisect_left
+
+    def bisect_right(self, by, value):
+        """
+        Same as `bisect_left`, but keys whose priority *by* equals *value*
+        are counted too.
+        """
+        return self._by(by).bisect_right((_Biggest, value))
+
+    def _check(self):
+        for pos, _list in enumerate(self._lists):
+            _list._check()
+            assert len(_list) == len(self._dict)
+            assert all(self._dict[key][pos] == value for key, value in _list)
+
+    def __repr__(self):
+        return '{0}({1!r}, {2!r})'.format(
+            self.__class__.__name__, self.names, self._dict)
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses evictions maxsize currsize')
+
+class PriorityCache(MutableMapping):
+    """
+    A mapping of at most *maxsize* entries which evicts the entry of lowest
+    priority when full. Priorities are kept in a PriorityDict so eviction
+    takes logarithmic time. *policy* sets the priority of an entry:
+
+    * ``'lfu'`` counts its uses, each lookup or set, breaking ties by
+      recency,
+    * ``'lru'`` is the time of its last use,
+    * ``'score'`` is its score, given to *set* or computed by
+      ``score(key, value)`` each time the entry is stored (default 0, or
+      the previous score when an entry is replaced), breaking ties by the
+      time it was first stored.
+
+    If *half_life* is given, LFU counts age: a use counts for twice as much
+    as one *half_life* uses earlier. Each use adds an increment which grows
+    geometrically, so no count is ever decayed in place; when the increment
+    grows large all counts are scaled down in one pass.
+
+    Only setting and lookups with ``d[key]`` or *get* count as uses and in
+    the hit and miss statistics of *cache_info*. Iteration, including over
+    items and values, is from the entry that would be evicted first.
+    """
+    def __init__(self, maxsize=128, policy='lfu', score=None, half_life=None):
+        if policy not in ('lfu', 'lru', 'score'):
+            raise ValueError('unknown policy: {0!r}'.format(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self._score = score
+        self._growth = None if half_life is None else 2 ** (1.0 / half_life)
+        self._increment = 1
+        self._ticks = count()
+        self._values = {}
+        self._priority = PriorityDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def _use(self):
+        """Return the weight of a use now and age older uses."""
+        increment = self._increment
+        if self._growth is not None:
+            self._increment *= self._growth
+            if self._increment > 1e100:
+                scale = self._increment
+                self._priority = PriorityDict(
+                    (key, (uses / scale, tick))
+                    for key, (uses, tick) in self._priority.iteritems())
+                self._increment = 1.0
+                increment /= scale
+        return increment
+
+    def _touch(self, key):
+        if self.policy == 'lfu':
+            increment = self._use()
+            uses, tick = self._priority[key]
+            self._priority[key] = (uses + increment, next(self._ticks))
+        elif self.policy == 'lru':
+            self._priority[key] = next(self._ticks)
+
+    def __getitem__(self, key):
+        """
+        Return the value of *key* and record a use and a hit. Record a miss
+        and raise KeyError if *key* is not cached.
+        """
+        try:
+            value = self._values[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        self._touch(key)
+        return value
+
+    def get(self, key, default=None):
+        """
+        Return the value of *key* if cached, else *default*, recording a hit
+        or a miss.
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        """Cache *value* for *key*, evicting an entry if full."""
+        self.set(key, value)
+
+    def set(self, key, value, score=None):
+        """
+        Cache *value* for *key*, evicting the lowest priority entry if the
+        cache is full. With the ``'score'`` policy, *score* overrides the
+        score function.
+        """
+        if self.maxsize <= 0:
+            return
+        _values, _priority = self._values, self._priority
+        if key in _values:
+            _values[key] = value
+            if self.policy == 'score':
+                if score is None:
+                    if self._score is None:
+                        score = _priority[key][0]
+                    else:
+                        score = self._score(key, value)
+                _priority[key] = (score, _priority[key][1])
+            else:
+                self._touch(key)
+            return
+
+        while len(_values) >= self.maxsize:
+            self.evict()
+
+        _values[key] = value
+        if self.policy == 'lfu':
+            # _use may rescale, replacing self._priority.
+            increment = self._use()
+            self._priority[key] = (increment, next(self._ticks))
+        elif self.policy == 'lru':
+            _priority[key] = next(self._ticks)
+        else:
+            if score is None:
+                score = 0 if self._score is None else self._score(key, value)
+            _priority[key] = (score, next(self._ticks))
+
+    def evict(self):
+        """
+        Remove and return the ``(key, value)`` entry of lowest priority.
+        Raises IndexError if the cache is empty.
+        """
+        key, priority = self._priority.popitem(0)
+        self.evictions += 1
+        return key, self._values.pop(key)
+
+    def priority(self, key):
+        """Return the priority of *key* without recording a use."""
+        return self._priority[key]
+
+    def __delitem__(self, key):
+        """Remove *key* from the cache. Raises KeyError if not cached."""
+        del self._values[key]
+        del self._priority[key]
+
+    def __contains__(self, key):
+        """Return True if *key* is cached, without recording a use."""
+        return key in self._values
+
+    def __iter__(self):
+        """Iterate the keys from the first to the last to be evicted."""
+        return iter(self._priority)
+
+    def __len__(self):
+        return len(self._values)
+
+    def iteritems(self):
+        """
+        Return an iterator over the ``(key, value)`` entries from the first
+        to the last to be evicted, without recording uses.
         """
-        value = self._dict[key]
-        return self._list.index((key, value))
+        _values = self._values
+        return ((key, _values[key]) for key in self._priority)
 
-    def bisect_left(self, value):
+    def itervalues(self):
         """
-        Similar to the ``bisect`` module in the standard library, this returns
-        an appropriate index to insert *value* in PriorityDict. If *value* is
-        already present in PriorityDict, the insertion point will be before (to
-        the left of) any existing entries.
+        Return an iterator over the values from the first to the last to be
+        evicted, without recording uses.
         """
-        return self._list.bisect_left((None, value))
+        return map(self._values.__getitem__, self._priority)
 
-    bisect = bisect_left
+    def viewitems(self):
+        return _IterItemsView(self)
 
-    def bisect_right(self, value):
+    def viewvalues(self):
+        return _IterValuesView(self)
+
+    if hexversion < 0x03000000:
+        def items(self):
+            return list(self.iteritems())
+
+        def values(self):
+            return list(self.itervalues())
+    else:
+        items, values = viewitems, viewvalues
+
+    def clear(self):
+        """Remove all entries, keeping the statistics."""
+        self._values.clear()
+        self._priority.clear()
+
+    def cache_info(self):
+        """Return a `CacheInfo` of the cache statistics."""
+        return CacheInfo(self.hits, self.misses, self.evictions,
+                         self.maxsize, len(self._values))
+
+    def cache_clear(self):
+        """Remove all entries and reset the statistics."""
+        self.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def __repr__(self):
+        return '{0}(maxsize={1!r}, policy={2!r})'.format(
+            self.__class__.__name__, self.maxsize, self.policy)
+
+_KWD_MARK = (object(),)
+
+def _make_key(args, kwargs, typed):
+    key = args
+    if kwargs:
+        items = sorted(kwargs.items())
+        key += _KWD_MARK + tuple(items)
+    if typed:
+        key += tuple(type(val) for val in args)
+        if kwargs:
+            key += tuple(type(val) for name, val in items)
+    return key
+
+def priority_cache(maxsize=128, policy='lfu', score=None, half_life=None,
+                   typed=False):
+    """
+    Function decorator caching results in a `PriorityCache` of *maxsize*,
+    *policy*, *score* and *half_life*, as `functools.lru_cache` does with
+    LRU eviction. Arguments must be hashable and, if *typed* is True,
+    arguments of different types are cached separately. The *score* function
+    is called with ``(args, kwargs)``, the tuple of positional arguments and
+    the dict of keyword arguments, and the result. The wrapper has
+    ``cache``, ``cache_info()`` and ``cache_clear()`` attributes.
+    """
+    def decorator(func):
+        cache = PriorityCache(maxsize, policy, None, half_life)
+        lock = threading.RLock()
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = _make_key(args, kwargs, typed)
+            with lock:
+                try:
+                    return cache[key]
+                except KeyError:
+                    pass
+            result = func(*args, **kwargs)
+            with lock:
+                if score is None or policy != 'score':
+                    cache[key] = result
+                else:
+                    cache.set(key, result, score((args, kwargs), result))
+            return result
+
+        wrapper.cache = cache
+        wrapper.cache_info = cache.cache_info
+        wrapper.cache_clear = cache.cache_clear
+        return wrapper
+    return decorator
+
+_SHIFT = 32
+_MASK = (1 << _SHIFT) - 1
+
+class _SlotTable(MutableMapping):
+    """
+    Mapping of integer keys in ``[0, 2 ** 32)`` to integer values held in two
+    flat arrays indexed by key: `_values` holds the values and `_present`
+    marks the keys in use. Memory is proportional to the largest key, so
+    keys should be dense. Values must fit in a C long.
+    """
+    def __init__(self):
+        self._values = array('l')
+        self._present = bytearray()
+        self._len = 0
+
+    def _grow(self, key):
+        extra = max(key + 1, 2 * len(self._present), 8) - len(self._present)
+        self._values.extend(array('l', [0]) * extra)
+        self._present.extend(bytearray(extra))
+
+    def __contains__(self, key):
+        try:
+            return key >= 0 and self._present[key] == 1
+        except (IndexError, TypeError):
+            return False
+
+    def __getitem__(self, key):
+        if key in self:
+            return self._values[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self._values[key]
+        return default
+
+    def __setitem__(self, key, value):
+        # Indexing the arrays rejects keys which are not ints.
+        if not 0 <= key <= _MASK:
+            raise TypeError('key must be an int in [0, 2 ** 32)')
+        if key >= len(self._present):
+            self._grow(key)
+        self._values[key] = value
+        if not self._present[key]:
+            self._present[key] = 1
+            self._len += 1
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._present[key] = 0
+        self._values[key] = 0
+        self._len -= 1
+
+    def __iter__(self):
+        return compress(count(), self._present)
+
+    def __len__(self):
+        return self._len
+
+    def clear(self):
+        self.__init__()
+
+    def copy(self):
+        result = _SlotTable()
+        result._values = array('l', self._values)
+        result._present = bytearray(self._present)
+        result._len = self._len
+        return result
+
+    def iteritems(self):
+        return compress(enumerate(self._values), self._present)
+
+    def itervalues(self):
+        return compress(self._values, self._present)
+
+    def viewkeys(self):
+        return KeysView(self)
+
+    def viewitems(self):
+        return _IterItemsView(self)
+
+    def viewvalues(self):
+        return _IterValuesView(self)
+
+    if hexversion < 0x03000000:
+        def items(self):
+            return list(self.iteritems())
+
+        def values(self):
+            return list(self.itervalues())
+    else:
+        keys, items, values = viewkeys, viewitems, viewvalues
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(self.__class__.__name__, dict(self.items()))
+
+class _IterItemsView(ItemsView):
+    """ItemsView iterating with the mapping's own *iteritems*."""
+    def __iter__(self):
+        return self._mapping.iteritems()
+
+class _IterValuesView(ValuesView):
+    """ValuesView iterating with the mapping's own *itervalues*."""
+    def __iter__(self):
+        return self._mapping.itervalues()
+
+def _pack(item):
+    key, value = item
+    return value << _SHIFT | key
+
+def _unpack(num):
+    return num & _MASK, num >> _SHIFT
+
+class _PackedList(object):
+    """
+    Sorted list of ``(key, value)`` items with integer keys in ``[0, 2 **
+    32)`` and integer values, stored in a SortedList as the single integers
+    ``value << 32 | key``, which order by value and then by key. Provides the
+    subset of the SortedListWithKey interface used by PriorityDict.
+    """
+    def __init__(self, iterable=None, load=1000):
+        self._list = SortedList(load=load)
+        if iterable is not None:
+            self.update(iterable)
+
+    def _bound(self, item):
         """
-        Same as `bisect_left`, but if *value* is already present in
-        PriorityDict, the insertion point will be after (to the right
-        of) any existing entries.
+        Return the packed integer to bisect for *item*. A sentinel key falls
+        between two packed items, so bisecting left of the result finds the
+        first packed item above it.
         """
-        return self._list.bisect_right((None, value))
+        key, value = item
+        if key is _Smallest:
+            if not isinstance(value, Integral):
+                value = int(ceil(value))
+            return value << _SHIFT
+        elif key is _Biggest:
+            if not isinstance(value, Integral):
+                value = int(floor(value))
+            return (value + 1) << _SHIFT
+        return _pack(item)
 
-    def __iadd__(self, that):
-        """Add values from `that` mapping."""
-        _list, _dict = self._list, self._dict
-        if len(_dict) == 0:
-            _dict.update(that)
-            _list.update(iteritems(_dict))
-        elif len(that) * 3 > len(_dict):
-            _list.clear()
-            for key, value in iteritems(that):
-                if key in _dict:
-                    _dict[key] += value
-                else:
-                    _dict[key] = value
-            _list.update(iteritems(_dict))
-        else:
-            for key, value in iteritems(that):
-                if key in _dict:
-                    old_value = _dict[key]
-                    _list.remove((key, old_value))
-                    value = old_value + value
-                _dict[key] = value
-                _list.add((key, value))
-        return self
+    def _bisect(self, item, bisect):
+        if item[0] is _Smallest or item[0] is _Biggest:
+            return self._list.bisect_left(self._bound(item))
+        return bisect(_pack(item))
 
-    def __isub__(self, that):
-        """Subtract values from `that` mapping."""
-        _list, _dict = self._list, self._dict
-        if len(_dict) == 0:
-            _dict.clear()
-            _list.clear()
-        elif len(that) * 3 > len(_dict):
-            _list.clear()
-            for key, value in iteritems(that):
-                if key in _dict:
-                    _dict[key] -= value
-            _list.update(iteritems(_dict))
-        else:
-            for key, value in iteritems(that):
-                if key in _dict:
-                    old_value = _dict[key]
-                    _list.remove((key, old_value))
-                    value = old_value - value
-                    _dict[key] = value
-                    _list.add((key, value))
-        return self
+    def add(self, value):
+        self._list.add(_pack(value))
 
-    def __ior__(self, that):
-        """Or values from `that` mapping (max(v1, v2))."""
-        _list, _dict = self._list, self._dict
-        if len(_dict) == 0:
-            _dict.update(that)
-            _list.update(iteritems(_dict))
-        elif len(that) * 3 > len(_dict):
-            _list.clear()
-            for key, value in iteritems(that):
-                if key in _dict:
-                    old_value = _dict[key]
-                    _dict[key] = old_value if old_value > value else value
-                else:
-                    _dict[key] = value
-            _list.update(iteritems(_dict))
-        else:
-            for key, value in iteritems(that):
-                if key in _dict:
-                    old_value = _dict[key]
-                    _list.remove((key, old_value))
-                    value = old_value if old_value > value else value
-                _dict[key] = value
-                _list.add((key, value))
-        return self
+    def remove(self, value):
+        self._list.remove(_pack(value))
 
-    def __iand__(self, that):
-        """And values from `that` mapping (min(v1, v2))."""
-        _list, _dict = self._list, self._dict
-        if len(_dict) == 0:
-            _dict.clear()
-            _list.clear()
-        elif len(that) * 3 > len(_dict):
-            _list.clear()
-            for key, value in iteritems(that):
-                if key in _dict:
-                    old_value = _dict[key]
-                    _dict[key] = old_value if old_value < value else value
-            _list.update(iteritems(_dict))
+    def pop(self, index=-1):
+        return _unpack(self._list.pop(index))
+
+    def update(self, iterable):
+        self._list.update(map(_pack, iterable))
+
+    def clear(self):
+        self._list.clear()
+
+    def index(self, value):
+        return self._list.index(_pack(value))
+
+    def bisect_left(self, value):
+        return self._bisect(value, self._list.bisect_left)
+
+    def bisect_right(self, value):
+        return self._bisect(value, self._list.bisect_right)
+
+    def __len__(self):
+        return len(self._list)
+
+    def __iter__(self):
+        return map(_unpack, self._list)
+
+    def __reversed__(self):
+        return map(_unpack, reversed(self._list))
+
+    def __contains__(self, value):
+        return _pack(value) in self._list
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [_unpack(num) for num in self._list[index]]
+        return _unpack(self._list[index])
+
+    def __delitem__(self, index):
+        del self._list[index]
+
+    def _check(self):
+        self._list._check()
+
+class IntPriorityDict(PriorityDict):
+    """
+    A PriorityDict specialized for dense non-negative integer keys below ``2
+    ** 32`` and integer values. Values are held in a flat array indexed by
+    key rather than in a dict, and the value sorted order is kept as single
+    packed integers rather than item tuples, which takes a fraction of the
+    memory of a PriorityDict and avoids hashing keys. The table grows to the
+    largest key stored so sparse keys waste memory. Setting a key that is not
+    an int in range raises TypeError, and a value that is not an int raises
+    TypeError or OverflowError; the dictionary is unchanged in either case.
+    """
+    def __init__(self, *args, **kwargs):
+        self._dict = _SlotTable()
+        self._list = _PackedList()
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        """Set `d[key]` to *value*."""
+        # Set the table first as it rejects keys and values that can't be
+        # packed.
+        _dict = self._dict
+        old_value = _dict.get(key, _NotGiven)
+        _dict[key] = value
+        if old_value is not _NotGiven:
+            self._list.remove((key, old_value))
+        self._list.add((key, value))
+
+    def update(self, *args, **kwargs):
+        """
+        Update the dictionary with the key/value pairs from *other*, overwriting
+        existing keys. Accepts the same arguments as `PriorityDict.update`.
+        """
+        if len(args) == 1 and len(kwargs) == 0 and isinstance(args[0], Mapping):
+            items = args[0]
         else:
-            for key, value in iteritems(that):
-                if key in _dict:
-                    old_value = _dict[key]
-                    _list.remove((key, old_value))
-                    value = old_value if old_value < value else value
-                    _dict[key] = value
-                    _list.add((key, value))
-        return self
+            items = dict(*args, **kwargs)
+        PriorityDict.update(self, items)
 
-    def __add__(self, that):
-        """Add values from this and `that` mapping."""
-        result = PriorityDict()
-        _list, _dict = result._list, result._dict
-        _dict.update(self._dict)
-        for key, value in iteritems(that):
-            if key in _dict:
-                _dict[key] += value
-            else:
-                _dict[key] = value
-        _list.update(iteritems(_dict))
-        return result
+def _tag(records, age):
+    for record in records:
+        yield record[0], -age, record
 
-    def __sub__(self, that):
-        """Subtract values in `that` mapping from this."""
-        result = PriorityDict()
-        _list, _dict = result._list, result._dict
-        _dict.update(self._dict)
-        for key, value in iteritems(that):
-            if key in _dict:
-                _dict[key] -= value
-        _list.update(iteritems(_dict))
-        return result
+def _merge_records(sources):
+    """
+    Merge *sources*, iterables of records in key order listed from oldest to
+    newest, into one iterable in key order with the newest record of each
+    key.
+    """
+    tagged = [_tag(source, age) for age, source in enumerate(sources)]
+    last = _NotGiven
+    for key, age, record in heapq.merge(*tagged):
+        if last is _NotGiven or key != last:
+            last = key
+            yield record
 
-    def __or__(self, that):
-        """Or values from this and `that` mapping."""
-        result = PriorityDict()
-        _list, _dict = result._list, result._dict
-        _dict.update(self._dict)
-        for key, value in iteritems(that):
-            if key in _dict:
-                old_value = _dict[key]
-                _dict[key] = old_value if old_value > value else value
-            else:
-                _dict[key] = value
-        _list.update(iteritems(_dict))
-        return result
+class _BloomFilter(object):
+    """
+    Set of keys answering membership with no false negatives and about
+    *error* false positives once *capacity* keys are added.
+    """
+    def __init__(self, capacity, error=0.01):
+        capacity = max(capacity, 1)
+        self._size = int(ceil(-capacity * log(error) / log(2) ** 2))
+        self._range = range(max(int(round(self._size * log(2) / capacity)), 1))
+        self._bits = bytearray((self._size + 7) // 8)
 
-    def __and__(self, that):
-        """And values from this and `that` mapping."""
-        result = PriorityDict()
-        _list, _dict = result._list, result._dict
-        _dict.update(self._dict)
-        for key, value in iteritems(that):
-            if key in _dict:
-                old_value = _dict[key]
-                _dict[key] = old_value if old_value < value else value
-        _list.update(iteritems(_dict))
-        return result
+    def _positions(self, key):
+        # Double hashing: the second hash is derived from the first by a
+        # multiplicative mix rather than by hashing again.
+        first = hash(key) & 0xFFFFFFFFFFFFFFFF
+        second = (first * 0x9E3779B97F4A7C15 >> 64) | 1
+        size = self._size
+        return [(first + num * second) % size for num in self._range]
+
+    def add(self, key):
+        _bits = self._bits
+        for pos in self._positions(key):
+            _bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        _bits = self._bits
+        for pos in self._positions(key):
+            if not _bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+class _Descending(object):
+    """Wrapper ordering ``(value, key)`` pairs from highest to lowest."""
+    __slots__ = ('pair', 'pos')
+
+    def __init__(self, pair, pos):
+        self.pair = pair
+        self.pos = pos
+
+    def __lt__(self, other):
+        return other.pair < self.pair
+
+class _Run(object):
+    """
+    Immutable file of records in key order. A record is ``(key, value)``, or
+    ``(key,)`` for a key deleted since older runs were written. Records are
+    pickled in blocks of *block* records. The first key and file span of
+    every block and a bloom filter of the keys are kept in memory so a
+    lookup reads at most one block.
+
+    The file also holds a value index: the ``(key, value)`` records are
+    read in slices of *segment* and each slice is written again sorted by
+    value, in blocks of a list of values and a list of keys. The first value,
+    span and starting position of each block of each segment are kept in
+    memory, so counting the records below a value reads one block per
+    segment. `first` and `last` are the numbers of the oldest and newest
+    flushes the run holds.
+    """
+    def __init__(self, path, records, capacity, block=256, segment=100000,
+                 first=0, last=0):
+        self.path = path
+        self.first, self.last = first, last
+        self.count = self.values = 0
+        self._firsts, self._spans = [], []
+        self._segments = []
+        self._bloom = _BloomFilter(capacity)
+        with open(path, 'wb') as writer:
+            pending = []
+            for chunk in _chunks(records, block):
+                data = pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL)
+                self._firsts.append(chunk[0][0])
+                self._spans.append((writer.tell(), len(data)))
+                writer.write(data)
+                for record in chunk:
+                    self._bloom.add(record[0])
+                    if len(record) == 2:
+                        pending.append((record[1], record[0]))
+                self.count += len(chunk)
+                if len(pending) >= segment:
+                    self._write_segment(writer, pending, block)
+                    pending = []
+            if pending:
+                self._write_segment(writer, pending, block)
+        self._file = open(path, 'rb')
+
+    def _write_segment(self, writer, pairs, block):
+        pairs.sort()
+        firsts, spans, starts = [], [], []
+        for chunk in _chunks(pairs, block):
+            values = [pair[0] for pair in chunk]
+            keys = [pair[1] for pair in chunk]
+            data = pickle.dumps((values, keys), pickle.HIGHEST_PROTOCOL)
+            firsts.append(values[0])
+            spans.append((writer.tell(), len(data)))
+            starts.append(self.values)
+            writer.write(data)
+            self.values += len(chunk)
+        base = starts[0]
+        self._segments.append(
+            (firsts, spans, [start - base for start in starts]))
+
+    def _read(self, span, reader):
+        offset, length = span
+        reader.seek(offset)
+        return pickle.loads(reader.read(length))
+
+    def find(self, key):
+        """Return the record of *key*, or None if the run has none."""
+        if key not in self._bloom:
+            return None
+        pos = bisect_right(self._firsts, key) - 1
+        if pos < 0:
+            return None
+        block = self._read(self._spans[pos], self._file)
+        idx = bisect_left(block, (key,))
+        if idx < len(block) and block[idx][0] == key:
+            return block[idx]
+        return None
+
+    def count_below(self, value, inclusive=False):
+        """
+        Return the number of records with value less than *value*, or less
+        than or equal if *inclusive*, reading one block per segment.
+        """
+        find = bisect_right if inclusive else bisect_left
+        total = 0
+        for firsts, spans, starts in self._segments:
+            pos = find(firsts, value)
+            if pos > 0:
+                values = self._read(spans[pos - 1], self._file)[0]
+                total += starts[pos - 1] + find(values, value)
+        return total
+
+    def descending(self, pos):
+        """
+        Return iterators, one per segment, of `_Descending` pairs from the
+        highest value down, tagged with *pos*.
+        """
+        return [self._descend(spans, pos) for firsts, spans, starts
+                in self._segments]
+
+    def _descend(self, spans, pos):
+        for span in reversed(spans):
+            values, keys = self._read(span, self._file)
+            for idx in range(len(values) - 1, -1, -1):
+                yield _Descending((values[idx], keys[idx]), pos)
+
+    def records(self):
+        """Iterate the records in key order with a file handle of its own."""
+        with open(self.path, 'rb') as reader:
+            for span in self._spans:
+                for record in self._read(span, reader):
+                    yield record
+
+    def close(self):
+        self._file.close()
+        os.remove(self.path)
 
-    def __eq__(self, that):
-        """Compare two mappings for equality."""
-        if isinstance(that, PriorityDict):
-            that = that._dict
-        return self._dict == that
+class SpillingPriorityDict(MutableMapping):
+    """
+    A mapping of keys to priorities for more distinct keys than fit in
+    memory. Writes go to an in-memory PriorityDict buffer of at most
+    *max_memory* keys which, when full, is written to *directory* (default a
+    new temporary directory) as a sorted run file. Once there are *max_runs*
+    runs the newest runs are merged, in a background thread if *background*
+    is True. Runs are merged with newer runs of at most their total size, so
+    each key is rewritten a logarithmic number of times. Lookups check the
+    buffer and then the runs from newest to oldest, skipping runs whose bloom
+    filter rules out the key. Deleted keys are held in memory as tombstones
+    until the next flush and count towards *max_memory*. Keys must be
+    orderable and picklable.
 
-    def __ne__(self, that):
-        """Compare two mappings for inequality."""
-        if isinstance(that, PriorityDict):
-            that = that._dict
-        return self._dict != that
+    Each run also holds a value index in segments of *max_memory* records
+    (see `_Run`). When a write replaces or deletes a record held in a run,
+    the replaced value is kept in memory until a merge drops the record, so
+    `bisect_left` and `bisect_right` count from the indexes, reading one
+    block per segment, less the replaced values. `most_common(count)` merges
+    the indexes from the highest value down and checks each record against
+    newer runs, so it reads about *count* records plus those replaced.
 
-    def __lt__(self, that):
-        """Compare two mappings for less than."""
-        if isinstance(that, PriorityDict):
-            that = that._dict
-        _dict = self._dict
-        return (_dict != that and self <= that)
+    Iteration is in key order. Iterators see the dictionary as it was when
+    they started. Call *close*, or use the dictionary as a context manager,
+    to remove the run files.
+    """
+    def __init__(self, max_memory=100000, directory=None, max_runs=4,
+                 background=True):
+        self._max_memory = max_memory
+        self._max_runs = max(max_runs, 2)
+        self._background = background
+        self._owns_directory = directory is None
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='prioritydict-')
+        self._directory = directory
+        self._names = count()
+        self._buffer = PriorityDict()
+        self._deleted = set()
+        self._runs = []
+        self._retired = []
+        # Values of run records replaced by newer writes, and for each flush
+        # number the (run flush number, value) of the records its writes
+        # replaced.
+        self._replaced = SortedList()
+        self._shadows = {}
+        self._flushes = count()
+        self._flush = next(self._flushes)
+        self._readers = 0
+        self._len = 0
+        self._lock = threading.RLock()
+        self._merging = None
+        self._error = None
 
-    def __le__(self, that):
-        """Compare two mappings for less than equal."""
-        if isinstance(that, PriorityDict):
-            that = that._dict
-        _dict = self._dict
-        return (len(_dict) <= len(that) and
-                all(_dict[key] <= that[key] if key in that else False
-                    for key in _dict))
+    def _locate(self, key):
+        """
+        Return the live record of *key* and the run holding it, None for the
+        buffer, or ``(None, None)`` if *key* is missing.
+        """
+        if key in self._buffer:
+            return (key, self._buffer[key]), None
+        if key in self._deleted:
+            return None, None
+        for run in reversed(self._runs):
+            record = run.find(key)
+            if record is not None:
+                return (record if len(record) == 2 else None), run
+        return None, None
 
-    def __gt__(self, that):
-        """Compare two mappings for greater than."""
-        if isinstance(that, PriorityDict):
-            that = that._dict
-        _dict = self._dict
-        return (_dict != that and self >= that)
+    def _lookup(self, key):
+        return self._locate(key)[0]
 
-    def __ge__(self, that):
-        """Compare two mappings for greater than equal."""
-        if isinstance(that, PriorityDict):
-            that = that._dict
-        _dict = self._dict
-        return (len(_dict) >= len(that) and
-                all(_dict[key] >= that[key] if key in _dict else False
-                    for key in that))
+    def _replace(self, key):
+        """
+        Return the live record of *key* before a write to it, recording the
+        value it replaces if the record is held in a run.
+        """
+        record, run = self._locate(key)
+        if record is not None and run is not None:
+            self._shadows.setdefault(self._flush, []).append(
+                (run.last, record[1]))
+            self._replaced.add(record[1])
+        return record
 
-    def isdisjoint(self, that):
+    def __contains__(self, key):
+        """Return True if and only if *key* is in the dictionary."""
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def __getitem__(self, key):
         """
-        Return True if no key in `self` is also in `that`.
-        This doesn't check that the value is greater than zero.
-        To remove keys with value less than or equal to zero see *clean*.
+        Return the priority of *key* in *d*.  Raises a KeyError if *key* is not
+        in the dictionary.
         """
-        return not any(key in self for key in that)
+        with self._lock:
+            record = self._lookup(key)
+        if record is None:
+            raise KeyError(key)
+        return record[1]
 
-    def items(self):
+    def __setitem__(self, key, value):
+        """Set `d[key]` to *value*."""
+        with self._lock:
+            if self._replace(key) is None:
+                self._len += 1
+            self._deleted.discard(key)
+            self._buffer[key] = value
+            self._spill()
+
+    def __delitem__(self, key):
         """
-        Return a list of the dictionary's items (``(key, value)``
-        pairs). Items are ordered by their value from least to greatest.
+        Remove ``d[key]`` from *d*.  Raises a KeyError if *key* is not in the
+        dictionary.
         """
-        return list(self._list)
+        with self._lock:
+            if self._replace(key) is None:
+                raise KeyError(key)
+            if key in self._buffer:
+                del self._buffer[key]
+            if self._runs:
+                self._deleted.add(key)
+            self._len -= 1
+            self._spill()
+
+    def __len__(self):
+        """Return the number of (key, value) pairs in the dictionary."""
+        return self._len
+
+    def __iter__(self):
+        """Create an iterator over the keys of the dictionary in key order."""
+        return map(itemgetter(0), self._records())
 
     def iteritems(self):
         """
         Return an iterable over the items (``(key, value)`` pairs) of the
-        dictionary. Items are ordered by their value from least to greatest.
+        dictionary in key order.
         """
-        return iter(self._list)
+        return self._records()
 
-    @not26
     def viewitems(self):
+        return _IterItemsView(self)
+
+    if hexversion >= 0x03000000:
+        items = viewitems
+
+    def tally(self, *args, **kwargs):
         """
-        In Python 2.7 and later, return a new `ItemsView` of the dictionary's
-        items. Beware iterating the `ItemsView` as items are unordered.
+        Elements are counted from an iterable or added-in from another mapping
+        (or counter) as in `PriorityDict.tally`. Counts are applied to the
+        buffer in batches of at most *max_memory* keys.
+        """
+        counts = Counter(*args, **kwargs)
+        for chunk in _chunks(iteritems(counts), self._max_memory):
+            with self._lock:
+                changes = {}
+                for key, num in chunk:
+                    record = self._replace(key)
+                    if record is None:
+                        self._len += 1
+                        changes[key] = num
+                    else:
+                        changes[key] = record[1] + num
+                    self._deleted.discard(key)
+                self._buffer.update(changes)
+                self._spill()
 
-        In Python 2.6, raise a NotImplementedError.
+    def most_common(self, count=None):
         """
-        if hexversion < 0x03000000:
-            return self._dict.viewitems()
+        Return a list of the `count` highest priority elements with their
+        priority, ordered as by `PriorityDict.most_common`. If `count` is not
+        specified, return *all* elements, which must then fit in memory.
+
+        The value indexes of the runs are merged with the buffer from the
+        highest value down, and a run's record is skipped if a newer write
+        replaced it, so about *count* records are read plus those replaced.
+        """
+        if count is None:
+            return sorted(self._records(), key=itemgetter(1, 0), reverse=True)
+        result = []
+        if count <= 0:
+            return result
+        with self._lock:
+            self._raise_error()
+            runs = self._runs
+            sources = [(_Descending((value, key), None)
+                        for key, value in self._buffer.iter_most_common())]
+            for pos, run in enumerate(runs):
+                sources.extend(run.descending(pos))
+            _buffer, _deleted = self._buffer, self._deleted
+            for item in heapq.merge(*sources):
+                value, key = item.pair
+                if item.pos is not None:
+                    if key in _buffer or key in _deleted:
+                        continue
+                    if any(run.find(key) is not None
+                           for run in runs[item.pos + 1:]):
+                        continue
+                result.append((key, value))
+                if len(result) == count:
+                    break
+        return result
+
+    def _count_below(self, value, inclusive):
+        with self._lock:
+            self._raise_error()
+            if inclusive:
+                total = (self._buffer.bisect_right(value)
+                         - self._replaced.bisect_right(value))
+            else:
+                total = (self._buffer.bisect_left(value)
+                         - self._replaced.bisect_left(value))
+            for run in self._runs:
+                total += run.count_below(value, inclusive)
+            return total
+
+    def bisect_left(self, value):
+        """
+        Return the number of keys whose priority is less than *value*, the
+        index at which `PriorityDict.bisect_left` would insert it. Reads one
+        block per segment of each run's value index.
+        """
+        return self._count_below(value, False)
+
+    bisect = bisect_left
+
+    def bisect_right(self, value):
+        """
+        Return the number of keys whose priority is less than or equal to
+        *value*, the index at which `PriorityDict.bisect_right` would insert
+        it. Reads one block per segment of each run's value index.
+        """
+        return self._count_below(value, True)
+
+    def clear(self):
+        """Remove all elements from the dictionary."""
+        with self._lock:
+            self._retired.extend(self._runs)
+            self._runs = []
+            self._buffer.clear()
+            self._deleted.clear()
+            self._replaced.clear()
+            self._shadows.clear()
+            self._len = 0
+            self._reap()
+
+    def flush(self):
+        """Write the buffer to a new run and clear it."""
+        with self._lock:
+            self._raise_error()
+            if not self._buffer and not self._deleted:
+                return
+            records = sorted(chain(
+                self._buffer.items(), ((key,) for key in self._deleted)))
+            flush = self._flush
+            self._runs.append(_Run(self._path(), records, len(records),
+                                   segment=self._max_memory, first=flush,
+                                   last=flush))
+            self._flush = next(self._flushes)
+            self._buffer.clear()
+            self._deleted.clear()
+            if len(self._runs) >= self._max_runs:
+                self._start_merge()
+
+    def compact(self):
+        """Flush the buffer and merge all runs into one before returning."""
+        self.wait()
+        self.flush()
+        self.wait()
+        with self._lock:
+            if len(self._runs) > 1:
+                self._merge(list(self._runs), True)
+            self._raise_error()
+
+    def wait(self):
+        """Wait for a background merge, if any, to finish."""
+        merging = self._merging
+        if merging is not None:
+            merging.join()
+
+    def close(self):
+        """Wait for merges and remove the run files and directory."""
+        self.wait()
+        self.clear()
+        if self._owns_directory:
+            shutil.rmtree(self._directory, ignore_errors=True)
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _path(self):
+        name = 'run-{0}.pickle'.format(next(self._names))
+        return os.path.join(self._directory, name)
+
+    def _spill(self):
+        if len(self._buffer) + len(self._deleted) >= self._max_memory:
+            self.flush()
+
+    def _start_merge(self):
+        if self._merging is not None and self._merging.is_alive():
+            return
+        _runs = self._runs
+        runs, total = _runs[-1:], _runs[-1].count
+        for run in reversed(_runs[:-1]):
+            if len(runs) > 1 and run.count > total:
+                break
+            runs.insert(0, run)
+            total += run.count
+        args = (runs, runs[0] is _runs[0])
+        if self._background:
+            self._merging = threading.Thread(target=self._merge, args=args)
+            self._merging.daemon = True
+            self._merging.start()
         else:
-            return self._dict.items()
+            self._merge(*args)
 
-    def keys(self):
+    def _merge(self, runs, oldest):
         """
-        Return a list of the dictionary's keys. Keys are ordered
-        by their corresponding value from least to greatest.
+        Merge *runs*, consecutive runs from oldest to newest, into one. If
+        *oldest* is True they include the oldest run, so deletion records
+        are dropped as there is no older record for them to hide.
         """
-        return list(tup[0] for tup in self._list)
+        try:
+            records = _merge_records([run.records() for run in runs])
+            if oldest:
+                records = (record for record in records if len(record) == 2)
+            merged = _Run(self._path(), records,
+                          sum(run.count for run in runs),
+                          segment=self._max_memory, first=runs[0].first,
+                          last=runs[-1].last)
+        except Exception as error:
+            self._error = error
+            return
+        with self._lock:
+            _runs = self._runs
+            pos = _runs.index(runs[0]) if runs[0] in _runs else -1
+            if pos >= 0 and _runs[pos:pos + len(runs)] == runs:
+                _runs[pos:pos + len(runs)] = [merged]
+                self._retired.extend(runs)
+                self._forget(merged.first, merged.last)
+            else:
+                self._retired.append(merged)
+            self._reap()
 
-    def iterkeys(self):
+    def _forget(self, first, last):
         """
-        Return an iterable over the keys of the dictionary. Keys are ordered
-        by their corresponding value from least to greatest.
+        Drop the replaced values of records which the merge of the runs of
+        flushes *first* to *last* removed: those replaced by a write of one
+        of those flushes to a record of another.
         """
-        return iter(tup[0] for tup in self._list)
+        _shadows, _replaced = self._shadows, self._replaced
+        for flush in range(first, last + 1):
+            shadows = _shadows.pop(flush, None)
+            if not shadows:
+                continue
+            kept = []
+            for shadow in shadows:
+                if shadow[0] < first:
+                    kept.append(shadow)
+                else:
+                    _replaced.remove(shadow[1])
+            if kept:
+                _shadows[flush] = kept
 
-    @not26
-    def viewkeys(self):
+    def _reap(self):
+        """Remove retired runs unless an iterator may still read them."""
+        if self._readers == 0:
+            for run in self._retired:
+                run.close()
+            del self._retired[:]
+
+    def _raise_error(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _records(self):
         """
-        In Python 2.7 and later, return a new `KeysView` of the dictionary's
-        keys. Beware iterating the `KeysView` as keys are unordered.
+        Yield the items in key order of the dictionary as it is when
+        iteration starts.
+        """
+        with self._lock:
+            runs = list(self._runs)
+            latest = sorted(chain(
+                self._buffer.items(), ((key,) for key in self._deleted)))
+            self._readers += 1
+        try:
+            sources = [run.records() for run in runs] + [latest]
+            for record in _merge_records(sources):
+                if len(record) == 2:
+                    yield record
+        finally:
+            with self._lock:
+                self._readers -= 1
+                self._reap()
 
-        In Python 2.6, raise a NotImplementedError.
+    def __repr__(self):
+        return '{0}(max_memory={1!r}, directory={2!r})'.format(
+            self.__class__.__name__, self._max_memory, self._directory)
+
+    def _check(self):
+        with self._lock:
+            for run in self._runs:
+                records = list(run.records())
+                assert run.count == len(records)
+                assert all(one[0] < two[0]
+                           for one, two in zip(records, records[1:]))
+                assert all(record[0] in run._bloom for record in records)
+            assert not set(self._buffer) & self._deleted
+            self._buffer._check()
+            assert self._len == sum(1 for record in self._records())
+            in_runs = self._len - len(self._buffer)
+            values = sum(run.values for run in self._runs)
+            assert len(self._replaced) == values - in_runs
+
+_FRAME = struct.Struct('>I')
+
+def _frame(payload):
+    """Return *payload* marshalled and prefixed by its length."""
+    data = marshal.dumps(payload, 2)
+    return _FRAME.pack(len(data)) + data
+
+def _read_frame(reader):
+    """
+    Return the next payload from the buffered file *reader*, or raise
+    EOFError if the connection closed.
+    """
+    header = reader.read(_FRAME.size)
+    if len(header) < _FRAME.size:
+        raise EOFError('connection closed')
+    size = _FRAME.unpack(header)[0]
+    data = reader.read(size)
+    if len(data) < size:
+        raise EOFError('connection closed')
+    return marshal.loads(data)
+
+def _make_socket(address):
+    """Return a socket for *address*, a Unix socket path or a (host, port)."""
+    if isinstance(address, (str, type(u''))):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+def _rank(_dict, key):
+    return len(_dict) - 1 - _dict.index(key)
+
+_COMMANDS = {
+    'get': lambda _dict, key: _dict[key],
+    'delete': lambda _dict, key: _dict.__delitem__(key),
+    'contains': lambda _dict, key: key in _dict,
+    'len': len,
+    'keys': list,
+    'items': lambda _dict: _dict.items(),
+    'most_common': lambda _dict, count=None: _dict.most_common(count),
+    'rank': _rank,
+    'clear': lambda _dict: _dict.clear(),
+    'pop': lambda _dict, key, *default: _dict.pop(key, *default),
+    'popitem': lambda _dict, index=-1: _dict.popitem(index),
+    'setdefault': lambda _dict, key, default=0: _dict.setdefault(key, default),
+}
+
+_ERRORS = dict((error.__name__, error) for error in (
+    KeyError, IndexError, ValueError, TypeError))
+
+class PriorityDictServer(object):
+    """
+    Serve one PriorityDict, *priority_dict* or a new one, to other processes
+    on the host over a Unix socket at path *address* or TCP at ``(host,
+    port)``; port 0 picks a free port, see `address`. Use
+    `PriorityDictClient` to connect.
+
+    Requests and responses are frames of a 4-byte big-endian length and a
+    marshal payload. A request is a list of commands, tuples of a name and
+    arguments, and is answered by a list of ``(ok, result)`` pairs in the
+    same order, where a failed command has ok False and result the error's
+    type name and message. Clients may send further requests before
+    reading responses. Commands are ``('tally', keys_or_mapping)``,
+    ``('set', key, value)``, ``('delete', key)``, ``('get', key)``,
+    ``('contains', key)``, ``('len',)``, ``('keys',)``, ``('items',)``,
+    ``('most_common', count)``, ``('clear',)``, ``('pop', key[,
+    default])``, ``('popitem', index)``, ``('setdefault', key, default)``
+    and ``('rank', key)``, the position of *key* from the highest priority.
+
+    One thread per connection reads requests and a single writer thread
+    executes them, so the dictionary needs no lock but must not be used by
+    the serving process while served. The writer takes every request queued
+    since it last ran and coalesces runs of tally and set commands, from all
+    connections, into one `update` and one `tally` applied before the next
+    other command and before any response is sent. If the `update` or the
+    `tally` fails, only the commands coalesced into it fail, and as
+    PriorityDict restores itself when a change is rejected, none of their
+    items are applied.
+
+    Keys and values must be marshallable and orderable. marshal is not
+    secure against malicious data, so only serve trusted local clients.
+    """
+    def __init__(self, address, priority_dict=None, backlog=16):
+        self.priority_dict = (PriorityDict() if priority_dict is None
+                              else priority_dict)
+        self._socket = _make_socket(address)
+        self._socket.bind(address)
+        self._socket.listen(backlog)
+        self._socket.settimeout(0.2)
+        self.address = self._socket.getsockname()
+        self._unix = self._socket.family == getattr(socket, 'AF_UNIX', None)
+        self._requests = queue.Queue()
+        self._connections = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._serving = None
+        self._writer = threading.Thread(target=self._write)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def serve_forever(self):
+        """Accept connections until *close* is called."""
+        while not self._closed:
+            try:
+                conn = self._socket.accept()[0]
+            except socket.timeout:
+                continue
+            except socket.error:
+                if self._closed:
+                    break
+                raise
+            conn.settimeout(None)
+            with self._lock:
+                self._connections.add(conn)
+            reader = threading.Thread(target=self._read, args=(conn,))
+            reader.daemon = True
+            reader.start()
+
+    def start(self):
+        """Serve in a background thread and return the server."""
+        self._serving = threading.Thread(target=self.serve_forever)
+        self._serving.daemon = True
+        self._serving.start()
+        return self
+
+    def close(self):
+        """Stop serving, close all connections and remove the Unix socket."""
+        self._closed = True
+        if self._serving is not None:
+            self._serving.join()
+        self._socket.close()
+        self._requests.put(None)
+        self._writer.join()
+        with self._lock:
+            for conn in self._connections:
+                try:
+                    # Wakes the reader blocked on the connection.
+                    conn.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                conn.close()
+            self._connections.clear()
+        if self._unix:
+            try:
+                os.remove(self.address)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _read(self, conn):
+        reader = conn.makefile('rb')
+        try:
+            while True:
+                self._requests.put((conn, _read_frame(reader)))
+        except (EOFError, ValueError, TypeError, socket.error):
+            pass
+        finally:
+            reader.close()
+            with self._lock:
+                self._connections.discard(conn)
+            conn.close()
+
+    def _write(self):
+        _requests = self._requests
+        while True:
+            batch = [_requests.get()]
+            while True:
+                try:
+                    batch.append(_requests.get_nowait())
+                except queue.Empty:
+                    break
+            done = None in batch
+            responses = self._execute([req for req in batch if req is not None])
+            for conn, results in responses:
+                try:
+                    frame = _frame(results)
+                except ValueError as error:
+                    failure = (False, ('ValueError', str(error)))
+                    frame = _frame([failure] * len(results))
+                try:
+                    conn.sendall(frame)
+                except socket.error:
+                    pass
+            if done:
+                return
+
+    def _execute(self, requests):
         """
-        if hexversion < 0x03000000:
-            return self._dict.viewkeys()
-        else:
-            return self._dict.keys()
+        Execute *requests*, pairs of a connection and a list of commands, and
+        return pairs of the connection and the list of results.
+        """
+        _dict = self.priority_dict
+        sets, tallies = {}, Counter()
+        pending = {'set': [], 'tally': []}
 
-    def values(self):
+        def flush():
+            # Sets are applied before tallies, which is the order of the
+            # commands as a set drops the pending tally of its key. Each
+            # group succeeds or fails on its own.
+            for name, items, method in (('set', sets, _dict.update),
+                                        ('tally', tallies, _dict.tally)):
+                try:
+                    if items:
+                        method(items)
+                except Exception as error:
+                    failure = (False, (type(error).__name__, str(error)))
+                    for results, pos in pending[name]:
+                        results[pos] = failure
+                items.clear()
+                del pending[name][:]
+
+        responses = []
+        for conn, commands in requests:
+            results = []
+            for command in commands:
+                try:
+                    name, args = command[0], command[1:]
+                    if name == 'set':
+                        key, value = args
+                        tallies.pop(key, None)
+                        sets[key] = value
+                        pending[name].append((results, len(results)))
+                        result = None
+                    elif name == 'tally':
+                        counts = args[0]
+                        if not isinstance(counts, Mapping):
+                            counts = Counter(counts)
+                        tallies.update(counts)
+                        pending[name].append((results, len(results)))
+                        result = None
+                    else:
+                        flush()
+                        result = _COMMANDS[name](_dict, *args)
+                    results.append((True, result))
+                except Exception as error:
+                    results.append((False, (type(error).__name__, str(error))))
+            responses.append((conn, results))
+        flush()
+        return responses
+
+class _Pipeline(object):
+    """
+    Commands queued on a `PriorityDictClient` and sent together by
+    *execute*. See `PriorityDictClient.pipeline`.
+    """
+    def __init__(self, client, batch_size):
+        self._client = client
+        self._batch_size = batch_size
+        self._commands = []
+
+    def tally(self, *args, **kwargs):
+        self._commands.append(('tally', dict(Counter(*args, **kwargs))))
+        return self
+
+    def set(self, key, value):
+        self._commands.append(('set', key, value))
+        return self
+
+    def delete(self, key):
+        self._commands.append(('delete', key))
+        return self
+
+    def get(self, key):
+        self._commands.append(('get', key))
+        return self
+
+    def most_common(self, count=None):
+        self._commands.append(('most_common', count))
+        return self
+
+    def rank(self, key):
+        self._commands.append(('rank', key))
+        return self
+
+    def execute(self):
         """
-        Return a list of the dictionary's values. Values are
-        ordered from least to greatest.
+        Send the queued commands in requests of up to *batch_size* commands,
+        all before reading any response, and return their results in order.
+        Raises the error of the first failed command after every response
+        has been read.
         """
-        return list(tup[1] for tup in self._list)
+        commands, self._commands = self._commands, []
+        size = self._batch_size
+        batches = [commands[pos:pos + size]
+                   for pos in range(0, len(commands), size)]
+        return self._client._request(batches)
 
-    def itervalues(self):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.results = self.execute()
+
+class PriorityDictClient(MutableMapping):
+    """
+    A MutableMapping of the PriorityDict served by a `PriorityDictServer` at
+    *address*. Iteration and *items* are in value sorted order as of the
+    request. *tally*, *most_common* and *rank* are as for the server
+    commands, and *update* sends all its items in one request. *pop*,
+    *popitem* and *setdefault* are each one server command, so are atomic;
+    other mapping methods may take several requests. Use
+    *pipeline* to send many commands with one round trip. Errors raised by
+    the server are raised again as KeyError, IndexError, ValueError or
+    TypeError, or RuntimeError for other types. Clients may be shared
+    between threads.
+    """
+    def __init__(self, address, timeout=None):
+        self._socket = _make_socket(address)
+        self._socket.settimeout(timeout)
+        self._socket.connect(address)
+        self._reader = self._socket.makefile('rb')
+        self._lock = threading.Lock()
+
+    def _request(self, batches):
+        frames = [_frame(commands) for commands in batches]
+        with self._lock:
+            for frame in frames:
+                self._socket.sendall(frame)
+            responses = [_read_frame(self._reader) for commands in batches]
+        results, error = [], None
+        for response in responses:
+            for ok, result in response:
+                if ok:
+                    results.append(result)
+                else:
+                    name, message = result
+                    results.append(None)
+                    if error is None:
+                        error = _ERRORS.get(name, RuntimeError)(message)
+        if error is not None:
+            raise error
+        return results
+
+    def _call(self, *command):
+        return self._request([[command]])[0]
+
+    def pipeline(self, batch_size=1000):
         """
-        Return an iterable over the values of the dictionary. Values are
-        iterated from least to greatest.
+        Return a pipeline queueing *tally*, *set*, *delete*, *get*,
+        *most_common* and *rank* commands until *execute* is called, or the
+        pipeline is left as a context manager, which stores the results in
+        its `results` attribute.
         """
-        return iter(tup[1] for tup in self._list)
+        return _Pipeline(self, batch_size)
 
-    @not26
-    def viewvalues(self):
+    def __getitem__(self, key):
+        return self._call('get', key)
+
+    def __setitem__(self, key, value):
+        self._call('set', key, value)
+
+    def __delitem__(self, key):
+        self._call('delete', key)
+
+    def __contains__(self, key):
+        return self._call('contains', key)
+
+    def __len__(self):
+        return self._call('len')
+
+    def __iter__(self):
+        return iter(self._call('keys'))
+
+    def items(self):
+        """Return a list of the items in value sorted order."""
+        return self._call('items')
+
+    def clear(self):
+        """Remove every key."""
+        self._call('clear')
+
+    def pop(self, key, default=_NotGiven):
         """
-        In Python 2.7 and later, return a `ValuesView` of the dictionary's
-        values. Beware iterating the `ValuesView` as values are unordered.
+        Remove *key* and return its value, else return *default* or raise
+        KeyError if it is not given.
+        """
+        if default is _NotGiven:
+            return self._call('pop', key)
+        return self._call('pop', key, default)
 
-        In Python 2.6, raise a NotImplementedError.
+    def popitem(self, index=-1):
         """
-        if hexversion < 0x03000000:
-            return self._dict.viewvalues()
-        else:
-            return self._dict.values()
+        Remove and return the item at *index* (default: -1) in value sorted
+        order. Raises IndexError if the dictionary is empty.
+        """
+        return tuple(self._call('popitem', index))
 
-    def __repr__(self):
-        """Return a string representation of PriorityDict."""
-        template = '{0}({{{1}}})'
-        items = ', '.join('{0}: {1}'.format(repr(key), repr(value))
-                          for key, value in self._list)
-        return template.format(
-            self.__class__.__name__,
-            items
-        )
+    def setdefault(self, key, default=0):
+        """Return the value of *key*, setting it to *default* if absent."""
+        return self._call('setdefault', key, default)
 
-    def _check(self):
-        self._list._check()
-        assert len(self._dict) == len(self._list)
-        assert all(key in self._dict and self._dict[key] == value
-                   for key, value in self._list)
+    def update(self, *args, **kwargs):
+        """Set the items of a mapping or iterable of pairs in one request."""
+        items = dict(*args, **kwargs)
+        self._request([[('set', key, value)
+                        for key, value in iteritems(items)]])
+
+    def tally(self, *args, **kwargs):
+        """Add counts as for `PriorityDict.tally`."""
+        self._call('tally', dict(Counter(*args, **kwargs)))
+
+    def most_common(self, count=None):
+        """Return the `count` items of highest priority, or all of them."""
+        return self._call('most_common', count)
+
+    def rank(self, key):
+        """Return the position of *key* from the highest priority."""
+        return self._call('rank', key)
+
+    def close(self):
+        """Close the connection."""
+        self._reader.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
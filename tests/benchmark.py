@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark PriorityDict and IntPriorityDict against a collections.Counter and
+heapq baseline.
+
+Every benchmark is run for every implementation at every size. Results are
+written as JSON lines, one record per benchmark, implementation and size, so
+that runs on different commits can be compared. With ``--memory`` each record
+also holds the bytes still allocated after the run, which for ``construct`` is
+the size of the structure built (Python 3 only)::
+
+    python -m tests.benchmark --sizes 1000,100000 --output head.jsonl
+    python -m tests.benchmark --bench construct --memory
+    python -m tests.benchmark --compare base.jsonl head.jsonl
+
+"""
+
+from __future__ import print_function
+
+import argparse, heapq, json, operator, platform, subprocess, sys
+
+from bisect import bisect_left
+from collections import Counter
+from itertools import islice
+from operator import itemgetter
+from random import Random
+from timeit import default_timer as timer
+
+import sortedcontainers
+from prioritydict import PriorityDict, IntPriorityDict
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+if sys.hexversion < 0x03000000:
+    range = xrange
+
+SIZES = (1000, 10000, 100000)
+TALLY_BATCHES = (10, 1000, 100000)
+QUERIES = 100
+
+class Data(object):
+    """Keys and values shared by all benchmarks of one size."""
+    def __init__(self, size, seed=0):
+        random = Random(seed)
+        self.size = size
+        self.keys = list(range(size))
+        self.values = [random.randrange(size) for key in self.keys]
+        self.ties = [random.randrange(10) for key in self.keys]
+        self.items = list(zip(self.keys, self.values))
+        self.tied = list(zip(self.keys, self.ties))
+        self.updates = [(random.randrange(size), random.randrange(size))
+                        for pos in range(min(size, 100000))]
+        self.tied_updates = [(key, random.randrange(10))
+                             for key, value in self.updates]
+        self.batches = dict(
+            (batch, [random.randrange(size) for pos in range(batch)])
+            for batch in TALLY_BATCHES
+        )
+        self.queries = [random.randrange(size) for pos in range(QUERIES)]
+        self.other = dict((key, random.randrange(size))
+                          for key in random.sample(self.keys, size // 2))
+
+class PriorityDictImpl(object):
+    name = 'PriorityDict'
+
+    @staticmethod
+    def construct(items):
+        return PriorityDict(items)
+
+    @staticmethod
+    def setitems(obj, items):
+        for key, value in items:
+            obj[key] = value
+
+    @staticmethod
+    def tally(obj, keys):
+        obj.tally(keys)
+
+    @staticmethod
+    def most_common(obj, count):
+        return obj.most_common(count)
+
+    @staticmethod
+    def clean(obj, value):
+        obj.clean(value)
+
+    @staticmethod
+    def iloc(obj, start, stop):
+        return obj.iloc[start:stop]
+
+    @staticmethod
+    def bisect(obj, values):
+        return [obj.bisect(value) for value in values]
+
+class IntPriorityDictImpl(PriorityDictImpl):
+    name = 'IntPriorityDict'
+
+    @staticmethod
+    def construct(items):
+        return IntPriorityDict(items)
+
+class CounterImpl(object):
+    name = 'Counter+heapq'
+
+    @staticmethod
+    def construct(items):
+        return Counter(dict(items))
+
+    @staticmethod
+    def setitems(obj, items):
+        for key, value in items:
+            obj[key] = value
+
+    @staticmethod
+    def tally(obj, keys):
+        obj.update(keys)
+
+    @staticmethod
+    def most_common(obj, count):
+        return heapq.nlargest(count, obj.items(), key=itemgetter(1))
+
+    @staticmethod
+    def clean(obj, value):
+        for key in [key for key, val in obj.items() if val <= value]:
+            del obj[key]
+
+    @staticmethod
+    def iloc(obj, start, stop):
+        items = heapq.nsmallest(stop, obj.items(), key=itemgetter(1))
+        return [key for key, value in islice(items, start, None)]
+
+    @staticmethod
+    def bisect(obj, values):
+        ordered = sorted(obj.values())
+        return [bisect_left(ordered, value) for value in values]
+
+IMPLS = (PriorityDictImpl, IntPriorityDictImpl, CounterImpl)
+
+BENCHMARKS = []
+
+def benchmark(func):
+    """
+    Register a benchmark. The benchmark is called with an implementation and
+    a `Data` object and returns a pair of *setup* and *run* functions. Only
+    ``run(setup())`` is timed.
+    """
+    BENCHMARKS.append((func.__name__, func))
+    return func
+
+@benchmark
+def construct(impl, data):
+    return (lambda: data.items), impl.construct
+
+@benchmark
+def setitem(impl, data):
+    return (lambda: impl.construct(data.items)), (
+        lambda obj: impl.setitems(obj, data.updates))
+
+@benchmark
+def setitem_ties(impl, data):
+    return (lambda: impl.construct(data.tied)), (
+        lambda obj: impl.setitems(obj, data.tied_updates))
+
+def tally_batch(batch):
+    def tally(impl, data):
+        keys = data.batches[batch]
+        return (lambda: impl.construct(data.tied)), (
+            lambda obj: impl.tally(obj, keys))
+    tally.__name__ = 'tally_{0}'.format(batch)
+    return tally
+
+for batch in TALLY_BATCHES:
+    benchmark(tally_batch(batch))
+
+@benchmark
+def most_common_10(impl, data):
+    obj = impl.construct(data.items)
+    return (lambda: obj), (lambda obj: impl.most_common(obj, 10))
+
+@benchmark
+def most_common_1000(impl, data):
+    obj = impl.construct(data.items)
+    return (lambda: obj), (lambda obj: impl.most_common(obj, 1000))
+
+@benchmark
+def clean(impl, data):
+    return (lambda: impl.construct(data.tied)), (
+        lambda obj: impl.clean(obj, 4))
+
+@benchmark
+def iloc_slice(impl, data):
+    obj = impl.construct(data.items)
+    start = data.size // 2
+    return (lambda: obj), (lambda obj: impl.iloc(obj, start, start + 100))
+
+@benchmark
+def bisect(impl, data):
+    obj = impl.construct(data.items)
+    return (lambda: obj), (lambda obj: impl.bisect(obj, data.queries))
+
+def binary(name):
+    func = getattr(operator, name)
+    def bench(impl, data):
+        this = impl.construct(data.items)
+        that = impl.construct(iter(data.other.items()))
+        if name.startswith('i'):
+            return (lambda: impl.construct(data.items)), (
+                lambda obj: func(obj, that))
+        else:
+            return (lambda: this), (lambda obj: func(obj, that))
+    bench.__name__ = name
+    return bench
+
+for name in ('add', 'sub', 'or_', 'and_', 'iadd', 'isub', 'ior', 'iand'):
+    benchmark(binary(name))
+
+def measure(setup, run, repeat):
+    """Return the sorted times of *repeat* runs of ``run(setup())``."""
+    times = []
+    for rpt in range(repeat):
+        state = setup()
+        start = timer()
+        run(state)
+        times.append(timer() - start)
+    return sorted(times)
+
+def measure_memory(setup, run):
+    """Return the bytes allocated by ``run(setup())`` and still held after."""
+    state = setup()
+    tracemalloc.start()
+    try:
+        result = run(state)  # Held so that its memory is counted.
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+def environment():
+    """Return a dict describing the commit and interpreter benchmarked."""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'sortedcontainers': sortedcontainers.__version__,
+    }
+
+def run(sizes=SIZES, names=None, impls=IMPLS, repeat=3, output=None,
+        memory=False):
+    """
+    Run the benchmarks named in *names* (default all) for *impls* at every
+    size in *sizes*. Write one JSON record per result to the file object
+    *output*, if given, and return the records. If *memory* is True, also
+    record the memory held by one more run.
+    """
+    env, records = environment(), []
+    for size in sizes:
+        data = Data(size)
+        for name, func in BENCHMARKS:
+            if names and name not in names:
+                continue
+            for impl in impls:
+                setup, body = func(impl, data)
+                times = measure(setup, body, repeat)
+                record = dict(env, benchmark=name, impl=impl.name, size=size,
+                              repeat=repeat, best=times[0],
+                              median=times[len(times) // 2])
+                if memory:
+                    record['memory'] = measure_memory(setup, body)
+                records.append(record)
+                if output is not None:
+                    output.write(json.dumps(record, sort_keys=True) + '\n')
+                    output.flush()
+    return records
+
+def load(path):
+    with open(path) as reader:
+        return [json.loads(line) for line in reader if line.strip()]
+
+def compare(base, head, output=sys.stdout):
+    """
+    Print the ratio of *head* to *base* best times for every benchmark,
+    implementation and size present in both. Ratios above 1 are slower.
+    """
+    def index(records):
+        return dict(((rec['benchmark'], rec['impl'], rec['size']), rec)
+                    for rec in records)
+    base, head = index(base), index(head)
+    template = '{0:<16} {1:<14} {2:>9} {3:>12.6f} {4:>12.6f} {5:>7.2f}'
+    print('{0:<16} {1:<14} {2:>9} {3:>12} {4:>12} {5:>7}'.format(
+        'benchmark', 'impl', 'size', 'base', 'head', 'ratio'), file=output)
+    for key in sorted(set(base) & set(head)):
+        before, after = base[key]['best'], head[key]['best']
+        ratio = after / before if before else float('inf')
+        print(template.format(key[0], key[1], key[2], before, after, ratio),
+              file=output)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='comma separated sizes, e.g. 1000,10000000')
+    parser.add_argument('--bench', action='append', dest='names',
+                        help='benchmark to run; repeat for several')
+    parser.add_argument('--no-baseline', action='store_true',
+                        help='skip the Counter and heapq baseline')
+    parser.add_argument('--memory', action='store_true',
+                        help='record memory held after each run (Python 3)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='file to write JSON lines to')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'HEAD'),
+                        help='compare two result files and exit')
+    parser.add_argument('--list', action='store_true',
+                        help='list benchmark names and exit')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, func in BENCHMARKS:
+            print(name)
+        return
+    if args.compare:
+        compare(load(args.compare[0]), load(args.compare[1]))
+        return
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    if args.memory and tracemalloc is None:
+        parser.error('--memory requires tracemalloc (Python 3)')
+    impls = tuple(impl for impl in IMPLS
+                  if not (args.no_baseline and impl is CounterImpl))
+    if args.output:
+        with open(args.output, 'w') as output:
+            run(sizes, args.names, impls, args.repeat, output, args.memory)
+    else:
+        run(sizes, args.names, impls, args.repeat, sys.stdout, args.memory)
+
+if __name__ == '__main__':
+    main()
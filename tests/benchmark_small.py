@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the memory and time taken by many small PriorityDicts.
+
+For each number of items per dictionary, build *count* dictionaries with the
+flat small list and with the full SortedListWithKey (``small_size = 0``) and
+report the bytes held per dictionary and the seconds taken to build them all.
+Memory is measured with tracemalloc, so run under Python 3::
+
+    python -m tests.benchmark_small [count [items ...]]
+
+"""
+
+from __future__ import print_function
+
+import gc, sys, tracemalloc
+from timeit import default_timer as timer
+from prioritydict import PriorityDict
+
+ITEMS = (0, 5, 20, 100)
+
+def measure(count, items, small_size):
+    """Return the bytes per dictionary and the seconds to build *count*."""
+    PriorityDict.small_size = small_size
+    pairs = [(key, key % 7) for key in range(items)]
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = timer()
+        dicts = [PriorityDict(pairs) for num in range(count)]
+        elapsed = timer() - start
+        held = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return float(held) / count, elapsed
+
+def main(count, sizes):
+    default = PriorityDict.small_size
+    template = '{0:>9} {1:>6} {2:>12.0f} {3:>12.0f} {4:>10.3f} {5:>10.3f}'
+    print('{0:>9} {1:>6} {2:>12} {3:>12} {4:>10} {5:>10}'.format(
+        'count', 'items', 'small bytes', 'full bytes', 'small s', 'full s'))
+    try:
+        for items in sizes:
+            small = measure(count, items, default)
+            full = measure(count, items, 0)
+            print(template.format(count, items, small[0], full[0],
+                                  small[1], full[1]))
+            sys.stdout.flush()
+    finally:
+        PriorityDict.small_size = default
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(args[0] if args else 1000000, args[1:] or ITEMS)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the strategies PriorityDict uses to apply bulk changes.
+
+For each dict size and fraction of keys changed, time `+=` with each strategy
+forced and report the fastest next to the strategy chosen by the default and
+a freshly calibrated `CostModel`. Run as::
+
+    python -m tests.benchmark_strategy [size ...]
+
+"""
+
+from __future__ import print_function
+
+import sys
+from random import Random
+from timeit import default_timer as timer
+from prioritydict import PriorityDict, CostModel, INCREMENTAL, MERGE, REBUILD
+
+STRATEGIES = (INCREMENTAL, MERGE, REBUILD)
+FRACTIONS = (0.0001, 0.001, 0.01, 0.03, 0.1, 0.3, 1.0)
+
+def measure(size, count, strategy, repeat=3):
+    """Return the fastest time of *repeat* runs of `+=` with *strategy*."""
+    random = Random(size)
+    values = [random.random() for key in range(size)]
+    that = dict((key, 1) for key in random.sample(range(size), count))
+    best = None
+    for run in range(repeat):
+        temp = PriorityDict(zip(range(size), values))
+        temp.cost_model = CostModel(adaptive=False, strategy=strategy)
+        start = timer()
+        temp += that
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(sizes):
+    default = CostModel(adaptive=False)
+    template = ('{0:>9} {1:>9} {2:>11.6f} {3:>11.6f} {4:>11.6f} '
+                '{5:>12} {6:>12} {7:>12}')
+    header = ('{0:>9} {1:>9} {2:>11} {3:>11} {4:>11} '
+              '{5:>12} {6:>12} {7:>12}')
+    print(header.format('size', 'count', INCREMENTAL, MERGE, REBUILD,
+                        'fastest', 'default', 'calibrated'))
+    for size in sizes:
+        calibrated = CostModel.calibrate(min(size, 100000))
+        calibrated.adaptive = False
+        for fraction in FRACTIONS:
+            count = max(int(size * fraction), 1)
+            times = [measure(size, count, strategy) for strategy in STRATEGIES]
+            fastest = STRATEGIES[times.index(min(times))]
+            print(template.format(
+                size, count, times[0], times[1], times[2], fastest,
+                default.choose(size, count), calibrated.choose(size, count)))
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000])
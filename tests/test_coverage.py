@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 
-import random, string
-from prioritydict import PriorityDict
+import io, os, random, shutil, string, tempfile, threading
+from prioritydict import PriorityDict, IntPriorityDict, SpillingPriorityDict
+from prioritydict import WindowedPriorityDict, PriorityCache, priority_cache
+from prioritydict import MultiPriorityDict, PriorityDictServer, PriorityDictClient
+from prioritydict import CostModel, PriorityDictSnapshot
+from sortedcontainers import SortedListWithKey
+from operator import itemgetter
+from nose import SkipTest
 from nose.tools import raises
-from sys import hexversion
-from collections import Counter
+from sys import getsizeof, hexversion
+from collections import Counter, OrderedDict
 from random import randrange as rand
 
 if hexversion < 0x03000000:
@@ -423,3 +429,1073 @@ def test_values():
 
 def test_repr():
     pass
+
+def test_stats():
+    temp = PriorityDict((val, val % 10) for val in range(100))
+    assert temp.stats() is None
+    events = []
+    temp.enable_stats(lambda name, elapsed, size: events.append(name))
+    temp[5] = 50
+    temp[200] = 3
+    del temp[0]
+    temp.popitem()
+    temp.update((val, -val) for val in range(50))
+    temp._check()
+    stats = temp.stats(reset=True)
+    assert stats['counts']['add'] == 2
+    assert stats['counts']['remove'] == 2
+    assert stats['counts']['pop'] == 1
+    assert stats['counts']['rebuild'] == 1
+    assert stats['rebuilt'] == 101
+    assert stats['ties'] == {16: 2}
+    assert sum(stats['latency']['add'].values()) == 2
+    assert events == ['remove', 'add', 'add', 'remove', 'pop',
+                      'clear', 'rebuild']
+    assert temp.stats()['counts'] == {}
+    temp.disable_stats()
+    assert temp.stats() is None
+    temp._check()
+
+def test_update_small_new_keys():
+    temp = PriorityDict((val, val) for val in range(100))
+    temp.update({200: -1, 201: 500})
+    assert temp.iloc[0] == 200 and temp.iloc[-1] == 201
+    temp._check()
+
+def test_cost_model():
+    model = CostModel()
+    assert model.choose(1000000, 10) == 'incremental'
+    assert model.choose(1000000, 300000) == 'merge'
+    assert model.choose(1000, 100000) == 'rebuild'
+    costs = model.costs(1000, 10)
+    assert sorted(costs) == ['incremental', 'merge', 'rebuild']
+    rate = model.rates['merge']
+    model.observe('merge', 1000, 100, 1.0)
+    assert rate < model.rates['merge'] <= rate * 2
+    model.observe('merge', 1000, 10, 1.0)
+    model.adaptive = False
+    model.observe('merge', 1000, 100, 1.0)
+
+def test_cost_model_strategies():
+    for strategy in ('incremental', 'merge', 'rebuild'):
+        temp_vals = list((val, rand(100)) for val in range(100))
+        that_vals = list((val, rand(100)) for val in range(50, 150))
+        temp = PriorityDict(temp_vals)
+        temp.cost_model = CostModel(strategy=strategy)
+        temp.enable_stats()
+        temp += dict(that_vals)
+        temp -= dict(that_vals[:20])
+        temp |= dict(that_vals)
+        temp &= dict(temp_vals)
+        temp.update(dict(temp_vals[:10]))
+        temp._check()
+        assert temp.stats()['strategies'] == {strategy: 5}
+        that = PriorityDict(temp_vals)
+        that += dict(that_vals)
+        that -= dict(that_vals[:20])
+        that |= dict(that_vals)
+        that &= dict(temp_vals)
+        that.update(dict(temp_vals[:10]))
+        assert temp == that
+
+def test_cost_model_calibrate():
+    rates = dict(PriorityDict.cost_model.rates)
+    model = CostModel.calibrate(1000, repeat=1)
+    assert all(rate > 0 for rate in model.rates.values())
+    model = CostModel.calibrate(10, repeat=1)
+    assert all(rate >= 0 for rate in model.rates.values())
+    assert PriorityDict.cost_model.rates == rates
+
+@raises(ValueError)
+def test_cost_model_calibrate_empty():
+    CostModel.calibrate(0)
+
+def test_most_common_count():
+    temp = PriorityDict({'a': 1, 'b': 2, 'c': 3, 'd': 4})
+    assert temp.most_common(0) == []
+    assert temp.most_common(-1) == []
+    assert temp.most_common(10) == temp.most_common()
+
+def test_iter_most_common():
+    temp = PriorityDict((val, -val) for val in range(100))
+    iterator = temp.iter_most_common()
+    assert next(iterator) == (0, 0)
+    assert next(iterator) == (1, -1)
+    assert list(temp.iter_most_common()) == temp.most_common()
+
+def test_iter_least_common():
+    temp = PriorityDict((val, -val) for val in range(100))
+    iterator = temp.iter_least_common()
+    assert next(iterator) == (99, -99)
+    assert list(temp.iter_least_common()) == temp.items()
+
+def test_copy_blocks():
+    temp = PriorityDict()
+    temp._list = SortedListWithKey(key=itemgetter(1), load=4)
+    temp.update((val, rand(100)) for val in range(100))
+    that = temp.copy()
+    that._check()
+    assert that.items() == temp.items()
+    for val in range(50):
+        temp[val] = -val
+    assert that.items() != temp.items()
+    temp._check()
+    that._check()
+
+def test_snapshot():
+    temp = PriorityDict()
+    temp._list = SortedListWithKey(key=itemgetter(1), load=4)
+    temp.update((val, rand(100)) for val in range(100))
+    items = temp.items()
+    snap = temp.snapshot()
+    for rpt in range(500):
+        key = rand(150)
+        if rand(3) == 0 and key in temp:
+            del temp[key]
+        else:
+            temp[key] = rand(100)
+        if rpt == 250:
+            other = temp.snapshot()
+            other_items = temp.items()
+    temp.update((val, rand(100)) for val in range(20))
+    temp.clean(50)
+    temp._check()
+    snap._check()
+    other._check()
+    assert snap.items() == items
+    assert other.items() == other_items
+    assert len(snap) == len(items)
+    key, value = items[0]
+    assert snap[key] == value
+    assert snap.iloc[0] == key
+    assert snap.copy() == snap
+    assert snap.most_common(1) == [items[-1]]
+
+@raises(TypeError)
+def test_snapshot_setitem():
+    temp = PriorityDict({'a': 1})
+    temp.snapshot()['a'] = 2
+
+@raises(TypeError)
+def test_snapshot_iloc_delitem():
+    temp = PriorityDict({'a': 1})
+    del temp.snapshot().iloc[0]
+
+@raises(TypeError)
+def test_snapshot_iadd():
+    snap = PriorityDict({'a': 1}).snapshot()
+    snap += {'a': 1}
+
+def test_value_index():
+    temp = PriorityDict((val, val % 10) for val in range(100))
+    assert temp.count_with_value(3) == 10
+    assert temp.distinct_values() == 10
+    temp.enable_value_index()
+    temp.enable_value_index()
+    assert temp.count_with_value(3) == 10
+    assert temp.count_with_value(30) == 0
+    temp[3] = 30
+    temp.tally([13, 13])
+    temp -= {23: 1}
+    temp.clean(1)
+    del temp.iloc[0]
+    del temp.iloc[:5]
+    temp.popitem()
+    temp._check()
+    assert temp.count_with_value(3) == 7
+    assert temp.count_with_value(5) == 11
+    assert temp.distinct_values() == 8
+    groups = list(temp.iter_value_groups())
+    assert groups[0] == (2, [52, 62, 72, 82, 92])
+    assert [value for value, keys in groups] == [2, 3, 4, 5, 6, 7, 8, 9]
+    assert list(temp.iter_value_groups(reverse=True)) == [
+        (value, keys[::-1]) for value, keys in reversed(groups)]
+    temp.disable_value_index()
+    assert list(temp.iter_value_groups()) == groups
+    assert temp.count_with_value(5) == 11
+    assert temp.distinct_values() == 8
+    temp.clear()
+    temp._check()
+
+def test_key_index():
+    temp = PriorityDict((val, -val) for val in range(100))
+    assert list(temp.irange_keys(10, 14)) == [10, 11, 12, 13, 14]
+    assert temp.bisect_key(50) == 50
+    temp.enable_key_index()
+    temp.enable_key_index()
+    assert temp.key_iloc[0] == 0
+    assert temp.key_iloc[-1] == 99
+    assert temp.key_iloc[10:13] == [10, 11, 12]
+    temp[150] = 5
+    temp.tally([7, 150])
+    temp.update({200: 0, 3: 3})
+    temp -= {4: 1}
+    temp.clean(-95)
+    del temp.iloc[0]
+    del temp.key_iloc[:2]
+    del temp.key_iloc[-1]
+    temp.popitem()
+    temp._check()
+    assert temp.key_iloc[:3] == [2, 3, 4]
+    assert temp.key_iloc[-1] == 93
+    assert temp.bisect_key_left(90) == 88
+    assert temp.bisect_key_right(90) == 89
+    assert temp.bisect_key(150) == len(temp)
+    assert list(temp.irange_keys(90, 93)) == [90, 91, 92, 93]
+    assert list(temp.irange_keys(90, 93, (False, False))) == [91, 92]
+    assert list(temp.irange_keys(91, reverse=True)) == [93, 92, 91]
+    assert list(temp.irange_keys(maximum=3)) == [2, 3]
+    keys = list(temp.irange_keys())
+    temp.disable_key_index()
+    assert list(temp.irange_keys()) == keys
+    assert temp.key_iloc[:] == keys
+    assert temp.bisect_key_right(90) == 89
+    temp.clear()
+    temp._check()
+
+def test_int_priority_dict():
+    temp = IntPriorityDict((val, val % 7) for val in range(100))
+    same = PriorityDict((val, val % 7) for val in range(100))
+    assert temp == same
+    assert temp.items() == same.items()
+    temp[500] = 3
+    same[500] = 3
+    temp.tally([1, 2, 2])
+    same.tally([1, 2, 2])
+    del temp[50]
+    del same[50]
+    temp._check()
+    assert temp.items() == same.items()
+    assert temp.iloc[:5] == same.iloc[:5]
+    assert temp.bisect_left(3) == same.bisect_left(3)
+    assert temp.bisect_right(3) == same.bisect_right(3)
+    assert temp.bisect_left(2.5) == temp.bisect_right(2.5) == same.bisect(3)
+    assert temp.most_common(3) == same.most_common(3)
+    assert temp.index(500) == same.index(500)
+    assert 'a' not in temp and -1 not in temp and 501 not in temp
+    assert temp.get(1000) is None
+    assert sorted(temp.viewkeys() if hexversion < 0x03000000
+                  else temp.keys()) == sorted(same)
+    for result in (temp + same, temp - same, temp | same, temp & same,
+                   temp.copy(), IntPriorityDict.count([1, 1])):
+        assert isinstance(result, IntPriorityDict)
+        result._check()
+    assert (temp + same) == (same + same)
+    temp -= {1: 5}
+    same -= {1: 5}
+    temp.clean(2)
+    same.clean(2)
+    temp._check()
+    assert temp.items() == same.items()
+    temp.clear()
+    temp._check()
+    assert len(temp) == 0
+
+@raises(TypeError)
+def test_int_priority_dict_key():
+    temp = IntPriorityDict({0: 1})
+    try:
+        temp[-1] = 1
+    finally:
+        temp._check()
+        assert len(temp) == 1
+
+@raises(TypeError)
+def test_int_priority_dict_value():
+    temp = IntPriorityDict({0: 1})
+    try:
+        temp[0] = 0.5
+    finally:
+        temp._check()
+        assert temp[0] == 1
+
+def test_int_priority_dict_update_atomic():
+    temp = IntPriorityDict((val, val % 7) for val in range(100))
+    for items in ([(200, 1), (-1, 3)], [(5, 2), (6, 0.5)]):
+        try:
+            temp.update(OrderedDict(items))
+        except TypeError:
+            pass
+        else:
+            assert False
+        temp._check()
+        assert len(temp) == 100 and temp[5] == 5
+    temp = IntPriorityDict()
+    try:
+        temp.update([(1, 1), (-5, 2)])
+    except TypeError:
+        pass
+    temp._check()
+    assert len(temp) == 0
+
+def check_rejected(temp, that, operator):
+    items = temp.items()
+    try:
+        operator(temp, that)
+    except TypeError:
+        pass
+    else:
+        assert False
+    temp._check()
+    assert temp.items() == items
+
+def test_inplace_rejected():
+    def iadd(this, that):
+        this += that
+    def ior(this, that):
+        this |= that
+    def isub(this, that):
+        this -= that
+    def iand(this, that):
+        this &= that
+    for operator, pairs in ((iadd, [(0, 1), (1, 0.5)]),
+                            (iadd, [(5, 1), (-1, 1)]),
+                            (ior, [(0, 5), (1, 2.5)]),
+                            (ior, [(5, 1), (-1, 1)]),
+                            (isub, [(0, 1), (1, 0.5)]),
+                            (iand, [(0, 0), (1, 1.5)])):
+        check_rejected(IntPriorityDict({0: 1, 1: 2, 2: 3}),
+                       OrderedDict(pairs), operator)
+    temp = PriorityDict((val, val) for val in range(500))
+    temp['e'] = 'x' if hexversion < 0x03000000 else 1.5
+    keys = (0, 1, 2, 'e')
+    check_rejected(temp, OrderedDict((key, 'y') for key in keys), iadd)
+    if hexversion < 0x03000000:
+        return
+    # Python 3 rejects values which do not compare with the others.
+    for size in (10, 500):
+        for operator in (iadd, ior, lambda this, that: this.update(that)):
+            check_rejected(PriorityDict((val, val) for val in range(size)),
+                           {'b': 'x', 3: 'y'}, operator)
+    temp = PriorityDict((val, val) for val in range(10))
+    try:
+        temp[3] = 'x'
+    except TypeError:
+        pass
+    temp._check()
+    assert temp[3] == 3
+
+def check_spilling(background):
+    temp = SpillingPriorityDict(max_memory=16, max_runs=3,
+                                background=background)
+    same = PriorityDict()
+    with temp:
+        for pos in range(2000):
+            key, value = rand(300), rand(100)
+            kind = rand(10)
+            if kind < 5:
+                temp[key] = value
+                same[key] = value
+            elif kind < 7:
+                keys = [rand(300) for num in range(rand(40))]
+                temp.tally(keys)
+                same.tally(keys)
+            elif key in same:
+                assert key in temp
+                del temp[key]
+                del same[key]
+            else:
+                assert key not in temp
+            assert temp.get(key) == same.get(key)
+            if pos % 25 == 0:
+                assert temp.most_common(10) == same.most_common(10)
+                for value in (-1, 0, 1, 50, 99, 150):
+                    assert temp.bisect(value) == same.bisect(value)
+                    assert temp.bisect_right(value) == same.bisect_right(value)
+            if pos % 250 == 0:
+                temp.wait()
+                temp._check()
+                assert len(temp) == len(same)
+                assert list(temp) == sorted(same)
+        iterator = temp.iteritems()
+        first = next(iterator)
+        temp.compact()
+        assert len(temp._runs) == 1 and not temp._buffer
+        temp._check()
+        assert [first] + list(iterator) == sorted(same.items())
+        assert temp.most_common() == same.most_common()
+        assert dict(temp.items()) == dict(same.items())
+        directory = temp._directory
+        temp.clear()
+        temp._check()
+        assert len(temp) == 0 and list(temp) == []
+    assert not os.path.exists(directory)
+
+def test_spilling():
+    check_spilling(False)
+
+def test_spilling_background():
+    check_spilling(True)
+
+def test_spilling_indexed_queries():
+    with SpillingPriorityDict(max_memory=50, max_runs=100,
+                              background=False) as temp:
+        same = PriorityDict()
+        for pos in range(2000):
+            temp[pos] = same[pos] = pos % 97
+        for pos in range(0, 2000, 3):
+            temp[pos] = same[pos] = -pos
+        for pos in range(1, 2000, 7):
+            del temp[pos]
+            del same[pos]
+        temp._check()
+        def scan():
+            assert False
+        temp._records = scan
+        assert temp.most_common(5) == same.most_common(5)
+        assert temp.bisect(0) == same.bisect(0)
+        assert temp.bisect_right(50) == same.bisect_right(50)
+        assert temp.most_common(0) == []
+
+@raises(KeyError)
+def test_spilling_keyerror():
+    with SpillingPriorityDict(max_memory=2) as temp:
+        temp.tally('abc')
+        temp['d']
+
+def test_windowed():
+    temp = WindowedPriorityDict(10, buckets=5)
+    tallies = []
+    for second in range(100):
+        keys = [rand(20) for num in range(rand(10))]
+        tallies.append((second, keys))
+        temp.tally(keys, second + 0.5)
+        temp._check()
+        total = Counter()
+        for when, keys in tallies:
+            if when // 2 > second // 2 - 5:
+                total.update(keys)
+        assert temp == dict(total)
+    assert len(temp._counts) == 5
+    temp.tally([100, 101], 50)
+    assert 100 not in temp
+    other = temp.copy()
+    temp.expire(1000)
+    assert len(temp) == 0 and len(temp._counts) == 0
+    temp._check()
+    assert len(other) == len(total)
+    other.tally([100, 101], 99)
+    assert other[100] == 1
+    assert type(other + other) is PriorityDict
+    other.tally([100])
+    other.expire()
+    assert other == {100: 1}
+
+def test_subclass_constructors():
+    snap = PriorityDict({'a': 1}).snapshot()
+    window = WindowedPriorityDict(10)
+    with tempfile.NamedTemporaryFile() as writer:
+        PriorityDict({b'a': 1, b'b': 2}).dump(writer, format='binary')
+        writer.flush()
+        for cls in (PriorityDictSnapshot, WindowedPriorityDict, snap, window):
+            for result in (cls.fromkeys('ab', 2), cls.count('abb'),
+                           cls.load(writer.name, format='binary')):
+                assert type(result) is PriorityDict
+                result._check()
+    assert IntPriorityDict.fromkeys([1, 2]) == {1: 0, 2: 0}
+    assert type(IntPriorityDict.count([1, 1])) is IntPriorityDict
+
+def test_load_dump():
+    directory = tempfile.mkdtemp()
+    try:
+        temp = PriorityDict((str(val), val % 13) for val in range(1000))
+        for format in ('tsv', 'csv', 'binary'):
+            for name in ('counts', 'counts.gz', 'counts.bz2'):
+                path = os.path.join(directory, name)
+                temp.dump(path, format=format)
+                other = PriorityDict.load(path, format=format, chunk_size=64)
+                other._check()
+                assert other.items() == temp.items()
+        path = os.path.join(directory, 'counts.tsv')
+        with open(path, 'w') as writer:
+            writer.write('a\t3\nb\t1\n\nc\t2\na\t0\nb\t5\n')
+        other = PriorityDict.load(path, chunk_size=2)
+        other._check()
+        assert other.items() == [('a', 0), ('c', 2), ('b', 5)]
+        with open(path) as reader:
+            assert PriorityDict.load(reader) == other
+        ints = IntPriorityDict((val, val % 7) for val in range(500))
+        path = os.path.join(directory, 'ints')
+        ints.dump(path, format='binary')
+        with open(path, 'rb') as reader:
+            assert reader.read(4) == b'PDCT'
+            reader.seek(0)
+            other = IntPriorityDict.load(reader, format='binary')
+        other._check()
+        assert other.items() == ints.items()
+        ints.dump(path)
+        other = IntPriorityDict.load(path, key_type=int, chunk_size=100)
+        other._check()
+        assert other.items() == ints.items()
+        floats = PriorityDict({b'x': 0.5, b'y': -1.25})
+        floats.dump(path, format='binary')
+        other = PriorityDict.load(path, format='binary')
+        other._check()
+        assert other.items() == floats.items()
+    finally:
+        shutil.rmtree(directory)
+
+@raises(ValueError)
+def test_load_binary_magic():
+    with tempfile.NamedTemporaryFile() as writer:
+        writer.write(b'x' * 32)
+        writer.flush()
+        PriorityDict.load(writer.name, format='binary')
+
+@raises(TypeError)
+def test_dump_binary_keys():
+    PriorityDict({1: 1, 'a': 2}).dump(io.BytesIO(), format='binary')
+
+@raises(ValueError)
+def test_load_format():
+    PriorityDict.load(io.BytesIO(), format='jsn')
+
+@raises(ValueError)
+def test_dump_format():
+    PriorityDict({'a': 1}).dump(io.BytesIO(), format='jsn')
+
+def test_dump_tsv_keys():
+    stream = io.BytesIO() if hexversion < 0x03000000 else io.StringIO()
+    PriorityDict({'a\tb': 1, 'c': 2}).dump(stream)
+    stream.seek(0)
+    assert PriorityDict.load(stream).items() == [('a\tb', 1), ('c', 2)]
+    for key in ('a\nb', 'a\rb'):
+        stream = io.BytesIO()
+        try:
+            PriorityDict({key: 1, 'c': 2}).dump(stream)
+        except ValueError:
+            assert stream.getvalue() == b''
+        else:
+            assert False
+
+def test_dump_binary_overflow():
+    for items in ({1 << 63: 1}, {1: -(1 << 63) - 1}, {b'a': 1 << 64}):
+        stream = io.BytesIO()
+        try:
+            PriorityDict(items).dump(stream, format='binary')
+        except OverflowError:
+            assert stream.getvalue() == b''
+        else:
+            assert False
+    stream = io.BytesIO()
+    temp = PriorityDict({-(1 << 63): (1 << 63) - 1, 0: 0})
+    temp.dump(stream, format='binary')
+    stream.seek(0)
+    assert PriorityDict.load(stream, format='binary') == temp
+
+def test_priority_cache_lfu():
+    cache = PriorityCache(3)
+    for key in 'aabbbcd':
+        if cache.get(key) is None:
+            cache[key] = key.upper()
+    assert 'c' not in cache
+    assert list(cache) == ['d', 'a', 'b']
+    assert cache.priority('b') == (3, 4)
+    assert cache.cache_info() == (3, 4, 1, 3, 3)
+    assert cache.evict() == ('d', 'D')
+    del cache['a']
+    assert len(cache) == 1
+    cache.cache_clear()
+    assert cache.cache_info() == (0, 0, 0, 3, 0)
+
+def test_priority_cache_lru():
+    cache = PriorityCache(2, policy='lru')
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache['a'] == 1
+    cache['c'] = 3
+    assert sorted(cache) == ['a', 'c']
+    cache['a'] = 4
+    cache['d'] = 5
+    assert sorted(cache.items()) == [('a', 4), ('d', 5)]
+
+def test_priority_cache_score():
+    cache = PriorityCache(2, policy='score', score=lambda key, value: value)
+    cache['a'] = 5
+    cache['b'] = 1
+    cache.set('c', 3)
+    assert sorted(cache) == ['a', 'c']
+    cache.set('a', 0, score=10)
+    cache['d'] = 4
+    assert cache.priority('a') == (10, 0)
+    assert sorted(cache) == ['a', 'd']
+    cache['x'] = 0
+    assert list(cache.items()) == [('x', 0), ('a', 0)]
+
+def test_priority_cache_rescore():
+    cache = PriorityCache(2, 'score', score=lambda key, value: value)
+    cache['a'] = 5
+    cache['b'] = 3
+    cache['a'] = 1
+    assert cache.priority('a') == (1, 0)
+    cache['c'] = 4
+    assert sorted(cache) == ['b', 'c']
+    cache.set('b', 9, score=7)
+    cache['d'] = 5
+    assert sorted(cache) == ['b', 'd']
+
+def test_priority_cache_aging():
+    cache = PriorityCache(2, half_life=4)
+    cache['old'] = 1
+    for num in range(10):
+        cache['old']
+    for num in range(400):
+        cache['new'] = 2
+        cache['new']
+    cache['next'] = 3
+    assert sorted(cache) == ['new', 'next']
+    assert cache.priority('new')[0] < 1e100
+    assert PriorityCache(0).set('a', 1) is None
+
+def test_priority_cache_rescale_insert():
+    cache = PriorityCache(1000, half_life=1)
+    for num in range(400):
+        cache['k{0}'.format(num)] = num
+    assert sorted(cache) == sorted(cache._values)
+    assert cache['k332'] == 332
+    cache._priority._check()
+
+@raises(ValueError)
+def test_priority_cache_policy():
+    PriorityCache(policy='mru')
+
+def test_priority_cache_decorator():
+    calls = []
+    @priority_cache(maxsize=2)
+    def square(num, offset=0):
+        calls.append(num)
+        return num * num + offset
+    for num in (1, 1, 2, 3, 1, 2):
+        square(num)
+    assert square(1, offset=1) == 2
+    assert calls == [1, 2, 3, 2, 1]
+    assert square.cache_info() == (2, 5, 3, 2, 2)
+    assert square.__name__ == 'square'
+    square.cache_clear()
+    assert square.cache_info() == (0, 0, 0, 2, 0)
+    typed = priority_cache(typed=True)(lambda num: num)
+    typed(1)
+    typed(1.0)
+    assert typed.cache_info().misses == 2
+    scores = []
+    def score(arguments, result):
+        scores.append(arguments)
+        return -result
+    scored = priority_cache(2, 'score', score)(lambda num, offset=0: num)
+    for num in (1, 2, 3):
+        scored(num, offset=num)
+    assert scores == [((num,), {'offset': num}) for num in (1, 2, 3)]
+    assert sorted(key[0] for key in scored.cache) == [1, 3]
+
+def test_sample():
+    temp = PriorityDict((val, val % 5 - 1) for val in range(100))
+    rnd = random.Random(0)
+    counts = Counter(temp.sample(4000, random=rnd))
+    assert set(counts) == set(key for key in temp if temp[key] > 0)
+    assert counts[3] > counts[1] * 2
+    temp.tally(range(50))
+    temp[1000] = 100
+    del temp[3]
+    temp -= {4: 10}
+    temp.clean(-5)
+    del temp.iloc[-3:]
+    temp.popitem()
+    temp.update((val, 0.5) for val in range(2000, 2100))
+    temp._check()
+    counts = Counter(temp.sample(5, random=rnd) + temp.sample(3000, random=rnd))
+    assert all(temp[key] > 0 for key in counts)
+    assert 1000 not in temp and 3 not in counts
+    keys = temp.sample(30, replace=False, random=rnd)
+    assert len(set(keys)) == 30
+    assert all(temp[key] > 0 for key in keys)
+    temp._check()
+    temp.clear()
+    temp[1] = 0
+    temp[2] = 2
+    temp._check()
+    assert temp.sample(3) == [2, 2, 2]
+    assert temp.sample_without_replacement(1) == [2]
+    temp.disable_sampling()
+    assert temp.sample() == [2]
+
+@raises(ValueError)
+def test_sample_nonpositive():
+    PriorityDict({'a': 0, 'b': -1}).sample()
+
+@raises(ValueError)
+def test_sample_without_replacement_count():
+    PriorityDict({'a': 1, 'b': 0}).sample_without_replacement(2)
+
+def test_many():
+    temp = PriorityDict((val, val % 7) for val in range(100))
+    keys = [5, 93, 0, 5, 48, 12]
+    assert temp.get_many(keys + [200], -1) == [temp[key] for key in keys] + [-1]
+    assert temp.index_many(keys) == [temp.index(key) for key in keys]
+    values = [3, -1, 0.5, 6, 7, 3, 2.5]
+    assert temp.bisect_many(values) == [temp.bisect_left(val) for val in values]
+    assert (temp.bisect_many(values, side='right')
+            == [temp.bisect_right(val) for val in values])
+    temp.set_many(range(95, 105), range(10))
+    temp._check()
+    assert temp[104] == 9 and temp[95] == 0
+    assert temp.index_many([]) == temp.bisect_many([]) == []
+    packed = IntPriorityDict(temp)
+    packed.enable_value_index()
+    assert packed.index_many(keys) == temp.index_many(keys)
+    assert packed.bisect_many(values) == temp.bisect_many(values)
+    assert (packed.bisect_many(values, 'right')
+            == temp.bisect_many(values, 'right'))
+
+def test_many_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise SkipTest('numpy is not installed')
+    temp = PriorityDict((val, val % 7) for val in range(100))
+    keys = numpy.array([5, 93, 0])
+    result = temp.index_many(keys)
+    assert isinstance(result, numpy.ndarray)
+    assert result.tolist() == [temp.index(key) for key in (5, 93, 0)]
+    temp.set_many(keys, numpy.array([1, 2, 3]))
+    assert temp.get_many(keys).tolist() == [1, 2, 3]
+    assert type(temp[5]) is int
+
+@raises(KeyError)
+def test_index_many_missing():
+    PriorityDict({'a': 1}).index_many(['a', 'b'])
+
+@raises(ValueError)
+def test_bisect_many_side():
+    PriorityDict({'a': 1}).bisect_many([1], side='middle')
+
+@raises(ValueError)
+def test_set_many_length():
+    PriorityDict().set_many('ab', [1])
+
+def test_small():
+    temp = PriorityDict((val, -val) for val in range(10))
+    temp.small_size = 10
+    assert type(temp._list).__name__ == '_SmallList'
+    assert not hasattr(temp, '_iloc')
+    assert temp.iloc[-1] == 0 and temp.index(3) == 6
+    assert temp.bisect(-3) == 6 and temp.bisect_right(-3) == 7
+    del temp.iloc[0]
+    assert temp.popitem() == (0, 0)
+    temp.clean(-7)
+    snap, dup = temp.snapshot(), temp.copy()
+    temp.update((val, val) for val in range(20, 24))
+    temp._check()
+    assert type(temp._list).__name__ == '_SmallList'
+    temp[24] = 24
+    temp._check()
+    assert type(temp._list).__name__ == 'SortedListWithKey'
+    assert list(temp) == [6, 5, 4, 3, 2, 1, 20, 21, 22, 23, 24]
+    assert list(snap) == list(dup) == [6, 5, 4, 3, 2, 1]
+    dup.enable_value_index()
+    dup._check()
+    assert dup.count_with_value(-6) == 1
+    assert type(PriorityDict(temp)._list).__name__ == '_SmallList'
+    large = PriorityDict.fromkeys(range(1000))
+    large._check()
+    assert type(large._list).__name__ == 'SortedListWithKey'
+    assert (large + {}).iloc[-1] == 999
+
+def test_small_size_zero():
+    temp = PriorityDict()
+    temp.small_size = 0
+    temp['a'] = 1
+    assert type(temp._list).__name__ == 'SortedListWithKey'
+
+@raises(ValueError)
+def test_small_remove_missing():
+    PriorityDict({'a': 1})._list.remove(('a', 2))
+
+def test_aggregates():
+    temp = PriorityDict((val, val % 4) for val in range(10))
+    assert temp.total() == 13
+    assert temp.mean() == 1.3
+    assert abs(temp.variance() - 1.21) < 1e-12
+    temp[20] = 7
+    del temp[3]
+    temp.popitem()
+    del temp.iloc[:2]
+    temp.update({1: 2, 30: -4})
+    temp.tally([30, 30])
+    temp.clean(0)
+    temp._check()
+    assert temp.total() == sum(temp.values())
+    temp.clear()
+    temp.update((val, val / 3.0) for val in range(50))
+    for val in range(200):
+        temp[val % 50] = val * 1e6 / 7.0
+    temp._check()
+    assert type(temp.total()) is float
+    for val in range(50):
+        temp[val] = val
+    temp._check()
+    assert temp.total() == 1225 and type(temp.total()) is int
+    temp.disable_aggregates()
+    temp._check()
+
+def test_aggregates_compare():
+    this = PriorityDict({'a': 1, 'b': 2})
+    that = PriorityDict({'b': 2, 'a': 1})
+    this.enable_aggregates()
+    that.enable_aggregates()
+    assert this == that and not this != that
+    that['a'] = 1.0
+    assert this == that
+    that['b'] = 3
+    assert this != that and this <= that and this < that
+    assert not that <= this and that >= this and that > this
+    this['c'] = -5
+    that['c'] = -4
+    assert this <= that
+    other = PriorityDict({'a': 1, 'b': 1, 'c': -5})
+    other.enable_aggregates()
+    assert this >= other and not this <= other
+    small = PriorityDict({'a': 3})
+    small.enable_aggregates()
+    large = PriorityDict({'a': 3, 'd': -10})
+    large.enable_aggregates()
+    assert small <= large
+
+def test_aggregates_float_slice():
+    temp = PriorityDict((val, val + .5) for val in range(100))
+    temp.enable_aggregates()
+    temp.clean(60)
+    temp._check()
+    assert temp.total() == 3200.0
+    del temp.iloc[5:15]
+    temp._check()
+    assert temp.total() == sum(temp.values())
+    del temp.iloc[:30]
+    temp._check()
+    assert temp.total() == sum(temp.values())
+
+@raises(ValueError)
+def test_mean_empty():
+    PriorityDict().mean()
+
+@raises(ValueError)
+def test_variance_empty():
+    PriorityDict().variance()
+
+def test_multi_priority_dict():
+    temp = MultiPriorityDict(('clicks', 'revenue'),
+                             ((val, (val % 7, -val)) for val in range(20)))
+    same = dict((name, PriorityDict()) for name in temp.names)
+    for key, record in temp.items():
+        same['clicks'][key], same['revenue'][key] = record
+    for pos in range(1000):
+        key = rand(40)
+        kind = rand(4)
+        if kind == 0:
+            temp[key] = {'clicks': rand(10), 'revenue': rand(10)}
+        elif kind == 1 and key in temp:
+            temp.set(key, revenue=rand(10))
+        elif kind == 2 and key in temp:
+            del temp[key]
+            for name in temp.names:
+                del same[name][key]
+            continue
+        else:
+            continue
+        same['clicks'][key], same['revenue'][key] = temp[key]
+        if pos % 50 == 0:
+            temp._check()
+            for name in temp.names:
+                assert temp.iloc[name][:] == list(same[name])
+                assert temp.most_common(3, by=name) == same[name].most_common(3)
+                assert temp.bisect(name, 5) == same[name].bisect(5)
+                assert temp.bisect_right(name, 5) == same[name].bisect_right(5)
+                assert temp.index(key, name) == same[name].index(key)
+    assert temp.most_common(2) == same['clicks'].most_common(2)
+    first = temp.iloc['revenue'][0]
+    del temp.iloc['revenue'][0]
+    assert first not in temp
+    other = temp.copy()
+    other.set(temp.iloc['clicks'][-1], clicks=-1)
+    other._check()
+    assert other != temp
+    temp.clear()
+    assert len(temp) == len(temp.iloc['clicks']) == 0
+    assert repr(temp) == "MultiPriorityDict(('clicks', 'revenue'), {})"
+
+def test_multi_priority_dict_touches_changed():
+    temp = MultiPriorityDict(('clicks', 'revenue'), a=(1, 2), b=(3, 4))
+    revenue = temp._lists[1]
+    revenue.add = revenue.remove = None
+    temp['a'] = temp['a']._replace(clicks=5)
+    temp.set('b', clicks=0)
+    temp._check()
+    assert temp.iloc['clicks'][:] == ['b', 'a']
+
+def test_multi_priority_dict_rejected():
+    temp = MultiPriorityDict(('a', 'b'))
+    try:
+        temp.update([(1, (1, 2)), (2, (1,))])
+    except TypeError:
+        pass
+    else:
+        assert False
+    temp._check()
+    assert len(temp) == 0
+    temp.update([(1, (1, 2))])
+    temp._check()
+    assert temp[1] == (1, 2)
+
+@raises(KeyError)
+def test_multi_priority_dict_unknown():
+    MultiPriorityDict(('clicks',)).most_common(by='revenue')
+
+@raises(TypeError)
+def test_multi_priority_dict_missing():
+    MultiPriorityDict(('clicks', 'revenue')).set('a', clicks=1)
+
+def test_server():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'socket')
+    try:
+        with PriorityDictServer(path).start() as server:
+            with PriorityDictClient(path) as client:
+                client['a'] = 3
+                client.tally('abcb')
+                assert client.items() == [('c', 1), ('b', 2), ('a', 4)]
+                assert list(client) == ['c', 'b', 'a'] and len(client) == 3
+                assert client.most_common(1) == [('a', 4)]
+                assert client.rank('c') == 2 and 'c' in client
+                assert client.get('z', 0) == 0
+                client.update(d=1, e=0)
+                del client['d']
+                assert server.priority_dict == {'a': 4, 'b': 2, 'c': 1, 'e': 0}
+                with client.pipeline(batch_size=2) as pipe:
+                    pipe.set('x', 10).tally(['x']).get('x')
+                    pipe.tally(['y']).set('y', 5).get('y')
+                    pipe.rank('x').most_common(2).delete('e')
+                assert pipe.results == [None, None, 11, None, None, 5, 0,
+                                        [('x', 11), ('y', 5)], None]
+
+                def work():
+                    with PriorityDictClient(path) as other:
+                        for pos in range(100):
+                            other.tally(['k{0}'.format(pos % 5)])
+                threads = [threading.Thread(target=work) for num in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                assert all(client['k{0}'.format(pos)] == 80 for pos in range(5))
+                server.priority_dict._check()
+        assert not os.path.exists(path)
+    finally:
+        shutil.rmtree(directory)
+
+class CountingPriorityDict(PriorityDict):
+    def __init__(self, *args, **kwargs):
+        self.calls = []
+        PriorityDict.__init__(self, *args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        self.calls.append('update')
+        PriorityDict.update(self, *args, **kwargs)
+
+    def tally(self, *args, **kwargs):
+        self.calls.append('tally')
+        PriorityDict.tally(self, *args, **kwargs)
+
+def test_server_coalesces():
+    temp = CountingPriorityDict({'a': 1})
+    with PriorityDictServer(('127.0.0.1', 0), temp) as server:
+        del temp.calls[:]
+        responses = server._execute([
+            ('one', [('tally', ['a', 'b']), ('set', 'c', 5), ('tally', 'c')]),
+            ('two', [('tally', ['d']), ('set', 'd', 1), ('tally', {'d': 2})]),
+            ('three', [('get', 'd'), ('set', 'a', 0), ('get', 'e')]),
+        ])
+        assert responses[0] == ('one', [(True, None)] * 3)
+        assert responses[2][1][0] == (True, 3)
+        assert responses[2][1][2][0] is False
+        assert temp == {'a': 0, 'b': 1, 'c': 6, 'd': 3}
+        assert temp.calls == ['update', 'tally', 'update']
+        temp.clear()
+        temp['f'] = 'x'
+        responses = server._execute([
+            ('one', [('set', 'e', 'y'), ('tally', ['e']), ('len',)]),
+        ])
+        assert [ok for ok, result in responses[0][1]] == [True, False, True]
+        assert responses[0][1][2] == (True, 2)
+        responses = server._execute([
+            ('one', [('set', 'g', 'z'), ('tally', ['f']), ('set', 'h', 'w')]),
+        ])
+        assert [ok for ok, result in responses[0][1]] == [True, False, True]
+        assert temp['g'] == 'z' and temp['h'] == 'w' and temp['f'] == 'x'
+
+def test_server_rejected_tally():
+    with PriorityDictServer(('127.0.0.1', 0)).start() as server:
+        with PriorityDictClient(server.address) as client:
+            client.update(dict((key, 1) for key in 'abcdefgh'))
+            client['e'] = 'str' if hexversion < 0x03000000 else 1.5
+            items = client.items()
+            try:
+                client.tally('abcdefgh' if hexversion < 0x03000000
+                             else {'a': 1, 'b': 1, 'e': 'x'})
+            except TypeError:
+                pass
+            else:
+                assert False
+            server.priority_dict._check()
+            assert client.items() == items
+            del client['a']
+            server.priority_dict._check()
+
+def test_client_pop():
+    with PriorityDictServer(('127.0.0.1', 0)).start() as server:
+        with PriorityDictClient(server.address) as client:
+            client.update(a=1, b=2, c=3)
+            assert client.pop('a') == 1 and client.pop('a', 5) == 5
+            assert client.popitem() == ('c', 3)
+            assert client.setdefault('b', 7) == 2
+            assert client.setdefault('d') == 0
+            assert client.popitem(0) == ('d', 0)
+            assert server.priority_dict == {'b': 2}
+            try:
+                client.pop('a')
+            except KeyError:
+                pass
+            else:
+                assert False
+
+@raises(KeyError)
+def test_server_keyerror():
+    with PriorityDictServer(('127.0.0.1', 0)).start() as server:
+        with PriorityDictClient(server.address) as client:
+            client['missing']
+
+def test_memory_report():
+    temp = PriorityDict((val, val % 10 + 1000) for val in range(1000))
+    report = temp.memory_report()
+    components = ('object', 'hash_table', 'sorted_list', 'blocks', 'index',
+                  'entries', 'keys', 'values', 'proxies')
+    assert report['total'] == sum(report[name] for name in components)
+    assert report['count'] == 1000 and report['per_entry'] > 0
+    assert all(report[name] > 0 for name in components if name != 'proxies')
+    size = getsizeof(temp)
+    assert size > report['hash_table'] + report['entries']
+    containers = report['total'] - report['keys'] - report['values']
+    assert abs(size - containers) <= 64
+    temp.enable_value_index()
+    assert temp.memory_report()['proxies'] > 0
+    assert getsizeof(temp) == size
+    packed = IntPriorityDict(temp)
+    assert packed.memory_report()['total'] < report['total']
+    assert packed.memory_report()['keys'] == 0
+    snapshot = temp.snapshot()
+    assert snapshot.memory_report()['hash_table'] == 0
+    assert snapshot._lookup is None
+    small = PriorityDict(a=1)
+    assert 0 < getsizeof(small) < getsizeof(PriorityDict.fromkeys(range(300)))
+    assert PriorityDict().memory_report()['per_entry'] == 0
+    window = WindowedPriorityDict(10)
+    assert window.memory_report()['per_entry'] == 0
+    assert PriorityDict().snapshot().memory_report()['per_entry'] == 0
@@ -1,10 +1,32 @@
 # -*- coding: utf-8 -*-
+"""
+Differential stress testing of PriorityDict.
 
-import random, string
-from prioritydict import PriorityDict
-from nose.tools import raises
+Random traces of mixed operations are applied to a PriorityDict and to
+`Reference`, a naive dict plus sort model of the same semantics. Every result
+is compared and the PriorityDict is checked with `_check` periodically,
+together with a snapshot taken at the previous check. A failing trace is
+shrunk to a minimal reproduction. Long runs spread seeds over
+worker processes::
+
+    python -m tests.test_stress --ops 1000000 --seeds 16 --workers 8
+
+"""
+
+from __future__ import print_function
+
+import argparse, random, string, sys
+from prioritydict import PriorityDict, IntPriorityDict, CostModel, _PackedList
+from sortedcontainers import SortedListWithKey
+from .benchmark import BENCHMARKS, IMPLS, run
+from collections import Counter
+from multiprocessing import Pool
+from operator import itemgetter
 from sys import hexversion
 
+if hexversion < 0x03000000:
+    range = xrange
+
 def get_keysview(dic):
     if hexversion < 0x03000000:
         return dic.viewkeys()
@@ -23,5 +45,434 @@ def get_itemsview(dic):
     else:
         return dic.items()
 
+class _RefIloc(object):
+    def __init__(self, ref):
+        self._ref = ref
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [key for key, value in self._ref.items()[index]]
+        return self._ref.items()[index][0]
+
+    def __delitem__(self, index):
+        items = self._ref.items()
+        if isinstance(index, slice):
+            for key, value in items[index]:
+                del self._ref._dict[key]
+        else:
+            del self._ref._dict[items[index][0]]
+
+class _RefKeyIloc(_RefIloc):
+    def __getitem__(self, index):
+        return sorted(self._ref._dict)[index]
+
+    def __delitem__(self, index):
+        keys = sorted(self._ref._dict)
+        for key in (keys[index] if isinstance(index, slice) else [keys[index]]):
+            del self._ref._dict[key]
+
+class Reference(object):
+    """Naive model of PriorityDict: a dict sorted on demand."""
+    def __init__(self):
+        self._dict = {}
+        self.iloc = _RefIloc(self)
+        self.key_iloc = _RefKeyIloc(self)
+
+    def items(self):
+        return sorted(self._dict.items(), key=lambda item: (item[1], item[0]))
+
+    def __len__(self):
+        return len(self._dict)
+
+    def __contains__(self, key):
+        return key in self._dict
+
+    def __setitem__(self, key, value):
+        self._dict[key] = value
+
+    def __delitem__(self, key):
+        del self._dict[key]
+
+    def get(self, key, default=None):
+        return self._dict.get(key, default)
+
+    def pop(self, key, *default):
+        return self._dict.pop(key, *default)
+
+    def popitem(self, index=-1):
+        key, value = self.items()[index]
+        del self._dict[key]
+        return key, value
+
+    def setdefault(self, key, default=0):
+        return self._dict.setdefault(key, default)
+
+    def clear(self):
+        self._dict.clear()
+
+    def clean(self, value=0):
+        for key in [key for key, val in self._dict.items() if val <= value]:
+            del self._dict[key]
+
+    def update(self, mapping):
+        self._dict.update(mapping)
+
+    def tally(self, keys):
+        self += Counter(keys)
+
+    def subtract(self, keys):
+        self -= Counter(keys)
+
+    def __iadd__(self, that):
+        for key, value in that.items():
+            self._dict[key] = self._dict.get(key, 0) + value
+        return self
+
+    def __isub__(self, that):
+        for key, value in that.items():
+            if key in self._dict:
+                self._dict[key] -= value
+        return self
+
+    def __ior__(self, that):
+        for key, value in that.items():
+            self._dict[key] = max(self._dict.get(key, value), value)
+        return self
+
+    def __iand__(self, that):
+        for key, value in that.items():
+            if key in self._dict:
+                self._dict[key] = min(self._dict[key], value)
+        return self
+
+    def index(self, key):
+        value = self._dict[key]
+        return self.items().index((key, value))
+
+    def bisect_left(self, value):
+        return sum(1 for val in self._dict.values() if val < value)
+
+    def bisect_right(self, value):
+        return sum(1 for val in self._dict.values() if val <= value)
+
+    def count_with_value(self, value):
+        return sum(1 for val in self._dict.values() if val == value)
+
+    def distinct_values(self):
+        return len(set(self._dict.values()))
+
+    def iter_value_groups(self, reverse=False):
+        items = self.items()
+        values = sorted(set(self._dict.values()), reverse=reverse)
+        for value in values:
+            keys = [key for key, val in items if val == value]
+            yield value, keys[::-1] if reverse else keys
+
+    def bisect_key_left(self, key):
+        return sum(1 for val in self._dict if val < key)
+
+    def bisect_key_right(self, key):
+        return sum(1 for val in self._dict if val <= key)
+
+    def irange_keys(self, minimum=None, maximum=None, inclusive=(True, True),
+                    reverse=False):
+        keys = [key for key in sorted(self._dict)
+                if (minimum is None or minimum < key
+                    or (inclusive[0] and minimum == key))
+                and (maximum is None or key < maximum
+                     or (inclusive[1] and maximum == key))]
+        return iter(keys[::-1] if reverse else keys)
+
+    def sample(self, k, replace=True):
+        positive = [key for key, value in self._dict.items() if value > 0]
+        if not positive or (not replace and len(positive) < k):
+            raise ValueError
+        return (positive * k)[:k]
+
+    def get_many(self, keys, default=None):
+        return [self._dict.get(key, default) for key in keys]
+
+    def index_many(self, keys):
+        return [self.index(key) for key in keys]
+
+    def bisect_many(self, values, side='left'):
+        bisect = self.bisect_left if side == 'left' else self.bisect_right
+        return [bisect(value) for value in values]
+
+    def set_many(self, keys, values):
+        self.update(zip(keys, values))
+
+    def total(self):
+        return sum(self._dict.values())
+
+    def mean(self):
+        if not self._dict:
+            raise ValueError
+        return self.total() / float(len(self._dict))
+
+    def variance(self):
+        size = len(self._dict)
+        if not size:
+            raise ValueError
+        total = self.total()
+        squares = sum(val * val for val in self._dict.values())
+        return (size * squares - total * total) / float(size * size)
+
+    def most_common(self, count=None):
+        items = self.items()[::-1]
+        return items if count is None else items[:count]
+
+def generate(seed, count, keyspace=50):
+    """Return a random trace of *count* operations."""
+    rnd = random.Random(seed)
+    key = lambda: rnd.randrange(keyspace)
+    value = lambda: rnd.randrange(-5, 20)
+    mapping = lambda size: tuple((key(), value()) for num in range(size))
+    index = lambda: rnd.randrange(-keyspace, keyspace)
+    def span():
+        start, stop = sorted((rnd.randrange(keyspace), rnd.randrange(keyspace)))
+        return slice(start, stop, rnd.choice((None, None, 2, 3)))
+    makers = [
+        (20, lambda: ('__setitem__', key(), value())),
+        (5, lambda: ('__delitem__', key())),
+        (2, lambda: ('pop', key())),
+        (2, lambda: ('pop', key(), None)),
+        (2, lambda: ('popitem', index())),
+        (2, lambda: ('setdefault', key(), value())),
+        (3, lambda: ('update', mapping(rnd.randrange(keyspace)))),
+        (3, lambda: ('tally', tuple(key() for num in range(keyspace)))),
+        (2, lambda: ('subtract', tuple(key() for num in range(keyspace)))),
+        (2, lambda: ('__iadd__', mapping(rnd.randrange(keyspace)))),
+        (2, lambda: ('__isub__', mapping(rnd.randrange(keyspace)))),
+        (2, lambda: ('__ior__', mapping(rnd.randrange(keyspace)))),
+        (2, lambda: ('__iand__', mapping(rnd.randrange(keyspace)))),
+        (1, lambda: ('clean', value())),
+        (2, lambda: ('del_iloc', index())),
+        (1, lambda: ('del_iloc', span())),
+        (3, lambda: ('iloc', index())),
+        (2, lambda: ('iloc', span())),
+        (3, lambda: ('index', key())),
+        (3, lambda: ('bisect_left', value())),
+        (3, lambda: ('bisect_right', value())),
+        (2, lambda: ('count_with_value', value())),
+        (1, lambda: ('distinct_values',)),
+        (1, lambda: ('value_groups', rnd.random() < 0.5)),
+        (2, lambda: ('most_common', rnd.randrange(keyspace))),
+        (2, lambda: ('key_iloc', index())),
+        (1, lambda: ('key_iloc', span())),
+        (1, lambda: ('del_key_iloc', index())),
+        (1, lambda: ('del_key_iloc', span())),
+        (2, lambda: ('bisect_key_left', key())),
+        (2, lambda: ('bisect_key_right', key())),
+        (2, lambda: ('irange_keys', key(), key(),
+                     (rnd.random() < 0.5, rnd.random() < 0.5),
+                     rnd.random() < 0.5)),
+        (2, lambda: ('sample', rnd.randrange(1, 80), rnd.random() < 0.7)),
+        (2, lambda: ('get_many', tuple(key() for num in range(10)))),
+        (2, lambda: ('index_many', tuple(key() for num in range(5)))),
+        (2, lambda: ('bisect_many',
+                     tuple(value() + rnd.choice((0, 0, 0.5))
+                           for num in range(10)),
+                     rnd.choice(('left', 'right')))),
+        (2, lambda: ('set_many', tuple(key() for num in range(10)),
+                     tuple(value() for num in range(10)))),
+        (1, lambda: ('total',)),
+        (1, lambda: ('mean',)),
+        (1, lambda: ('variance',)),
+        (3, lambda: ('get', key())),
+        (1, lambda: ('items',)),
+        (1, lambda: ('__len__',)),
+    ]
+    if rnd.random() < 0.5:
+        makers.append((1, lambda: ('clear',)))
+    choices = [maker for weight, maker in makers for num in range(weight)]
+    return [rnd.choice(choices)() for num in range(count)]
+
+MAPPING_OPS = ('update', '__iadd__', '__isub__', '__ior__', '__iand__')
+
+def apply(obj, op):
+    """Apply *op* to *obj* and return the result or the exception raised."""
+    name, args = op[0], op[1:]
+    try:
+        if name == 'iloc':
+            return obj.iloc[args[0]]
+        elif name == 'del_iloc':
+            del obj.iloc[args[0]]
+        elif name == 'key_iloc':
+            return obj.key_iloc[args[0]]
+        elif name == 'del_key_iloc':
+            del obj.key_iloc[args[0]]
+        elif name == 'irange_keys':
+            return list(obj.irange_keys(*args))
+        elif name == 'sample':
+            keys = obj.sample(*args)
+            distinct = args[1] or len(set(keys)) == len(keys)
+            return (len(keys) == args[0] and distinct
+                    and all(obj.get(key) > 0 for key in keys))
+        elif name == 'value_groups':
+            return list(obj.iter_value_groups(*args))
+        elif name in MAPPING_OPS:
+            getattr(obj, name)(dict(args[0]))
+        else:
+            return getattr(obj, name)(*args)
+    except (KeyError, IndexError, ValueError) as error:
+        return ('raise', type(error).__name__)
+
+def make_target(seed, load=4):
+    """
+    Return a PriorityDict whose sorted list has a tiny load factor so that
+    block splits and merges happen often. The seed picks an IntPriorityDict
+    or a PriorityDict, which may start out small, a bulk strategy and
+    whether stats are recorded, values and keys are indexed and aggregates
+    are maintained.
+    """
+    rnd = random.Random(seed)
+    kind = rnd.random()
+    if kind < 0.25:
+        temp = IntPriorityDict()
+        temp._list = _PackedList(load=load)
+    elif kind < 0.5:
+        temp = PriorityDict()
+        temp.small_size = 40
+    else:
+        temp = PriorityDict()
+        temp._list = SortedListWithKey(key=itemgetter(1), load=load)
+    temp.cost_model = CostModel(
+        strategy=rnd.choice((None, 'incremental', 'merge', 'rebuild')))
+    if 0.25 <= kind < 0.5:
+        return temp
+    if rnd.random() < 0.25:
+        temp.enable_stats()
+    if rnd.random() < 0.25:
+        temp.enable_value_index()
+    if rnd.random() < 0.25:
+        temp.enable_key_index()
+    if rnd.random() < 0.25:
+        temp.enable_aggregates()
+    return temp
+
+def replay(seed, ops, check_every=100, factory=make_target):
+    """
+    Run *ops* against a new target and a Reference. Return None if they
+    agree throughout, else ``(position, message)`` of the first failure.
+    """
+    target, ref = factory(seed), Reference()
+    snapshot = None
+    for pos, op in enumerate(ops):
+        try:
+            actual = apply(target, op)
+        except Exception as error:
+            return pos, '{0!r} raised {1!r}'.format(op, error)
+        expected = apply(ref, op)
+        if actual != expected:
+            return pos, '{0!r} returned {1!r}, expected {2!r}'.format(
+                op, actual, expected)
+        if pos % check_every == 0 or pos == len(ops) - 1:
+            try:
+                target._check()
+                assert target.items() == ref.items()
+                if snapshot is not None:
+                    snapshot._check()
+                    assert snapshot.items() == snapshot_items
+                snapshot, snapshot_items = target.snapshot(), ref.items()
+            except AssertionError:
+                return pos, 'state check failed after {0!r}'.format(op)
+    return None
+
+def shrink(seed, ops, factory=make_target):
+    """Return a minimal sub-trace of *ops* which still fails."""
+    fails = lambda trace: replay(seed, trace, 1, factory) is not None
+    failure = replay(seed, ops, 1, factory)
+    ops = ops[:failure[0] + 1]
+    chunk = len(ops) // 2
+    while chunk > 0:
+        pos = 0
+        while pos < len(ops):
+            trace = ops[:pos] + ops[pos + chunk:]
+            if trace and fails(trace):
+                ops = trace
+            else:
+                pos += chunk
+        chunk //= 2
+    return ops
+
+def stress(seed, count=10000, keyspace=50, check_every=100,
+           factory=make_target):
+    """
+    Run a random trace of *count* operations with *seed*. Return None on
+    success, else a dict with the seed, the failure and the shrunk trace.
+    """
+    ops = generate(seed, count, keyspace)
+    failure = replay(seed, ops, check_every, factory)
+    if failure is None:
+        return None
+    trace = shrink(seed, ops, factory)
+    return {
+        'seed': seed,
+        'failure': replay(seed, trace, 1, factory)[1],
+        'trace': trace,
+    }
+
+def _stress(args):
+    return stress(*args)
+
+def stress_parallel(seeds, count, keyspace=50, check_every=100, workers=None):
+    """Run *seeds* over a pool of *workers* and return the failures."""
+    pool = Pool(workers)
+    try:
+        tasks = [(seed, count, keyspace, check_every) for seed in seeds]
+        return [result for result in pool.imap_unordered(_stress, tasks)
+                if result is not None]
+    finally:
+        pool.terminate()
+
+def test_benchmark():
+    records = run(sizes=[100], repeat=1)
+    assert len(records) == len(BENCHMARKS) * len(IMPLS)
+    assert all(record['best'] >= 0 for record in records)
+
 def test_stress():
-    pass
+    for seed in range(8):
+        assert stress(seed, 2000, check_every=10) is None
+
+def test_stress_keyspace():
+    assert stress(8, 500, keyspace=1000) is None
+    assert stress(9, 2000, keyspace=5, check_every=1) is None
+
+def test_stress_parallel():
+    assert stress_parallel(range(10, 14), 500, workers=2) == []
+
+class _BrokenDict(PriorityDict):
+    def clean(self, value=0):
+        PriorityDict.clean(self, value - 1)
+
+def test_shrink():
+    factory = lambda seed: _BrokenDict()
+    for seed in range(100):
+        result = stress(seed, 300, factory=factory)
+        if result is not None:
+            break
+    assert result['trace'][-1][0] == 'clean'
+    assert len(result['trace']) <= 3
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--ops', type=int, default=100000,
+                        help='operations per seed')
+    parser.add_argument('--seeds', type=int, default=8)
+    parser.add_argument('--first-seed', type=int, default=0)
+    parser.add_argument('--keyspace', type=int, default=50)
+    parser.add_argument('--check-every', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+    seeds = range(args.first_seed, args.first_seed + args.seeds)
+    failures = stress_parallel(seeds, args.ops, args.keyspace,
+                               args.check_every, args.workers)
+    for failure in failures:
+        print('seed {0}: {1}'.format(failure['seed'], failure['failure']))
+        for op in failure['trace']:
+            print('    {0!r}'.format(op))
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()